@@ -0,0 +1,77 @@
+import asyncio
+import argparse
+import logging
+
+from dotenv import load_dotenv
+
+from services.config_service import load_config
+from services.llm_service import LLMService
+from services.analysis_cache import AnalysisCache
+from services.bulk_analysis_service import BulkAnalysisService
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+async def run(args, config: dict) -> None:
+    """Score every dialog that lacks an analysis by the current prompt and write the updated log"""
+    llm_service = LLMService(
+        config['llm_provider'],
+        analysis_provider=config.get('analysis_llm_provider'),
+        max_connections=max(args.concurrency, config.get('llm_max_connections', 100)),
+        keepalive_expiry=config.get('llm_keepalive_expiry', 120),
+        analysis_cache=AnalysisCache(
+            max_entries=config.get('analysis_cache_size', 1000),
+            db_path=args.cache_db
+        )
+    )
+    bulk_service = BulkAnalysisService(
+        llm_service,
+        config['conversation_analysis_prompt'],
+        concurrency=args.concurrency,
+        max_retries=config.get('analysis_max_retries', 3)
+    )
+    
+    try:
+        if args.batch:
+            counts = await bulk_service.analyze_batch(args.csv_paths, f"{args.cache_db}.batch.json", args.poll_interval)
+        else:
+            counts = await bulk_service.analyze(args.csv_paths)
+        logging.info(f"Analyzed {counts['analyzed']} dialogs, {counts['failed']} failed")
+        
+        written = bulk_service.write_results(args.csv_paths, args.out)
+        logging.info(f"Wrote {written['rows']} rows to {args.out}, {written['updated']} with new analyses")
+    finally:
+        llm_service.analysis_cache.close()
+        await llm_service.aclose()
+
+def main():
+    """Re-score logged conversations with the current analysis prompt"""
+    parser = argparse.ArgumentParser(description="Bulk analysis of logged conversations")
+    parser.add_argument(
+        'csv_paths',
+        nargs='*',
+        default=['logs/llm_experiments/conversations.csv'],
+        help="Conversation CSV files of any schema version"
+    )
+    parser.add_argument('--out', default='logs/llm_experiments/conversations.analyzed.csv', help="Updated log to write")
+    parser.add_argument('--concurrency', type=int, default=8, help="Analyses running at the same time")
+    parser.add_argument('--batch', action='store_true', help="Use the OpenAI Batch API, slower but half the price")
+    parser.add_argument('--poll-interval', type=float, default=60.0, help="Seconds between batch status checks")
+    parser.add_argument('--cache-db', help="Analysis cache that doubles as checkpoint, analysis_cache_db by default")
+    parser.add_argument('--config', default='config.yaml', help="Bot config")
+    args = parser.parse_args()
+    
+    config = load_config(args.config)
+    
+    args.cache_db = args.cache_db or config.get('analysis_cache_db')
+    if not args.cache_db:
+        parser.error("Bulk analysis needs a persistent analysis cache, set analysis_cache_db or pass --cache-db")
+    
+    asyncio.run(run(args, config))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+from typing import Any, Dict, List
+
+import aiohttp
+
+from benchmarks.fakes import FakeChatModel, FakeTelegramBot
+from benchmarks.replay_bench import benchmark_config
+from cluster import Cluster
+
+def make_update_json(update_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    """Raw webhook payload of a private text message"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"},
+        'text': text
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+def create_benchmark_bot(config: dict):
+    """Bot of a worker process with the fake Telegram transport and fake LLM"""
+    from tg_bot import TelegramBot
+    
+    logging.getLogger().setLevel(logging.WARNING)
+    settings = config['benchmark']
+    bot = TelegramBot(config, telegram_bot=FakeTelegramBot(rtt=settings['rtt']))
+    bot.llm_service.register_llm(FakeChatModel(
+        ttft=settings['ttft'],
+        tokens_per_sec=settings['tokens_per_sec'],
+        reply_tokens=settings['reply_tokens']
+    ))
+    return bot
+
+async def run_cluster(args, workers: int, log_dir: str) -> Dict[str, Any]:
+    """Send generated updates through the ingress of a cluster and time until all are handled"""
+    config = benchmark_config(args, log_dir)
+    config['benchmark'] = {
+        'rtt': args.rtt,
+        'ttft': args.ttft,
+        'tokens_per_sec': args.tokens_per_sec,
+        'reply_tokens': args.reply_tokens
+    }
+    cluster = Cluster(config, workers, bot_factory=create_benchmark_bot, warm_up=False)
+    await cluster.start('127.0.0.1', args.port)
+    await cluster.wait_ready()
+    
+    url = f"http://127.0.0.1:{args.port}{config.get('cluster_webhook_path', '/telegram')}"
+    # Every user gets one message per wave, so each user's messages arrive in order
+    waves = [['/start_chat']] + [[f"Сообщение {turn + 1}"] for turn in range(args.turns)]
+    total = args.users * len(waves)
+    update_id = 0
+    senders = asyncio.Semaphore(args.senders)
+    
+    async with aiohttp.ClientSession() as session:
+        async def post(payload: Dict[str, Any]) -> None:
+            async with senders:
+                async with session.post(url, json=payload) as response:
+                    response.raise_for_status()
+        
+        started_at = time.perf_counter()
+        for wave in waves:
+            payloads = []
+            for user in range(args.users):
+                update_id += 1
+                payloads.append(make_update_json(update_id, 1000 + user, wave[0]))
+            await asyncio.gather(*(post(payload) for payload in payloads))
+        
+        while True:
+            statuses = await cluster.worker_status()
+            handled = sum(status['received'] for status in statuses if status)
+            busy = any(status is None or status['pending'] or status['active_users'] for status in statuses)
+            if handled >= total and not busy:
+                break
+            await asyncio.sleep(0.02)
+        elapsed = time.perf_counter() - started_at
+    
+    await cluster.stop()
+    return {
+        'workers': workers,
+        'updates': total,
+        'elapsed_sec': round(elapsed, 3),
+        'updates_per_sec': round(total / elapsed, 1),
+        'updates_per_worker': [status['received'] for status in statuses]
+    }
+
+async def run_benchmark(args) -> List[Dict[str, Any]]:
+    results = []
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as log_dir:
+            results.append(await run_cluster(args, workers, log_dir))
+    return results
+
+def main():
+    """Measure how webhook throughput scales with the number of worker processes"""
+    parser = argparse.ArgumentParser(description="Load test of the sharded webhook deployment")
+    parser.add_argument('--workers', type=lambda value: [int(n) for n in value.split(',')], default=[1, 2, 4],
+                        help="Comma-separated worker counts to compare")
+    parser.add_argument('--config', default='config.yaml', help="Bot config to start from")
+    parser.add_argument('--users', type=int, default=200, help="Simulated users")
+    parser.add_argument('--turns', type=int, default=5, help="Messages sent by every user after /start_chat")
+    parser.add_argument('--senders', type=int, default=64, help="Webhook requests in flight at once")
+    parser.add_argument('--port', type=int, default=8543, help="Local port of the ingress")
+    parser.add_argument('--max-concurrency', type=int, default=256, help="max_concurrent_users of every worker")
+    parser.add_argument('--ttft', type=float, default=0.05, help="Seconds to the first LLM token")
+    parser.add_argument('--tokens-per-sec', type=float, default=2000.0, help="LLM output token rate")
+    parser.add_argument('--reply-tokens', type=int, default=60, help="Tokens in every LLM reply")
+    parser.add_argument('--rtt', type=float, default=0.0, help="Seconds added to every Telegram API call")
+    parser.add_argument('--stream', action=argparse.BooleanOptionalAction, default=False, help="Stream replies")
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+    args = parser.parse_args()
+    # benchmark_config also reads these replay options
+    args.fallback = False
+    args.rate_limits = False
+    
+    logging.getLogger().setLevel(logging.WARNING)
+    results = asyncio.run(run_benchmark(args))
+    
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    
+    baseline = results[0]['updates_per_sec'] / results[0]['workers']
+    for result in results:
+        print(f"{result['workers']} workers: {result['updates']} updates in {result['elapsed_sec']}s, "
+              f"{result['updates_per_sec']} updates/sec "
+              f"({result['updates_per_sec'] / baseline / result['workers']:.0%} of linear), "
+              f"per worker {result['updates_per_worker']}")
+
+if __name__ == '__main__':
+    main()
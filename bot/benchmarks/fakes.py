@@ -0,0 +1,114 @@
+import time
+import random
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from services.memory_service import count_tokens
+
+class FakeTelegramBot(AsyncTeleBot):
+    """Telegram transport that keeps sent messages in memory instead of calling the API"""
+    
+    def __init__(self, rtt: float = 0.0):
+        super().__init__("0:benchmark")
+        # Simulated round trip of every API call
+        self.rtt = rtt
+        self.api_calls = 0
+        self.first_reply_latencies: List[float] = []
+        self._message_id = 0
+        self._waiting: Dict[int, float] = {}
+    
+    def expect_reply(self, chat_id: int) -> None:
+        """Start timing until the next message sent to a chat"""
+        self._waiting[chat_id] = time.perf_counter()
+    
+    async def _call(self, chat_id: Optional[int] = None, text: str = "") -> types.Message:
+        """Account for an API call and return the message it would have produced"""
+        self.api_calls += 1
+        if self.rtt:
+            await asyncio.sleep(self.rtt)
+        started_at = self._waiting.pop(chat_id, None)
+        if started_at is not None:
+            self.first_reply_latencies.append(time.perf_counter() - started_at)
+        
+        self._message_id += 1
+        return types.Message.de_json({
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id or 0, 'type': 'private'},
+            'text': text
+        })
+    
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        return await self._call(chat_id, text)
+    
+    async def edit_message_text(self, text=None, chat_id=None, message_id=None, *args, **kwargs):
+        return await self._call(chat_id, text)
+    
+    async def answer_callback_query(self, callback_query_id, *args, **kwargs):
+        await self._call()
+        return True
+    
+    async def close_session(self):
+        pass
+
+class FakeChatModel(BaseChatModel):
+    """Local chat model with a configurable time to first token and token rate
+    
+    A share of calls can fail or stall, to imitate a degraded provider.
+    """
+    
+    ttft: float = 0.5
+    tokens_per_sec: float = 50.0
+    reply_tokens: int = 60
+    fail_rate: float = 0.0
+    slow_rate: float = 0.0
+    slow_factor: float = 10.0
+    
+    calls: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+    
+    def _count_input(self, messages: List[Any]) -> None:
+        self.calls += 1
+        self.input_tokens += sum(count_tokens(str(message.content)) for message in messages)
+        if random.random() < self.fail_rate:
+            # Providers fail like a dropped connection, which the router retries
+            raise ConnectionError("Simulated provider error")
+    
+    def _first_token_delay(self) -> float:
+        return self.ttft * (self.slow_factor if random.random() < self.slow_rate else 1)
+    
+    def _reply_words(self) -> List[str]:
+        words = ["слово"] * self.reply_tokens
+        self.output_tokens += len(words)
+        return words
+    
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self._count_input(messages)
+        words = self._reply_words()
+        time.sleep(self._first_token_delay() + len(words) / self.tokens_per_sec)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=" ".join(words)))])
+    
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self._count_input(messages)
+        words = self._reply_words()
+        await asyncio.sleep(self._first_token_delay() + len(words) / self.tokens_per_sec)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=" ".join(words)))])
+    
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        self._count_input(messages)
+        await asyncio.sleep(self._first_token_delay())
+        for i, word in enumerate(self._reply_words()):
+            if i:
+                await asyncio.sleep(1 / self.tokens_per_sec)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else f" {word}"))
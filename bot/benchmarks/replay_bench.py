@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import tracemalloc
+from typing import Any, Dict, List
+
+from telebot import types
+
+from services.config_service import load_config
+from services.log_sink import read_rows
+from services.memory_service import parse_conversation_log
+from benchmarks.fakes import FakeChatModel, FakeTelegramBot
+
+# No request leaves the process, the clients only need a key to be created
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+from tg_bot import TelegramBot
+
+def load_transcripts(csv_path: str) -> List[List[str]]:
+    """User turns of every logged conversation that has any"""
+    transcripts = []
+    for row in read_rows(csv_path):
+        turns = [text for role, text in parse_conversation_log(row['Conversation Log']) if role == 'human']
+        if turns:
+            transcripts.append(turns)
+    return transcripts
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of a list of values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+def make_update(update_id: int, user_id: int, text: str) -> types.Update:
+    """Telegram update for a private text message"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"},
+        'text': text
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return types.Update.de_json({'update_id': update_id, 'message': message})
+
+def benchmark_config(args, log_dir: str) -> Dict[str, Any]:
+    """Bot config with everything that touches disk or the network redirected"""
+    config = load_config(args.config)
+    config.update({
+        'conversation_store': 'memory',
+        'analysis_cache_db': None,
+        'experiments_db': None,
+        'stt_backend': 'openai',
+        'log_dir': log_dir,
+        'metrics_port': None,
+        'stream_replies': args.stream,
+        # Simulated users send at machine speed, admission would hold or turn away their messages
+        'admission_debounce': 0,
+        'admission_turns_per_minute': None,
+        'admission_max_queue_wait': None,
+        'max_concurrent_users': args.max_concurrency or config.get('max_concurrent_users', 16)
+    })
+    if args.fallback:
+        # Routing extras ship off, the benchmark turns the fallback on
+        other = 'gemini' if config.get('llm_provider') != 'gemini' else 'gpt'
+        config['llm_fallback_provider'] = config.get('llm_fallback_provider') or other
+    else:
+        config['llm_fallback_provider'] = None
+    if not args.rate_limits:
+        config['llm_requests_per_minute'] = None
+    return config
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    """Replay transcripts with concurrent simulated users and collect the results"""
+    transcripts = load_transcripts(args.csv)
+    if not transcripts:
+        raise SystemExit(f"No conversations with user turns in {args.csv}")
+    
+    with tempfile.TemporaryDirectory() as log_dir:
+        telegram_bot = FakeTelegramBot(rtt=args.rtt)
+        bot = TelegramBot(benchmark_config(args, log_dir), telegram_bot=telegram_bot)
+        llm = FakeChatModel(
+            ttft=args.ttft,
+            tokens_per_sec=args.tokens_per_sec,
+            reply_tokens=args.reply_tokens,
+            fail_rate=args.fail_rate,
+            slow_rate=args.slow_rate
+        )
+        bot.llm_service.register_llm(llm)
+        # The fallback provider is always a healthy fake, never a real client
+        fallback_llm = FakeChatModel(
+            ttft=args.ttft,
+            tokens_per_sec=args.tokens_per_sec,
+            reply_tokens=args.reply_tokens
+        )
+        if bot.config.get('llm_fallback_provider'):
+            bot.llm_service.register_llm(fallback_llm, provider=bot.config['llm_fallback_provider'])
+        await bot.start(warm_up=False)
+        
+        latencies: List[float] = []
+        update_ids = iter(range(1, 1 << 31))
+        
+        async def send(user_id: int, text: str, timed: bool = True) -> float:
+            """Dispatch one message like the poller does and wait for its handler"""
+            done = asyncio.get_running_loop().create_future()
+            update = make_update(next(update_ids), user_id, text)
+            
+            async def job():
+                try:
+                    await bot.process_update(update)
+                finally:
+                    done.set_result(time.perf_counter())
+            
+            if timed:
+                telegram_bot.expect_reply(user_id)
+            started_at = time.perf_counter()
+            bot.dispatcher.submit(user_id, job)
+            return await done - started_at
+        
+        async def simulate_user(user_id: int, turns: List[str]) -> None:
+            """Closed loop: each message is sent once the previous reply is complete"""
+            await send(user_id, '/start_chat', timed=False)
+            for i in range(args.turns):
+                latencies.append(await send(user_id, turns[i % len(turns)]))
+        
+        if args.trace_memory:
+            tracemalloc.start()
+        started_at = time.perf_counter()
+        await asyncio.gather(*(
+            simulate_user(1000 + i, transcripts[i % len(transcripts)])
+            for i in range(args.users)
+        ))
+        elapsed = time.perf_counter() - started_at
+        memory = tracemalloc.get_traced_memory()[0] if args.trace_memory else None
+        tracemalloc.stop()
+        
+        await bot.stop()
+    
+    messages = args.users * args.turns
+    return {
+        'users': args.users,
+        'messages': messages,
+        'stream_replies': args.stream,
+        'elapsed_sec': round(elapsed, 3),
+        'msgs_per_sec': round(messages / elapsed, 2),
+        'latency_ms': {
+            f"p{p}": round(percentile(latencies, p) * 1000, 1) for p in (50, 95, 99)
+        },
+        'first_reply_ms': {
+            f"p{p}": round(percentile(telegram_bot.first_reply_latencies, p) * 1000, 1) for p in (50, 95, 99)
+        },
+        'memory_per_conversation_kb': round(memory / args.users / 1024, 1) if memory is not None else None,
+        'llm_calls': llm.calls,
+        'fallback_llm_calls': fallback_llm.calls,
+        'input_tokens_per_turn': round(llm.input_tokens / messages, 1),
+        'output_tokens_per_turn': round(llm.output_tokens / messages, 1),
+        'telegram_api_calls': telegram_bot.api_calls
+    }
+
+# Logs are not tracked, a fresh checkout replays the sample log of the tests
+BOT_LOG = 'logs/llm_experiments/conversations.csv'
+SAMPLE_LOG = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data', 'legacy_conversations.csv')
+
+def main():
+    """Replay logged conversations through the bot handlers and report throughput and latency"""
+    parser = argparse.ArgumentParser(description="Offline replay and load test of the bot handlers")
+    parser.add_argument('--csv', help="Conversation log to replay, the bot's log or else the sample log of the tests")
+    parser.add_argument('--config', default='config.yaml', help="Bot config to start from")
+    parser.add_argument('--users', type=int, default=50, help="Concurrent simulated users")
+    parser.add_argument('--turns', type=int, default=10, help="Messages sent by every user")
+    parser.add_argument('--max-concurrency', type=int, default=0, help="Override max_concurrent_users")
+    parser.add_argument('--ttft', type=float, default=0.5, help="Seconds to the first LLM token")
+    parser.add_argument('--tokens-per-sec', type=float, default=50.0, help="LLM output token rate")
+    parser.add_argument('--reply-tokens', type=int, default=60, help="Tokens in every LLM reply")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="Share of LLM calls that fail")
+    parser.add_argument('--slow-rate', type=float, default=0.0, help="Share of LLM calls with a 10x slower first token")
+    parser.add_argument('--fallback', action=argparse.BooleanOptionalAction, default=True,
+                        help="Route failed and hedged calls to a fake fallback provider")
+    parser.add_argument('--rate-limits', action='store_true', help="Keep the configured provider rate limits")
+    parser.add_argument('--rtt', type=float, default=0.0, help="Seconds added to every Telegram API call")
+    parser.add_argument('--stream', action=argparse.BooleanOptionalAction, default=True, help="Stream replies")
+    parser.add_argument('--trace-memory', action=argparse.BooleanOptionalAction, default=True,
+                        help="Measure memory per conversation, slows the run down")
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+    args = parser.parse_args()
+    if not args.csv:
+        args.csv = BOT_LOG if os.path.exists(BOT_LOG) else SAMPLE_LOG
+    
+    logging.getLogger().setLevel(logging.WARNING)
+    results = asyncio.run(run_benchmark(args))
+    
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    
+    print(f"{results['messages']} messages from {results['users']} users in {results['elapsed_sec']}s "
+          f"({'streaming' if results['stream_replies'] else 'complete'} replies)")
+    print(f"throughput:          {results['msgs_per_sec']} msgs/sec")
+    print("reply latency:       " + ", ".join(f"{p} {ms} ms" for p, ms in results['latency_ms'].items()))
+    print("first reply latency: " + ", ".join(f"{p} {ms} ms" for p, ms in results['first_reply_ms'].items()))
+    if results['memory_per_conversation_kb'] is not None:
+        print(f"memory:              {results['memory_per_conversation_kb']} KiB per conversation")
+    print(f"LLM calls:           {results['llm_calls']} main, {results['fallback_llm_calls']} fallback")
+    print(f"LLM tokens per turn: {results['input_tokens_per_turn']} in, {results['output_tokens_per_turn']} out")
+
+if __name__ == '__main__':
+    main()
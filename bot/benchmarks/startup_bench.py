@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import statistics
+import subprocess
+import tempfile
+from typing import Any, Dict, List
+
+# No request leaves the process, the clients only need a key to be created
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+PHASES = ('import_sec', 'init_sec', 'ready_sec', 'first_reply_sec', 'total_sec')
+
+async def measure_startup(args, started_at: float) -> Dict[str, float]:
+    """Time the startup phases of the bot in this fresh interpreter"""
+    import tg_bot
+    imported_at = time.perf_counter()
+    
+    # The fakes import LangChain model classes, so they are loaded after the bot module is timed
+    from benchmarks.fakes import FakeChatModel, FakeTelegramBot
+    from benchmarks.replay_bench import benchmark_config, make_update
+    
+    with tempfile.TemporaryDirectory() as log_dir:
+        args.stream = False
+        args.max_concurrency = 0
+        args.fallback = False
+        args.rate_limits = False
+        
+        fakes_loaded_at = time.perf_counter()
+        telegram_bot = FakeTelegramBot()
+        bot = tg_bot.TelegramBot(benchmark_config(args, log_dir), telegram_bot=telegram_bot)
+        bot.llm_service.register_llm(FakeChatModel(ttft=0.0, tokens_per_sec=100000.0, reply_tokens=20))
+        initialized_at = time.perf_counter()
+        
+        await bot.start(warm_up=args.warm_up)
+        ready_at = time.perf_counter()
+        
+        # The first user opens a chat and sends one message
+        for update_id, text in enumerate(('/start_chat', 'Здравствуйте!'), start=1):
+            done = asyncio.get_running_loop().create_future()
+            update = make_update(update_id, 1000, text)
+            
+            async def job(update=update, done=done):
+                try:
+                    await bot.process_update(update)
+                finally:
+                    done.set_result(None)
+            
+            bot.dispatcher.submit(1000, job)
+            await done
+        replied_at = time.perf_counter()
+        
+        await bot.stop()
+    
+    return {
+        'import_sec': imported_at - started_at,
+        'init_sec': initialized_at - fakes_loaded_at,
+        'ready_sec': ready_at - initialized_at,
+        'first_reply_sec': replied_at - ready_at,
+        # Loading the fakes is benchmark overhead and is left out
+        'total_sec': replied_at - started_at - (fakes_loaded_at - imported_at)
+    }
+
+def run_child(args) -> None:
+    started_at = time.perf_counter()
+    logging.disable(logging.WARNING)
+    print(json.dumps(asyncio.run(measure_startup(args, started_at))))
+
+def run_parent(args) -> Dict[str, Any]:
+    """Start the bot in fresh interpreters and take the median of every phase"""
+    command = [sys.executable, '-m', 'benchmarks.startup_bench', '--child', '--config', args.config]
+    if not args.warm_up:
+        command.append('--no-warm-up')
+    
+    runs: List[Dict[str, float]] = []
+    for _ in range(args.runs):
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    
+    return {
+        'runs': args.runs,
+        'warm_up': args.warm_up,
+        **{phase: round(statistics.median(run[phase] for run in runs), 3) for phase in PHASES}
+    }
+
+def main():
+    """Measure the time from process start to the first reply"""
+    parser = argparse.ArgumentParser(description="Cold start benchmark of the bot")
+    parser.add_argument('--config', default='config.yaml', help="Bot config to start from")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters to start")
+    parser.add_argument('--warm-up', action=argparse.BooleanOptionalAction, default=True,
+                        help="Warm up the LLM clients in the background like the bot does")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+    args = parser.parse_args()
+    
+    if args.child:
+        run_child(args)
+        return
+    
+    results = run_parent(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    
+    print(f"median of {results['runs']} cold starts ({'with' if results['warm_up'] else 'without'} warm-up):")
+    print(f"import:      {results['import_sec']}s")
+    print(f"init:        {results['init_sec']}s")
+    print(f"ready:       {results['ready_sec']}s")
+    print(f"first reply: {results['first_reply_sec']}s")
+    print(f"total:       {results['total_sec']}s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+import os
+import signal
+import asyncio
+import argparse
+import logging
+import multiprocessing
+from typing import Callable, Dict, List, Optional
+
+import aiohttp
+from dotenv import load_dotenv
+from telebot.async_telebot import AsyncTeleBot
+
+from services.config_service import load_config
+from services.shard_service import ShardWorker, WebhookIngress
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+def worker_config(config: dict, shard: int) -> dict:
+    """Config of one worker, with the files and ports only that worker may use"""
+    config = dict(config)
+    config['cluster_shard'] = shard
+    # One writer per CSV file, analyze_logs.py reads the shard logs together
+    config['log_dir'] = os.path.join(config.get('log_dir', 'logs/llm_experiments'), f"shard{shard}")
+    if config.get('metrics_port'):
+        config['metrics_port'] = config['metrics_port'] + 1 + shard
+    return config
+
+async def serve_worker(
+    config: dict,
+    shard: int,
+    port: int,
+    bot_factory: Optional[Callable] = None,
+    warm_up: bool = True
+) -> None:
+    """Run the bot of one shard until the process is told to stop"""
+    from tg_bot import TelegramBot
+    
+    bot = (bot_factory or TelegramBot)(worker_config(config, shard))
+    worker = ShardWorker(bot, shard, warm_up=warm_up)
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    # Ctrl+C reaches the whole process group, the cluster decides when workers stop
+    loop.add_signal_handler(signal.SIGINT, lambda: None)
+    
+    await worker.start('127.0.0.1', port)
+    await stopping.wait()
+    logging.info(f"Shard {shard} worker is draining")
+    await worker.stop()
+
+def run_worker(
+    config: dict,
+    shard: int,
+    port: int,
+    bot_factory: Optional[Callable] = None,
+    warm_up: bool = True
+) -> None:
+    """Entry point of a worker process"""
+    asyncio.run(serve_worker(config, shard, port, bot_factory, warm_up))
+
+class Cluster:
+    """Webhook ingress in this process and one bot worker process per shard
+    
+    Dead workers are restarted by the supervisor. restart_workers() replaces
+    the workers one at a time; updates for a restarting shard wait in the
+    ingress, so no user loses or reorders messages.
+    """
+    
+    def __init__(self, config: dict, workers: int, bot_factory: Optional[Callable] = None, warm_up: bool = True):
+        self.config = config
+        self.workers = workers
+        self.bot_factory = bot_factory
+        self.warm_up = warm_up
+        self.base_port = config.get('cluster_worker_base_port', 9200)
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        self.ingress = WebhookIngress(
+            [f"http://127.0.0.1:{self.base_port + shard}/updates" for shard in range(workers)],
+            path=config.get('cluster_webhook_path', '/telegram'),
+            secret_token=os.getenv('TELEGRAM_WEBHOOK_SECRET'),
+            max_buffer=config.get('cluster_buffer_size', 10000)
+        )
+        # Spawned workers do not inherit the event loop or open sockets of this process
+        self._context = multiprocessing.get_context('spawn')
+        self._stopping = False
+        self._restarting = set()
+        self._supervisor: Optional[asyncio.Task] = None
+    
+    def _start_worker(self, shard: int) -> None:
+        process = self._context.Process(
+            target=run_worker,
+            args=(self.config, shard, self.base_port + shard, self.bot_factory, self.warm_up),
+            name=f"bot-shard-{shard}"
+        )
+        process.start()
+        self.processes[shard] = process
+    
+    async def _stop_worker(self, shard: int, timeout: float = 60.0) -> None:
+        """Let a worker drain its accepted updates, killing it after the timeout"""
+        process = self.processes[shard]
+        process.terminate()
+        await asyncio.to_thread(process.join, timeout)
+        if process.is_alive():
+            logging.error(f"Shard {shard} worker did not stop in {timeout}s, killing it")
+            process.kill()
+            await asyncio.to_thread(process.join)
+    
+    async def start(self, host: str = '0.0.0.0', port: int = 8443) -> None:
+        """Start the workers, the ingress and the supervisor"""
+        if self.config.get('conversation_store') != 'sqlite':
+            logging.warning("Workers keep conversations in memory, they are lost when a worker restarts")
+        for shard in range(self.workers):
+            self._start_worker(shard)
+        await self.ingress.start(host, port)
+        self._supervisor = asyncio.create_task(self._supervise())
+    
+    async def _supervise(self) -> None:
+        """Restart workers that died"""
+        while not self._stopping:
+            for shard, process in list(self.processes.items()):
+                if not process.is_alive() and shard not in self._restarting:
+                    logging.error(f"Shard {shard} worker exited with code {process.exitcode}, restarting it")
+                    self._start_worker(shard)
+            await asyncio.sleep(1.0)
+    
+    async def worker_status(self) -> List[Optional[dict]]:
+        """Status of every worker, None for workers that do not answer"""
+        async def status(session: aiohttp.ClientSession, shard: int) -> Optional[dict]:
+            try:
+                async with session.get(f"http://127.0.0.1:{self.base_port + shard}/status") as response:
+                    return await response.json()
+            except aiohttp.ClientError:
+                return None
+        
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
+            return await asyncio.gather(*(status(session, shard) for shard in range(self.workers)))
+    
+    async def wait_ready(self, timeout: float = 120.0) -> None:
+        """Wait until every worker accepts updates"""
+        deadline = asyncio.get_running_loop().time() + timeout
+        while None in await self.worker_status():
+            if asyncio.get_running_loop().time() > deadline:
+                raise TimeoutError("Cluster workers did not start in time")
+            await asyncio.sleep(0.2)
+    
+    async def restart_workers(self) -> None:
+        """Replace the workers one at a time, e.g. to deploy new code or config"""
+        for shard in range(self.workers):
+            self._restarting.add(shard)
+            try:
+                await self._stop_worker(shard)
+                self._start_worker(shard)
+            finally:
+                self._restarting.discard(shard)
+            logging.info(f"Shard {shard} worker restarted")
+    
+    async def stop(self) -> None:
+        """Deliver buffered updates, then stop the workers after they finish them"""
+        self._stopping = True
+        if self._supervisor:
+            self._supervisor.cancel()
+        await self.ingress.stop()
+        await asyncio.gather(*(self._stop_worker(shard) for shard in self.processes))
+
+async def set_webhook(config: dict) -> None:
+    """Point Telegram at the ingress, if a public URL is configured"""
+    public_url = config.get('cluster_public_url')
+    if not public_url:
+        return
+    bot = AsyncTeleBot(os.getenv('TELEGRAM_BOT_TOKEN'))
+    try:
+        await bot.set_webhook(
+            url=public_url.rstrip('/') + config.get('cluster_webhook_path', '/telegram'),
+            secret_token=os.getenv('TELEGRAM_WEBHOOK_SECRET'),
+            max_connections=100
+        )
+        logging.info(f"Telegram webhook set to {public_url}")
+    finally:
+        await bot.close_session()
+
+async def run(config: dict, workers: int) -> None:
+    """Serve the bot from several processes until SIGTERM or Ctrl+C, SIGHUP restarts the workers"""
+    cluster = Cluster(config, workers)
+    await cluster.start(config.get('cluster_webhook_host', '0.0.0.0'), config.get('cluster_webhook_port', 8443))
+    await set_webhook(config)
+    
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    loop.add_signal_handler(signal.SIGINT, stopping.set)
+    loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(cluster.restart_workers()))
+    logging.info(f"LLM Experiment Telegram Bot cluster started with {workers} workers...")
+    
+    await stopping.wait()
+    await cluster.stop()
+
+def main():
+    """Run the bot as a webhook ingress with sharded worker processes"""
+    parser = argparse.ArgumentParser(description="Webhook deployment of the bot over several processes")
+    parser.add_argument('--workers', type=int, help="Worker processes, cluster_workers by default")
+    parser.add_argument('--config', default='config.yaml', help="Bot config")
+    args = parser.parse_args()
+    
+    config = load_config(args.config)
+    
+    workers = args.workers or config.get('cluster_workers') or os.cpu_count() or 1
+    asyncio.run(run(config, workers))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+import argparse
+import logging
+
+from services.log_sink import export_parquet
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+def main():
+    """Export conversation CSV logs to Parquet"""
+    parser = argparse.ArgumentParser(description="Export conversation logs to Parquet")
+    parser.add_argument(
+        'csv_paths',
+        nargs='*',
+        default=['logs/llm_experiments/conversations.csv'],
+        help="Conversation CSV files of any schema version"
+    )
+    parser.add_argument('--out', default='logs/llm_experiments/export', help="Output directory")
+    args = parser.parse_args()
+    
+    counts = export_parquet(args.csv_paths, args.out)
+    logging.info(f"Exported {counts['dialogs']} dialogs with {counts['prompts']} distinct prompts to {args.out}")
+
+if __name__ == '__main__':
+    main()
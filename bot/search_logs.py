@@ -0,0 +1,103 @@
+import os
+import glob
+import json
+import time
+import argparse
+import logging
+
+from services.config_service import load_config
+from services.log_sink import read_rows
+from services.search_index import DialogSearchIndex, parse_query
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+def default_csv_paths(config: dict) -> list:
+    """Conversation logs of the bot and of every cluster shard, rotated logs first"""
+    log_dir = config.get('log_dir', 'logs/llm_experiments')
+    paths = []
+    for directory in [log_dir] + sorted(glob.glob(os.path.join(log_dir, 'shard*'))):
+        # Logs moved aside on a schema change, oldest first so newer rows of a dialog replace older ones
+        rotated = (glob.glob(os.path.join(directory, 'conversations.v1*.csv'))
+                   + glob.glob(os.path.join(directory, 'conversations.old*.csv')))
+        paths += sorted(rotated, key=os.path.getmtime) + [os.path.join(directory, 'conversations.csv')]
+    return [path for path in paths if os.path.exists(path)]
+
+def reindex(index: DialogSearchIndex, csv_paths: list) -> None:
+    """Add existing conversation logs to the index"""
+    for csv_path in csv_paths:
+        started_at = time.perf_counter()
+        rows = index.rebuild(read_rows(csv_path))
+        logging.info(f"Indexed {rows} rows of {csv_path} in {time.perf_counter() - started_at:.1f}s")
+    logging.info(f"{index.count()} dialogs in {index.db_path}")
+
+def print_dialog(index: DialogSearchIndex, dialog_id: int, as_json: bool) -> None:
+    dialog = index.dialog(dialog_id)
+    if as_json or not dialog:
+        print(json.dumps(dialog, ensure_ascii=False, indent=2))
+        return
+    print(f"Dialog #{dialog['id']} of user {dialog['user_id']} at {dialog['timestamp']}, "
+          f"rating {dialog['dialog_rating'] or '-'}, naturalness {dialog['naturalness_rating'] or '-'}")
+    print(f"\nSystem prompt ({dialog['prompt_hash']}):\n{dialog['system_prompt'] or '-'}")
+    print(f"\nConversation log:\n{dialog['conversation_log']}")
+    print(f"\nAnalysis:\n{dialog['analysis_result']}")
+
+def main():
+    """Search logged dialogs by phrase, user, prompt, rating and time"""
+    parser = argparse.ArgumentParser(description="Search the index of logged dialogs")
+    parser.add_argument(
+        'query',
+        nargs='*',
+        help="Words to find and filters: user:ID prompt:HASH rating:successful|unsuccessful|unrated "
+             "natural:1-5 since:DATE until:DATE page:N id:DIALOG"
+    )
+    parser.add_argument('--config', default='config.yaml', help="Bot config")
+    parser.add_argument('--db', help="Search index, search_index_db by default")
+    parser.add_argument('--page-size', type=int, default=20, help="Dialogs per page")
+    parser.add_argument('--reindex', nargs='*', metavar='CSV',
+                        help="Index conversation logs first, the bot's logs by default")
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+    args = parser.parse_args()
+    
+    config = load_config(args.config)
+    db_path = args.db or config.get('search_index_db')
+    if not db_path:
+        raise SystemExit("No search index: set search_index_db in the config or pass --db")
+    index = DialogSearchIndex(db_path)
+    
+    try:
+        if args.reindex is not None:
+            reindex(index, args.reindex or default_csv_paths(config))
+            if not args.query:
+                return
+        
+        try:
+            search = parse_query(" ".join(args.query))
+        except ValueError as e:
+            raise SystemExit(f"Invalid query: {e}")
+        if 'dialog_id' in search:
+            print_dialog(index, search['dialog_id'], args.json)
+            return
+        
+        page = search.pop('page', 1)
+        started_at = time.perf_counter()
+        results, has_more = index.search(page=page, page_size=args.page_size, **search)
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+        
+        if args.json:
+            print(json.dumps({'page': page, 'has_more': has_more, 'results': results}, ensure_ascii=False, indent=2))
+            return
+        for result in results:
+            print(f"#{result['id']} {result['timestamp'][:19]} user {result['user_id']} "
+                  f"prompt {result['prompt_hash'][:8]} {result['dialog_rating'] or 'unrated'} "
+                  f"naturalness {result['naturalness_rating'] or '-'}")
+            print(f"    {' '.join(result['snippet'].split())}")
+        print(f"page {page}, {len(results)} dialogs in {elapsed_ms:.1f} ms"
+              + (f", next: page:{page + 1}" if has_more else ""))
+    finally:
+        index.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import asyncio
+import argparse
+import logging
+
+from dotenv import load_dotenv
+
+from services.config_service import load_config
+from services.llm_service import LLMService
+from services.conversation_service import ConversationService
+from services.logging_service import LoggingService
+from services.selfplay_service import SelfPlayService
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+def read_prompt(path: str) -> str:
+    """Read a prompt from a text file"""
+    with open(path, 'r', encoding='utf-8') as prompt_file:
+        return prompt_file.read()
+
+async def run(args, config: dict) -> dict:
+    """Play a batch of dialogs with the configured personas"""
+    llm_service = LLMService(
+        config['llm_provider'],
+        analysis_provider=config.get('analysis_llm_provider'),
+        max_connections=config.get('llm_max_connections', 100),
+        keepalive_expiry=config.get('llm_keepalive_expiry', 120)
+    )
+    conversation_service = ConversationService(
+        llm_service,
+        config['default_system_prompt'],
+        memory_settings={
+            'mode': config.get('memory_mode', 'full'),
+            'token_budget': config.get('memory_token_budget'),
+            'keep_last_turns': config.get('memory_keep_last_turns'),
+            'summary_prompt': config.get('memory_summary_prompt')
+        },
+        cache_size=args.dialogs,
+        cache_ttl=None
+    )
+    logging_service = LoggingService(
+        llm_service,
+        log_dir=args.log_dir or config.get('selfplay_log_dir', 'logs/selfplay'),
+        batch_size=config.get('log_batch_size', 50),
+        flush_interval=config.get('log_flush_interval', 1.0),
+        fsync_policy=config.get('log_fsync_policy', 'batch')
+    )
+    selfplay_service = SelfPlayService(
+        conversation_service,
+        logging_service,
+        manager_prompt=read_prompt(args.manager_prompt) if args.manager_prompt else config['selfplay_manager_prompt'],
+        analysis_prompt=config['conversation_analysis_prompt'],
+        manager_provider=config.get('selfplay_manager_provider'),
+        stop_phrases=config.get('selfplay_stop_phrases'),
+        max_turns=args.max_turns or config.get('selfplay_max_turns', 12),
+        concurrency=args.concurrency or config.get('selfplay_concurrency', 20),
+        requests_per_minute=config.get('selfplay_requests_per_minute', 0) if args.rpm is None else args.rpm
+    )
+    
+    try:
+        return await selfplay_service.run(
+            args.dialogs,
+            client_prompt=read_prompt(args.client_prompt) if args.client_prompt else None
+        )
+    finally:
+        logging_service.close()
+        await llm_service.aclose()
+
+def main():
+    """Run self-play dialogs between an LLM sales manager and the LLM client"""
+    parser = argparse.ArgumentParser(description="Headless self-play of the manager and client personas")
+    parser.add_argument('--dialogs', type=int, default=100, help="Dialogs to play")
+    parser.add_argument('--concurrency', type=int, default=0, help="Override selfplay_concurrency")
+    parser.add_argument('--max-turns', type=int, default=0, help="Override selfplay_max_turns")
+    parser.add_argument('--rpm', type=float, default=None, help="Override selfplay_requests_per_minute")
+    parser.add_argument('--client-prompt', help="File with the client prompt, default_system_prompt if omitted")
+    parser.add_argument('--manager-prompt', help="File with the manager prompt, selfplay_manager_prompt if omitted")
+    parser.add_argument('--log-dir', help="Override selfplay_log_dir")
+    parser.add_argument('--config', default='config.yaml', help="Bot config")
+    args = parser.parse_args()
+    
+    config = load_config(args.config)
+    
+    summary = asyncio.run(run(args, config))
+    logging.info(
+        f"Played {summary['dialogs']} dialogs ({summary['failed']} failed, {summary['turns']} turns) "
+        f"in {summary['elapsed']:.1f}s"
+    )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import time
+import asyncio
+from typing import Any, Callable, Dict, List, Optional
+
+# Hands an update to the per-user dispatcher
+Dispatch = Callable[[int, Any], None]
+# Turns an update away, the reason is 'rate_limited' or 'overloaded'
+Reject = Callable[[Any, str], None]
+
+class TokenBucket:
+    """Turn allowance of one user, refilled over time up to a burst size"""
+    
+    __slots__ = ('tokens', 'updated')
+    
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+    
+    def refill(self, rate: float, capacity: float, now: float) -> None:
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+class Burst:
+    """Text messages of one user that arrived in quick succession"""
+    
+    __slots__ = ('updates', 'started_at', 'timer')
+    
+    def __init__(self, started_at: float):
+        self.updates: List[Any] = []
+        self.started_at = started_at
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+class AdmissionService:
+    """Decides which user messages reach the LLM
+    
+    With debounce set, text messages are held until the user pauses for that
+    long, or for at most max_debounce seconds, and the burst is answered as
+    one turn with the texts joined. With turns_per_minute set, every turn
+    takes a token from the user's bucket, refilled at that rate up to burst
+    tokens. A turn is also turned away while the estimated wait for a free
+    slot, taken from the users in line and the recent turn duration, is over
+    max_queue_wait seconds.
+    """
+    
+    def __init__(
+        self,
+        dispatcher,
+        dispatch: Dispatch,
+        reject: Reject,
+        debounce: float = 0,
+        max_debounce: float = 5.0,
+        turns_per_minute: Optional[float] = None,
+        burst: float = 3,
+        max_queue_wait: Optional[float] = 30.0
+    ):
+        self.dispatcher = dispatcher
+        self.dispatch = dispatch
+        self.reject = reject
+        self.debounce = debounce
+        self.max_debounce = max_debounce
+        self.turns_per_minute = turns_per_minute
+        self.burst = burst
+        self.max_queue_wait = max_queue_wait
+        
+        self.turn_seconds = 0.0
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._bursts: Dict[int, Burst] = {}
+        self._counters = {'admitted': 0, 'coalesced': 0, 'rate_limited': 0, 'overloaded': 0}
+    
+    def hold(self, user_id: int, update) -> None:
+        """Add a text message to the user's burst, restarting the debounce window"""
+        if not self.debounce:
+            self.admit(user_id, update)
+            return
+        
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        burst = self._bursts.get(user_id)
+        if burst is None:
+            burst = self._bursts[user_id] = Burst(now)
+        else:
+            burst.timer.cancel()
+        burst.updates.append(update)
+        delay = min(self.debounce, burst.started_at + self.max_debounce - now)
+        burst.timer = loop.call_later(max(0.0, delay), self.release, user_id)
+    
+    def release(self, user_id: int) -> None:
+        """Send the user's held burst on as one turn, e.g. before an update that must follow it"""
+        burst = self._bursts.pop(user_id, None)
+        if burst is None:
+            return
+        burst.timer.cancel()
+        
+        update = burst.updates[-1]
+        if len(burst.updates) > 1:
+            # The reply goes to the last message, which now carries the whole burst
+            update.message.text = "\n".join(held.message.text for held in burst.updates)
+            self._counters['coalesced'] += len(burst.updates) - 1
+        self.admit(user_id, update)
+    
+    def admit(self, user_id: int, update) -> None:
+        """Dispatch an update that starts an LLM turn, unless the user or the bot is over its limit"""
+        if self.queue_wait() > (self.max_queue_wait or float('inf')):
+            self._counters['overloaded'] += 1
+            self.reject(update, 'overloaded')
+            return
+        if not self._take_token(user_id):
+            self._counters['rate_limited'] += 1
+            self.reject(update, 'rate_limited')
+            return
+        self._counters['admitted'] += 1
+        self.dispatch(user_id, update)
+    
+    def _take_token(self, user_id: int) -> bool:
+        if not self.turns_per_minute:
+            return True
+        now = time.monotonic()
+        capacity = max(1.0, self.burst)
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= 10000:
+                self._prune(now, capacity)
+            bucket = self._buckets[user_id] = TokenBucket(capacity, now)
+        else:
+            bucket.refill(self.turns_per_minute / 60, capacity, now)
+        
+        if bucket.tokens < 1:
+            return False
+        bucket.tokens -= 1
+        return True
+    
+    def _prune(self, now: float, capacity: float) -> None:
+        """Forget buckets that are full again, a new bucket starts full anyway"""
+        rate = self.turns_per_minute / 60
+        for user_id, bucket in list(self._buckets.items()):
+            if bucket.tokens + (now - bucket.updated) * rate >= capacity:
+                del self._buckets[user_id]
+    
+    def queue_wait(self) -> float:
+        """Estimated seconds a new turn waits for a free slot"""
+        return self.dispatcher.waiting_lanes() * self.turn_seconds / self.dispatcher.max_concurrency
+    
+    def record_turn(self, seconds: float) -> None:
+        """Track how long turns take, recent turns weigh the most"""
+        self.turn_seconds = seconds if not self.turn_seconds else 0.9 * self.turn_seconds + 0.1 * seconds
+    
+    def held(self) -> int:
+        """Number of users with a burst waiting for its debounce window"""
+        return len(self._bursts)
+    
+    def close(self) -> None:
+        """Send every held burst on, e.g. before the bot drains its queues"""
+        for user_id in list(self._bursts):
+            self.release(user_id)
+    
+    def metrics(self) -> Dict[str, float]:
+        """Get admission counters, held bursts and the estimated queue wait"""
+        return {
+            **self._counters,
+            'held_bursts': self.held(),
+            'queue_wait_seconds': self.queue_wait(),
+            'turn_seconds': self.turn_seconds
+        }
@@ -0,0 +1,116 @@
+import os
+import asyncio
+import logging
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+
+class AnalysisCache:
+    """Content-addressed cache of conversation analysis results
+    
+    Entries live in an in-process LRU and, when db_path is set, in a SQLite
+    table so results survive restarts and can be shared with offline tools.
+    The async path reads and writes SQLite in a thread.
+    """
+    
+    def __init__(self, max_entries: int = 1000, db_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        
+        self._db = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            # Cluster workers and the bulk analysis CLI share the file
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS analyses (key TEXT PRIMARY KEY, result TEXT NOT NULL)"
+            )
+            self._db.commit()
+    
+    @staticmethod
+    def make_key(conversation_log: str, system_prompt: str, analysis_prompt: str, model: str) -> str:
+        """Hash everything that determines an analysis result"""
+        digest = hashlib.sha256()
+        for part in (conversation_log, system_prompt, analysis_prompt, model):
+            data = (part or "").encode('utf-8')
+            # Length prefixes keep ("ab", "c") and ("a", "bc") apart
+            digest.update(len(data).to_bytes(8, 'big'))
+            digest.update(data)
+        return digest.hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """Get a cached result, looking in SQLite when it is not in memory"""
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+            elif self._db:
+                row = self._db.execute("SELECT result FROM analyses WHERE key = ?", (key,)).fetchone()
+                if row:
+                    result = row[0]
+                    self._remember(key, result)
+            
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return result
+    
+    def set(self, key: str, result: str) -> None:
+        """Store a result in memory and in SQLite"""
+        with self._lock:
+            self._remember(key, result)
+            if self._db:
+                self._db.execute("INSERT OR REPLACE INTO analyses (key, result) VALUES (?, ?)", (key, result))
+                self._db.commit()
+    
+    def _remember(self, key: str, result: str) -> None:
+        """Put a result into the in-memory LRU"""
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[str]]) -> str:
+        """Get a cached result or compute it, sharing one call between concurrent requests"""
+        result = await asyncio.to_thread(self.get, key) if self._db else self.get(key)
+        if result is not None:
+            return result
+        
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._compute(key, compute))
+            self._in_flight[key] = task
+        # A cancelled waiter must not cancel the call other waiters share
+        return await asyncio.shield(task)
+    
+    async def _compute(self, key: str, compute: Callable[[], Awaitable[str]]) -> str:
+        """Run a computation and cache its result, errors are not cached"""
+        try:
+            result = await compute()
+            try:
+                if self._db:
+                    await asyncio.to_thread(self.set, key, result)
+                else:
+                    self.set(key, result)
+            except Exception as e:
+                # The result is paid for, a failed write only costs the next lookup
+                logging.error(f"Error caching analysis result: {e}")
+            return result
+        finally:
+            self._in_flight.pop(key, None)
+    
+    def close(self) -> None:
+        """Close the SQLite connection"""
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
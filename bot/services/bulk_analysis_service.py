@@ -0,0 +1,269 @@
+import os
+import csv
+import json
+import random
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import openai
+
+from .llm_service import LLMService
+from .log_sink import CSV_COLUMNS, SCHEMA_VERSION, prompt_hash, read_rows
+from .provider_router import is_transient_error
+
+# Results that mean a dialog was never really analyzed
+FAILED_RESULTS = ("", "Unable to analyze conversation", "Analysis skipped: queue is full")
+
+# Requests the OpenAI Batch API accepts in one batch
+MAX_BATCH_REQUESTS = 50000
+
+class BulkAnalysisService:
+    """Service for re-scoring logged conversations in bulk
+    
+    Results are stored in the analysis cache under the same content keys the
+    bot uses. With a persistent cache a run can stop at any point and the
+    next run continues where it stopped, and the bot gets the new results as
+    cache hits.
+    """
+    
+    def __init__(
+        self,
+        llm_service: LLMService,
+        analysis_prompt: str,
+        concurrency: int = 8,
+        max_retries: int = 3,
+        retry_delay: float = 2.0
+    ):
+        if not llm_service.analysis_cache:
+            raise ValueError("Bulk analysis needs an analysis cache to keep its results")
+        self.llm_service = llm_service
+        self.cache = llm_service.analysis_cache
+        self.analysis_prompt = analysis_prompt
+        self.analysis_prompt_hash = prompt_hash(analysis_prompt)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+    
+    def needs_analysis(self, row: Dict[str, str]) -> bool:
+        """Check whether a row is unscored or was scored with another analysis prompt"""
+        if not row['Conversation Log'].strip():
+            return False
+        return (
+            row['Analysis Result'] in FAILED_RESULTS
+            or row['Analysis Prompt Hash'] != self.analysis_prompt_hash
+        )
+    
+    def pending(self, csv_paths: List[str]) -> Iterator[Tuple[str, Dict[str, str]]]:
+        """Stream rows that still need a result in the cache, each distinct dialog once"""
+        seen = set()
+        for csv_path in csv_paths:
+            for row in read_rows(csv_path):
+                if not self.needs_analysis(row):
+                    continue
+                key = self.llm_service.analysis_key(row['Conversation Log'], row['System Prompt'], self.analysis_prompt)
+                if key in seen or self.cache.get(key) is not None:
+                    continue
+                seen.add(key)
+                yield key, row
+    
+    async def analyze(self, csv_paths: List[str]) -> Dict[str, int]:
+        """Score pending dialogs with bounded parallelism"""
+        counts = {'analyzed': 0, 'failed': 0}
+        rows: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        
+        async def worker():
+            while True:
+                item = await rows.get()
+                if item is None:
+                    return
+                _, row = item
+                try:
+                    await self._analyze_row(row)
+                    counts['analyzed'] += 1
+                    if counts['analyzed'] % 100 == 0:
+                        logging.info(f"Analyzed {counts['analyzed']} dialogs")
+                except Exception as e:
+                    counts['failed'] += 1
+                    logging.error(f"Error analyzing dialog of user {row['User ID']}: {e}")
+        
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        # The queue is bounded, so the CSV is read only as fast as dialogs are scored
+        for item in self.pending(csv_paths):
+            await rows.put(item)
+        for _ in workers:
+            await rows.put(None)
+        await asyncio.gather(*workers)
+        return counts
+    
+    async def _analyze_row(self, row: Dict[str, str]) -> None:
+        """Score one dialog, retrying rate limits, timeouts and server errors of any provider"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.llm_service.aanalyze_conversation(
+                    conversation_log=row['Conversation Log'],
+                    system_prompt=row['System Prompt'],
+                    analysis_prompt=self.analysis_prompt
+                )
+                return
+            except Exception as e:
+                if not is_transient_error(e) or attempt == self.max_retries:
+                    raise
+                # Exponential backoff with jitter
+                await asyncio.sleep(self.retry_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+    
+    async def analyze_batch(self, csv_paths: List[str], state_path: str, poll_interval: float = 60.0) -> Dict[str, int]:
+        """Score pending dialogs through the OpenAI Batch API, at half the price of regular calls
+        
+        Ids of submitted batches are kept in state_path, so an interrupted run
+        collects them instead of paying for the same dialogs twice.
+        """
+        llm = self.llm_service.create_llm(temperature=0.2, provider=self.llm_service.analysis_provider)
+        if self.llm_service.analysis_provider != "gpt" or not llm:
+            raise ValueError("Batch analysis is only available for the gpt provider")
+        
+        client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        counts = {'analyzed': 0, 'failed': 0}
+        
+        def collect_counts(batch_counts: Dict[str, int]) -> None:
+            counts['analyzed'] += batch_counts['analyzed']
+            counts['failed'] += batch_counts['failed']
+        
+        def submitted(batch_id: str) -> None:
+            # Saved right away, a batch that is paid for must never be submitted again
+            state['batch_ids'].append(batch_id)
+            self._save_state(state_path, state)
+        
+        try:
+            state = self._load_state(state_path) or {'batch_ids': [], 'submitted': False}
+            collected = 0
+            if not state['submitted']:
+                # Results of an interrupted submission reach the cache first, so pending() skips their dialogs
+                for batch_id in state['batch_ids']:
+                    collect_counts(await self._collect_batch(client, batch_id, poll_interval))
+                collected = len(state['batch_ids'])
+                await self._submit_batches(client, llm.model_name, csv_paths, submitted)
+                state['submitted'] = True
+                self._save_state(state_path, state)
+            
+            for batch_id in state['batch_ids'][collected:]:
+                collect_counts(await self._collect_batch(client, batch_id, poll_interval))
+            os.remove(state_path)
+        finally:
+            await client.close()
+        return counts
+    
+    async def _submit_batches(
+        self,
+        client: openai.AsyncOpenAI,
+        model: str,
+        csv_paths: List[str],
+        submitted: Callable[[str], None]
+    ) -> None:
+        """Upload the pending dialogs as batch input files and start the batches, reporting each started batch"""
+        lines: List[str] = []
+        
+        async def submit():
+            input_file = await client.files.create(
+                file=("analysis_batch.jsonl", "\n".join(lines).encode('utf-8')),
+                purpose="batch"
+            )
+            batch = await client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+            submitted(batch.id)
+            logging.info(f"Submitted analysis batch {batch.id} with {len(lines)} dialogs")
+        
+        for key, row in self.pending(csv_paths):
+            formatted_prompt = self.llm_service._format_analysis_prompt(
+                row['Conversation Log'],
+                row['System Prompt'],
+                self.analysis_prompt
+            )
+            lines.append(json.dumps({
+                'custom_id': key,
+                'method': "POST",
+                'url': "/v1/chat/completions",
+                'body': {
+                    'model': model,
+                    'temperature': 0.2,
+                    'messages': [{'role': "user", 'content': formatted_prompt}]
+                }
+            }, ensure_ascii=False))
+            if len(lines) == MAX_BATCH_REQUESTS:
+                await submit()
+                lines = []
+        
+        if lines:
+            await submit()
+    
+    async def _collect_batch(self, client: openai.AsyncOpenAI, batch_id: str, poll_interval: float) -> Dict[str, int]:
+        """Wait for a batch to finish and put its results into the cache"""
+        while True:
+            batch = await client.batches.retrieve(batch_id)
+            if batch.status in ("completed", "failed", "expired", "cancelled"):
+                break
+            logging.info(f"Analysis batch {batch_id} is {batch.status}")
+            await asyncio.sleep(poll_interval)
+        
+        counts = {'analyzed': 0, 'failed': 0}
+        if not batch.output_file_id:
+            logging.error(f"Analysis batch {batch_id} ended as {batch.status} without results")
+            return counts
+        
+        output = await client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            result = json.loads(line)
+            response = result.get('response') or {}
+            if response.get('status_code') != 200:
+                counts['failed'] += 1
+                logging.error(f"Batch analysis of {result['custom_id']} failed: {result.get('error')}")
+                continue
+            self.cache.set(result['custom_id'], response['body']['choices'][0]['message']['content'])
+            counts['analyzed'] += 1
+        return counts
+    
+    @staticmethod
+    def _load_state(state_path: str) -> Optional[Dict[str, Any]]:
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path, 'r', encoding='utf-8') as state_file:
+            state = json.load(state_file)
+        # Earlier runs saved the state only once every batch was submitted
+        state.setdefault('submitted', True)
+        return state
+    
+    @staticmethod
+    def _save_state(state_path: str, state: Dict[str, Any]) -> None:
+        # Written to a temporary file first, an interrupted write must not lose the batch ids
+        temp_path = f"{state_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as state_file:
+            json.dump(state, state_file)
+        os.replace(temp_path, state_path)
+    
+    def write_results(self, csv_paths: List[str], out_path: str) -> Dict[str, int]:
+        """Write the logs with cached results filled in, in the current schema"""
+        counts = {'rows': 0, 'updated': 0}
+        os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+        with open(out_path, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=CSV_COLUMNS)
+            writer.writeheader()
+            for csv_path in csv_paths:
+                for row in read_rows(csv_path):
+                    if self.needs_analysis(row):
+                        key = self.llm_service.analysis_key(
+                            row['Conversation Log'],
+                            row['System Prompt'],
+                            self.analysis_prompt
+                        )
+                        result = self.cache.get(key)
+                        if result is not None:
+                            row['Analysis Result'] = result
+                            row['Analysis Prompt Hash'] = self.analysis_prompt_hash
+                            counts['updated'] += 1
+                    row['Schema Version'] = SCHEMA_VERSION
+                    writer.writerow(row)
+                    counts['rows'] += 1
+        return counts
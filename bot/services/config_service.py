@@ -0,0 +1,151 @@
+import os
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import yaml
+
+REQUIRED_KEYS = (
+    'llm_provider',
+    'default_system_prompt',
+    'conversation_analysis_prompt',
+    'welcome_message',
+    'prompt_not_set_message',
+    'chat_started_message',
+    'no_active_chat_message',
+    'chat_ended_message',
+    'voice_input_coming_soon'
+)
+
+# Keys with a fixed set of values, checked when they are set
+CHOICES = {
+    'llm_provider': ('gpt', 'gemini'),
+    'analysis_llm_provider': ('gpt', 'gemini'),
+    'llm_fallback_provider': ('gpt', 'gemini'),
+    'memory_mode': ('full', 'summary'),
+    'stt_backend': ('openai', 'local'),
+    'conversation_store': ('memory', 'sqlite'),
+    'log_fsync_policy': ('always', 'batch', 'never'),
+    'experiment_assignment': ('user', 'dialog')
+}
+
+# Keys that must be numbers when they are set
+NUMBER_KEYS = (
+    'llm_max_connections', 'llm_keepalive_expiry', 'llm_timeout', 'llm_max_retries',
+    'llm_hedge_percentile', 'llm_hedge_min_samples', 'memory_token_budget', 'memory_keep_last_turns',
+    'stream_edit_interval', 'analysis_workers', 'analysis_max_backlog', 'analysis_max_retries',
+    'analysis_cache_size', 'log_batch_size', 'log_flush_interval', 'conversation_cache_size',
+    'conversation_cache_ttl', 'max_concurrent_users', 'polling_timeout', 'metrics_port',
+    'response_cache_similarity', 'response_cache_bypass_rate', 'config_reload_interval', 'admission_debounce',
+    'admission_max_debounce', 'admission_turns_per_minute', 'admission_burst', 'admission_max_queue_wait',
+    'live_analysis_window', 'search_page_size'
+)
+
+class ConfigError(ValueError):
+    """The config file is missing required settings or has invalid values"""
+
+def validate_config(config: Any) -> None:
+    """Check required keys and value types, raising ConfigError with every problem found"""
+    if not isinstance(config, dict):
+        raise ConfigError("Config must be a mapping of settings")
+    
+    problems: List[str] = [f"{key} is missing" for key in REQUIRED_KEYS if not config.get(key)]
+    for key, choices in CHOICES.items():
+        if config.get(key) and config[key] not in choices:
+            problems.append(f"{key} must be one of {', '.join(choices)}, not {config[key]!r}")
+    for key in NUMBER_KEYS:
+        value = config.get(key)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            problems.append(f"{key} must be a number, not {value!r}")
+    if config.get('memory_mode') == 'summary' and not config.get('memory_summary_prompt'):
+        problems.append("memory_summary_prompt is required in summary memory mode")
+    if config.get('live_analysis') and not config.get('live_analysis_prompt'):
+        problems.append("live_analysis_prompt is required when live_analysis is on")
+    
+    if problems:
+        raise ConfigError("Invalid config: " + "; ".join(problems))
+
+# Parsed configs by absolute path, with the file version they were read from
+_cache: Dict[str, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+
+def _file_version(path: str) -> Tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+def load_config(path: str = 'config.yaml') -> Dict[str, Any]:
+    """Parse and validate a config file, reusing the result until the file changes"""
+    path = os.path.abspath(path)
+    version = _file_version(path)
+    cached = _cache.get(path)
+    if cached is None or cached[0] != version:
+        with open(path, 'r', encoding='utf-8') as config_file:
+            config = yaml.safe_load(config_file)
+        validate_config(config)
+        cached = _cache[path] = (version, config)
+    # Callers may adjust their copy, e.g. per worker
+    return dict(cached[1])
+
+class ConfigWatcher:
+    """Reloads a config file when it changes and hands every valid version to a callback
+    
+    The file is checked by modification time, so no watcher library is
+    needed. A version that does not parse or validate is logged and
+    skipped, and the running bot keeps its previous settings.
+    """
+    
+    def __init__(
+        self,
+        path: str,
+        config: Dict[str, Any],
+        on_change: Callable[[Dict[str, Any], Set[str]], None],
+        interval: float = 2.0
+    ):
+        self.path = path
+        self.config = config
+        self.on_change = on_change
+        self.interval = interval
+        self._version = _file_version(path)
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self) -> None:
+        """Start checking the file in the background"""
+        self._task = asyncio.create_task(self._run())
+    
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                logging.error(f"Error reloading config: {e}")
+    
+    def check(self) -> bool:
+        """Reload the file if it changed, returns whether a new config was applied"""
+        version = _file_version(self.path)
+        if version == self._version:
+            return False
+        self._version = version
+        
+        try:
+            config = load_config(self.path)
+        except (yaml.YAMLError, ConfigError) as e:
+            logging.error(f"Config {self.path} changed but was not applied: {e}")
+            return False
+        
+        changed = {key for key in config.keys() | self.config.keys() if config.get(key) != self.config.get(key)}
+        if not changed:
+            return False
+        self.config = config
+        logging.info(f"Config reloaded, changed: {', '.join(sorted(changed))}")
+        self.on_change(config, changed)
+        return True
+    
+    async def stop(self) -> None:
+        """Stop checking the file"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -1,37 +1,152 @@
 import uuid
+from functools import partial
 from typing import Dict, Any, Optional
 from .memory_service import TelegramChatMemory
 from .llm_service import LLMService
+from .conversation_store import ConversationCache, ConversationStore
+from .experiment_service import ExperimentService
+from .live_analysis_service import RunningAnalysis
 
 class ConversationService:
     """Service for managing user conversations"""
     
-    def __init__(self, llm_service: LLMService, default_system_prompt: str):
+    def __init__(
+        self,
+        llm_service: LLMService,
+        default_system_prompt: str,
+        memory_settings: Optional[Dict[str, Any]] = None,
+        store: Optional[ConversationStore] = None,
+        cache_size: int = 1000,
+        cache_ttl: Optional[float] = 3600,
+        experiments: Optional[ExperimentService] = None
+    ):
         self.llm_service = llm_service
         self.default_system_prompt = default_system_prompt
-        self.conversations: Dict[int, Dict[str, Any]] = {}
+        self.memory_settings = memory_settings or {}
+        self.experiments = experiments
+        
+        # Live conversations are cached, every change is written through to the store if there is one
+        self.store = store
+        self.conversations = ConversationCache(cache_size, cache_ttl)
+    
+    def _create_memory(self, user_id: int) -> TelegramChatMemory:
+        """Create chat memory according to the configured memory mode"""
+        if self.memory_settings.get('mode') != 'summary':
+            return TelegramChatMemory(user_id)
+        
+        return TelegramChatMemory(
+            user_id,
+            token_budget=self.memory_settings.get('token_budget') or 3000,
+            keep_last_turns=self.memory_settings.get('keep_last_turns') or 6,
+            summarizer=partial(self.llm_service.asummarize_history, self.memory_settings['summary_prompt'])
+        )
     
     def create_conversation(self, user_id: int, system_prompt: Optional[str] = None) -> Dict[str, Any]:
         """Create a new conversation for a user"""
+        user_uuid = str(uuid.uuid4())
+        
+        # Users with a prompt of their own stay out of the experiment
+        custom_prompt = bool(system_prompt) or self._has_custom_prompt(user_id)
+        variant = None
+        if not custom_prompt and self.experiments:
+            variant = self.experiments.assign(user_id, user_uuid)
+        
         # Use existing system prompt if available, otherwise use default
-        prompt_to_use = system_prompt or self.get_user_prompt(user_id) or self.default_system_prompt
+        prompt_to_use = (
+            system_prompt
+            or (variant.prompt if variant else None)
+            or self.get_user_prompt(user_id)
+            or self.default_system_prompt
+        )
         
         conversation = {
-            'user_uuid': str(uuid.uuid4()),
-            'memory': TelegramChatMemory(user_id, prompt_to_use),
+            'user_uuid': user_uuid,
+            'memory': self._create_memory(user_id),
             'chain': self.llm_service.create_chat_chain(prompt_to_use),
             'active': True,
             'rating': None,
             'naturalness_rating': None,
-            'system_prompt': prompt_to_use
+            'system_prompt': prompt_to_use,
+            'custom_prompt': custom_prompt,
+            'experiment': self.experiments.active.name if variant else None,
+            'variant': variant.name if variant else None,
+            'reply_seconds': 0.0,
+            'analysis': None
         }
         
-        self.conversations[user_id] = conversation
+        self.conversations.put(user_id, conversation)
+        self.save_conversation(user_id, conversation)
         return conversation
     
+    def _has_custom_prompt(self, user_id: int) -> bool:
+        """Check whether the user's last conversation ran a prompt they set themselves"""
+        conversation = self.get_conversation(user_id)
+        return bool(conversation and conversation['custom_prompt'])
+    
     def get_conversation(self, user_id: int) -> Optional[Dict[str, Any]]:
-        """Get an existing conversation"""
-        return self.conversations.get(user_id)
+        """Get an existing conversation, loading it from the store if it was evicted"""
+        conversation = self.conversations.get(user_id)
+        if conversation or not self.store:
+            return conversation
+        
+        state = self.store.load(user_id)
+        if not state:
+            return None
+        
+        conversation = self._deserialize(user_id, state)
+        self.conversations.put(user_id, conversation)
+        return conversation
+    
+    def save_conversation(self, user_id: int, conversation: Dict[str, Any]) -> None:
+        """Write the current state of a conversation through to the store
+        
+        Callers pass the conversation they hold, the cache may have evicted it meanwhile.
+        """
+        if self.store:
+            self.store.save(user_id, self._serialize(conversation))
+    
+    @staticmethod
+    def _serialize(conversation: Dict[str, Any]) -> Dict[str, Any]:
+        """Turn a conversation into compact state without chain or memory objects, with only its new turns"""
+        return {
+            'user_uuid': conversation['user_uuid'],
+            'system_prompt': conversation['system_prompt'],
+            'custom_prompt': conversation['custom_prompt'],
+            'active': conversation['active'],
+            'rating': conversation['rating'],
+            'naturalness_rating': conversation['naturalness_rating'],
+            'experiment': conversation['experiment'],
+            'variant': conversation['variant'],
+            'reply_seconds': conversation['reply_seconds'],
+            'analysis': conversation['analysis'].to_state() if conversation.get('analysis') else None,
+            # The store keeps the turns it was given before
+            'memory': conversation['memory'].unsaved_state()
+        }
+    
+    def _deserialize(self, user_id: int, state: Dict[str, Any]) -> Dict[str, Any]:
+        """Rebuild a live conversation, including its chain, from stored state"""
+        memory = self._create_memory(user_id)
+        memory.load_state(state['memory'])
+        
+        return {
+            'user_uuid': state['user_uuid'],
+            'memory': memory,
+            'chain': self.llm_service.create_chat_chain(state['system_prompt']),
+            'active': state['active'],
+            'rating': state['rating'],
+            'naturalness_rating': state['naturalness_rating'],
+            'system_prompt': state['system_prompt'],
+            # States saved before the flag existed tell custom prompts by the default prompt of the time
+            'custom_prompt': state.get(
+                'custom_prompt',
+                not state.get('variant') and state['system_prompt'] != self.default_system_prompt
+            ),
+            # States saved before experiments have no variant
+            'experiment': state.get('experiment'),
+            'variant': state.get('variant'),
+            'reply_seconds': state.get('reply_seconds', 0.0),
+            'analysis': RunningAnalysis.from_state(state.get('analysis'))
+        }
     
     def get_user_prompt(self, user_id: int) -> Optional[str]:
         """Get user's current system prompt"""
@@ -46,26 +161,35 @@ class ConversationService:
             return
         
         conversation['system_prompt'] = new_prompt
-        conversation['memory'] = TelegramChatMemory(user_id, new_prompt)
+        conversation['custom_prompt'] = True
+        conversation['experiment'] = None
+        conversation['variant'] = None
+        conversation['reply_seconds'] = 0.0
+        conversation['analysis'] = None
+        conversation['memory'] = self._create_memory(user_id)
         conversation['chain'] = self.llm_service.create_chat_chain(new_prompt)
+        self.save_conversation(user_id, conversation)
     
     def end_conversation(self, user_id: int) -> None:
         """End an active conversation"""
         conversation = self.get_conversation(user_id)
         if conversation:
             conversation['active'] = False
+            self.save_conversation(user_id, conversation)
     
     def set_rating(self, user_id: int, rating: bool) -> None:
         """Set success/failure rating for a conversation"""
         conversation = self.get_conversation(user_id)
         if conversation:
             conversation['rating'] = rating
+            self.save_conversation(user_id, conversation)
     
     def set_naturalness_rating(self, user_id: int, rating: int) -> None:
         """Set naturalness rating for a conversation"""
         conversation = self.get_conversation(user_id)
         if conversation:
             conversation['naturalness_rating'] = rating
+            self.save_conversation(user_id, conversation)
     
     def is_conversation_active(self, user_id: int) -> bool:
         """Check if user has an active conversation"""
@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+class ConversationStore:
+    """Base class for persistent storage of serialized conversation state
+    
+    Dialog turns are only ever appended, so a saved state carries just the
+    turns from state['memory']['first_turn'] on; the store keeps the earlier
+    ones and drops any it holds from that turn on. Loaded states carry every
+    turn.
+    """
+    
+    def load(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Load the state of a user's conversation"""
+        raise NotImplementedError
+    
+    def save(self, user_id: int, state: Dict[str, Any]) -> None:
+        """Save the state of a user's conversation"""
+        raise NotImplementedError
+    
+    def delete(self, user_id: int) -> None:
+        """Delete the state of a user's conversation"""
+        raise NotImplementedError
+    
+    def close(self) -> None:
+        """Release any resources held by the store"""
+
+def _merge_states(older: Optional[Dict[str, Any]], newer: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """One state that saves both, the newer one wins except for the turns only the older one holds"""
+    if older is None or newer is None:
+        return newer
+    first_turn = newer['memory'].get('first_turn', 0)
+    older_first_turn = older['memory'].get('first_turn', 0)
+    if first_turn <= older_first_turn:
+        return newer
+    memory = dict(newer['memory'])
+    memory['messages'] = older['memory']['messages'][:first_turn - older_first_turn] + newer['memory']['messages']
+    memory['first_turn'] = older_first_turn
+    return {**newer, 'memory': memory}
+
+class SQLiteConversationStore(ConversationStore):
+    """Conversation store backed by a SQLite file that several processes can share
+    
+    Saves are queued and written by one writer thread, so handlers never wait
+    on the disk or the JSON encoding. Repeated saves of a user are coalesced
+    and each pass of the writer commits every queued state in one
+    transaction. Turns are rows of their own, a save writes only the new
+    ones. Loads see queued states before they reach the file.
+    """
+    
+    def __init__(self, db_path: str, retry_delay: float = 1.0):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "user_id INTEGER PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS turns ("
+            "user_id INTEGER NOT NULL, seq INTEGER NOT NULL, turn TEXT NOT NULL, PRIMARY KEY (user_id, seq));"
+        )
+        self._db.commit()
+        
+        # States waiting for the writer and being written by it, None deletes the user
+        self._pending: Dict[int, Optional[Dict[str, Any]]] = {}
+        self._writing: Dict[int, Optional[Dict[str, Any]]] = {}
+        self._pending_ready = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name="conversation-store-writer", daemon=True)
+        self._thread.start()
+    
+    def load(self, user_id: int) -> Optional[Dict[str, Any]]:
+        with self._pending_ready:
+            queued = [states[user_id] for states in (self._writing, self._pending) if user_id in states]
+        if queued and queued[-1] is None:
+            return None
+        
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state FROM conversations WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            turns = self._db.execute(
+                "SELECT turn FROM turns WHERE user_id = ? ORDER BY seq", (user_id,)
+            ).fetchall()
+        state = json.loads(row[0]) if row else None
+        if state and 'first_turn' not in state['memory']:
+            # Rows written before turns had a table of their own hold every turn, the next save moves them
+            self._queue(user_id, state)
+        elif state:
+            state['memory']['messages'] = [json.loads(turn) for turn, in turns]
+            state['memory']['first_turn'] = 0
+        
+        # Queued saves are newer than the file, a deletion restarts from nothing
+        for queued_state in queued:
+            state = _merge_states(state, queued_state) if queued_state else None
+        if state:
+            state['memory']['first_turn'] = 0
+        return state
+    
+    def save(self, user_id: int, state: Dict[str, Any]) -> None:
+        self._queue(user_id, state)
+    
+    def delete(self, user_id: int) -> None:
+        with self._pending_ready:
+            self._pending[user_id] = None
+            self._pending_ready.notify()
+    
+    def _queue(self, user_id: int, state: Dict[str, Any]) -> None:
+        with self._pending_ready:
+            self._pending[user_id] = _merge_states(self._pending.get(user_id), state)
+            self._pending_ready.notify()
+    
+    def _run(self) -> None:
+        """Writer thread: commit the queued states until the store is closed"""
+        while True:
+            with self._pending_ready:
+                while not self._pending and not self._closing:
+                    self._pending_ready.wait()
+                if not self._pending:
+                    return
+                self._writing, self._pending = self._pending, {}
+            
+            written = self._write(self._writing)
+            with self._pending_ready:
+                if not written and not self._closing:
+                    # Later saves only hold their new turns, so the failed ones are kept for the next pass
+                    for user_id, state in self._writing.items():
+                        if user_id in self._pending:
+                            self._pending[user_id] = _merge_states(state, self._pending[user_id])
+                        else:
+                            self._pending[user_id] = state
+                self._writing = {}
+            if not written:
+                time.sleep(self.retry_delay)
+    
+    def _write(self, states: Dict[int, Optional[Dict[str, Any]]]) -> bool:
+        now = time.time()
+        with self._lock:
+            try:
+                for user_id, state in states.items():
+                    if state is None:
+                        self._db.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+                        self._db.execute("DELETE FROM turns WHERE user_id = ?", (user_id,))
+                        continue
+                    
+                    memory = state['memory']
+                    first_turn = memory.get('first_turn', 0)
+                    self._db.execute("DELETE FROM turns WHERE user_id = ? AND seq >= ?", (user_id, first_turn))
+                    self._db.executemany(
+                        "INSERT INTO turns (user_id, seq, turn) VALUES (?, ?, ?)",
+                        [
+                            (user_id, first_turn + i, json.dumps(turn, ensure_ascii=False, separators=(',', ':')))
+                            for i, turn in enumerate(memory['messages'])
+                        ]
+                    )
+                    data = json.dumps(
+                        {**state, 'memory': {**memory, 'messages': [], 'first_turn': first_turn}},
+                        ensure_ascii=False,
+                        separators=(',', ':')
+                    )
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO conversations (user_id, state, updated_at) VALUES (?, ?, ?)",
+                        (user_id, data, now)
+                    )
+                self._db.commit()
+                return True
+            except Exception as e:
+                self._db.rollback()
+                logging.error(f"Error saving {len(states)} conversations: {e}")
+                return False
+    
+    def close(self) -> None:
+        """Write the queued states and close the database"""
+        with self._pending_ready:
+            self._closing = True
+            self._pending_ready.notify()
+        self._thread.join()
+        with self._lock:
+            self._db.close()
+
+class ConversationCache:
+    """LRU cache of live conversations that also evicts users idle for longer than ttl"""
+    
+    def __init__(self, max_entries: int = 1000, ttl: Optional[float] = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # Ordered by last access, oldest first
+        self._entries: OrderedDict[int, tuple] = OrderedDict()
+    
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Get a conversation and mark it as recently used"""
+        entry = self._entries.get(user_id)
+        if not entry:
+            return None
+        
+        accessed_at, conversation = entry
+        if self.ttl and time.monotonic() - accessed_at > self.ttl:
+            del self._entries[user_id]
+            return None
+        
+        self._entries[user_id] = (time.monotonic(), conversation)
+        self._entries.move_to_end(user_id)
+        return conversation
+    
+    def put(self, user_id: int, conversation: Dict[str, Any]) -> None:
+        """Add or replace a conversation, evicting idle and least recently used ones"""
+        self._entries[user_id] = (time.monotonic(), conversation)
+        self._entries.move_to_end(user_id)
+        self.evict()
+    
+    def pop(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Remove a conversation from the cache"""
+        entry = self._entries.pop(user_id, None)
+        return entry[1] if entry else None
+    
+    def evict(self) -> None:
+        """Drop expired entries from the old end, then trim to max_entries"""
+        now = time.monotonic()
+        while self._entries:
+            user_id, (accessed_at, _) = next(iter(self._entries.items()))
+            if len(self._entries) > self.max_entries or (self.ttl and now - accessed_at > self.ttl):
+                del self._entries[user_id]
+            else:
+                break
+    
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable
+
+Job = Callable[[], Awaitable[None]]
+
+class UpdateDispatcher:
+    """Service for dispatching updates in per-user order with bounded concurrency"""
+    
+    def __init__(self, max_concurrency: int = 16):
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._lanes: Dict[Hashable, Deque[Job]] = {}
+        self._workers: Dict[Hashable, asyncio.Task] = {}
+        self._running = 0
+    
+    def submit(self, key: Hashable, job: Job) -> None:
+        """Queue a job behind all earlier jobs with the same key"""
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = deque()
+            self._workers[key] = asyncio.create_task(self._run_lane(key, lane))
+        lane.append(job)
+    
+    async def _run_lane(self, key: Hashable, lane: Deque[Job]) -> None:
+        """Run the jobs of a single lane one after another"""
+        try:
+            while lane:
+                job = lane.popleft()
+                async with self._semaphore:
+                    self._running += 1
+                    try:
+                        await job()
+                    except Exception as e:
+                        logging.error(f"Error processing update for {key}: {e}")
+                    finally:
+                        self._running -= 1
+        finally:
+            # No await between the empty check and cleanup, so no job can be lost
+            self._lanes.pop(key, None)
+            self._workers.pop(key, None)
+    
+    def pending(self) -> int:
+        """Number of queued jobs that have not started yet"""
+        return sum(len(lane) for lane in self._lanes.values())
+    
+    def active_lanes(self) -> int:
+        """Number of users with queued or running jobs"""
+        return len(self._workers)
+    
+    def waiting_lanes(self) -> int:
+        """Number of users whose next job waits for a free slot"""
+        return len(self._workers) - self._running
+    
+    async def drain(self) -> None:
+        """Wait until every queued job has finished"""
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
@@ -0,0 +1,408 @@
+import os
+import json
+import math
+import time
+import queue
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from .log_sink import prompt_hash
+
+NATURALNESS_SCALE = 5
+
+class Variant:
+    """One prompt of an experiment with its share of the traffic"""
+    
+    __slots__ = ('name', 'prompt', 'weight', 'prompt_hash', 'version')
+    
+    def __init__(self, name: str, prompt: str, weight: float = 1.0):
+        self.name = name
+        self.prompt = prompt
+        self.weight = weight
+        self.prompt_hash = prompt_hash(prompt)
+        self.version = 1
+
+class Experiment:
+    """Prompt variants compared on users or on single dialogs"""
+    
+    def __init__(self, name: str, variants: List[Variant], assignment: str = 'user'):
+        if assignment not in ('user', 'dialog'):
+            raise ValueError(f"Unknown experiment assignment: {assignment}")
+        if not variants or sum(variant.weight for variant in variants) <= 0:
+            raise ValueError(f"Experiment {name} needs variants with a positive total weight")
+        self.name = name
+        self.variants = variants
+        self.assignment = assignment
+    
+    def pick(self, unit: str) -> Variant:
+        """Variant of a user or dialog, stable across restarts and processes"""
+        digest = hashlib.sha256(f"{self.name}:{unit}".encode('utf-8')).digest()
+        point = int.from_bytes(digest[:8], 'big') / 2 ** 64 * sum(variant.weight for variant in self.variants)
+        for variant in self.variants:
+            point -= variant.weight
+            if point < 0:
+                return variant
+        return self.variants[-1]
+
+class VariantStats:
+    """Running totals of the dialogs logged for one prompt version"""
+    
+    __slots__ = ('dialogs', 'rated', 'successes', 'naturalness', 'turns', 'tokens', 'timed_turns', 'reply_seconds')
+    
+    def __init__(self):
+        self.dialogs = 0
+        self.rated = 0
+        self.successes = 0
+        # Dialog count per naturalness rating, 1 to NATURALNESS_SCALE
+        self.naturalness = [0] * NATURALNESS_SCALE
+        self.turns = 0
+        self.tokens = 0
+        self.timed_turns = 0
+        self.reply_seconds = 0.0
+    
+    def add(self, contribution: Dict[str, Any], sign: int = 1) -> None:
+        """Add the figures of one dialog, or take them back with sign -1"""
+        self.dialogs += sign
+        if contribution['rating'] is not None:
+            self.rated += sign
+            self.successes += sign * contribution['rating']
+        if contribution['naturalness']:
+            self.naturalness[contribution['naturalness'] - 1] += sign
+        self.turns += sign * contribution['turns']
+        self.tokens += sign * contribution['tokens']
+        if contribution['reply_seconds']:
+            self.timed_turns += sign * contribution['turns']
+            self.reply_seconds += sign * contribution['reply_seconds']
+    
+    def merge(self, other: 'VariantStats') -> None:
+        """Add the totals of another process"""
+        for slot in self.__slots__:
+            if slot == 'naturalness':
+                self.naturalness = [a + b for a, b in zip(self.naturalness, other.naturalness)]
+            else:
+                setattr(self, slot, getattr(self, slot) + getattr(other, slot))
+    
+    def to_state(self) -> Dict[str, Any]:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+    
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> 'VariantStats':
+        stats = cls()
+        for slot in cls.__slots__:
+            setattr(stats, slot, state.get(slot, getattr(stats, slot)))
+        return stats
+    
+    def summary(self) -> Dict[str, Any]:
+        """Rates and means of the dialogs, with a 95% Wilson interval for the success rate"""
+        rated_naturalness = sum(self.naturalness)
+        success_rate = self.successes / self.rated if self.rated else None
+        return {
+            'dialogs': self.dialogs,
+            'rated': self.rated,
+            'success_rate': success_rate,
+            'success_interval': wilson_interval(self.successes, self.rated),
+            'naturalness_mean': (
+                sum((score + 1) * count for score, count in enumerate(self.naturalness)) / rated_naturalness
+                if rated_naturalness else None
+            ),
+            'naturalness_counts': list(self.naturalness),
+            'turns_mean': self.turns / self.dialogs if self.dialogs else None,
+            'tokens_mean': self.tokens / self.dialogs if self.dialogs else None,
+            'reply_seconds_mean': self.reply_seconds / self.timed_turns if self.timed_turns else None
+        }
+
+def wilson_interval(successes: int, trials: int, z: float = 1.96) -> Optional[Tuple[float, float]]:
+    """Confidence interval of a success rate that stays sensible for few trials"""
+    if not trials:
+        return None
+    rate = successes / trials
+    denominator = 1 + z * z / trials
+    center = (rate + z * z / (2 * trials)) / denominator
+    margin = z * math.sqrt(rate * (1 - rate) / trials + z * z / (4 * trials * trials)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+class ExperimentService:
+    """Registry of prompt experiments with per-variant statistics
+    
+    Prompts are stored by hash with a version per variant, so editing a
+    variant starts a new set of statistics instead of mixing two prompts.
+    Every logged dialog updates its variant's running totals in constant
+    time. A dialog logged again, e.g. after a second rating, replaces its
+    earlier figures. With db_path set, prompts, totals and recent dialog
+    figures are kept in SQLite and survive restarts; a writer thread saves
+    them, so logging a dialog never waits on the disk. Processes sharing the
+    database keep their totals apart by shard and statistics add them up.
+    """
+    
+    def __init__(self, db_path: Optional[str] = None, max_dialogs: int = 10000, shard: int = 0):
+        self.max_dialogs = max_dialogs
+        self.shard = shard
+        self.active: Optional[Experiment] = None
+        # Guards the totals, the connection has a lock of its own
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        # (experiment, variant, prompt hash) -> totals
+        self._stats: Dict[Tuple[str, str, str], VariantStats] = {}
+        # (experiment, variant, prompt hash) -> version of the prompt
+        self._versions: Dict[Tuple[str, str, str], int] = {}
+        # Dialog uuid -> (stats key, figures) of recently logged dialogs
+        self._dialogs: OrderedDict[str, Tuple[Tuple[str, str, str], Dict[str, Any]]] = OrderedDict()
+        
+        self._db = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS prompts ("
+                "experiment TEXT NOT NULL, variant TEXT NOT NULL, prompt_hash TEXT NOT NULL, "
+                "version INTEGER NOT NULL, prompt TEXT NOT NULL, created_at REAL NOT NULL, "
+                "PRIMARY KEY (experiment, variant, prompt_hash))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS variant_stats ("
+                "experiment TEXT NOT NULL, variant TEXT NOT NULL, prompt_hash TEXT NOT NULL, "
+                "shard INTEGER NOT NULL, stats TEXT NOT NULL, "
+                "PRIMARY KEY (experiment, variant, prompt_hash, shard))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS dialogs ("
+                "dialog_id TEXT PRIMARY KEY, experiment TEXT NOT NULL, variant TEXT NOT NULL, "
+                "prompt_hash TEXT NOT NULL, figures TEXT NOT NULL)"
+            )
+            self._db.commit()
+            self._load()
+            # Logged dialogs waiting for the writer, None stops it
+            self._queue: queue.Queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, name="experiment-writer", daemon=True)
+            self._thread.start()
+    
+    def _load(self) -> None:
+        """Read prompt versions and the totals of this shard, both are small"""
+        for experiment, variant, hash_, version in self._db.execute(
+            "SELECT experiment, variant, prompt_hash, version FROM prompts"
+        ):
+            self._versions[(experiment, variant, hash_)] = version
+        for experiment, variant, hash_, stats in self._db.execute(
+            "SELECT experiment, variant, prompt_hash, stats FROM variant_stats WHERE shard = ?", (self.shard,)
+        ):
+            self._stats[(experiment, variant, hash_)] = VariantStats.from_state(json.loads(stats))
+    
+    def define(self, name: str, variants: Dict[str, Dict[str, Any]], assignment: str = 'user') -> Experiment:
+        """Register an experiment from {variant: {'prompt', 'weight'}} and make it the active one"""
+        experiment = Experiment(
+            name,
+            [Variant(variant, settings['prompt'], settings.get('weight', 1.0)) for variant, settings in variants.items()],
+            assignment
+        )
+        with self._lock:
+            new_variants = [variant for variant in experiment.variants if self._register_prompt(name, variant)]
+            self.active = experiment
+        if self._db and new_variants:
+            with self._db_lock:
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO prompts "
+                    "(experiment, variant, prompt_hash, version, prompt, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (name, variant.name, variant.prompt_hash, variant.version, variant.prompt, time.time())
+                        for variant in new_variants
+                    ]
+                )
+                self._db.commit()
+        return experiment
+    
+    def _register_prompt(self, experiment: str, variant: Variant) -> bool:
+        """Set the version of a variant's prompt, adding the prompt as the next version if it is new"""
+        key = (experiment, variant.name, variant.prompt_hash)
+        is_new = key not in self._versions
+        if is_new:
+            self._versions[key] = 1 + max(
+                (version for (name, variant_name, _), version in self._versions.items()
+                 if name == experiment and variant_name == variant.name),
+                default=0
+            )
+        variant.version = self._versions[key]
+        return is_new
+    
+    def assign(self, user_id: int, dialog_id: str) -> Optional[Variant]:
+        """Variant of the active experiment for a new dialog, None without an experiment"""
+        if not self.active:
+            return None
+        unit = str(user_id) if self.active.assignment == 'user' else dialog_id
+        return self.active.pick(unit)
+    
+    def record(self, conversation: Dict[str, Any]) -> None:
+        """Add a logged dialog to its variant's totals, replacing an earlier log of the same dialog"""
+        if not conversation.get('variant'):
+            return
+        
+        memory = conversation['memory']
+        key = (conversation['experiment'], conversation['variant'], prompt_hash(conversation['system_prompt']))
+        figures = {
+            'rating': conversation.get('rating'),
+            'naturalness': conversation.get('naturalness_rating'),
+            'turns': len(memory.turns) // 2,
+            'tokens': memory.dialog_tokens,
+            'reply_seconds': conversation.get('reply_seconds', 0.0)
+        }
+        dialog_id = conversation['user_uuid']
+        
+        with self._lock:
+            previous = self._dialogs.get(dialog_id)
+            if previous:
+                self._totals(previous[0]).add(previous[1], -1)
+            self._totals(key).add(figures)
+            
+            self._dialogs[dialog_id] = (key, figures)
+            self._dialogs.move_to_end(dialog_id)
+            while len(self._dialogs) > self.max_dialogs:
+                self._dialogs.popitem(last=False)
+        
+        if self._db:
+            # Figures of a dialog counted before a restart are looked up and taken back by the writer
+            self._queue.put((dialog_id, key, figures, previous is not None))
+    
+    def _run(self) -> None:
+        """Writer thread: save the queued dialogs and the totals they changed, a batch per transaction"""
+        closing = False
+        while not closing:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = None in batch
+            batch = [item for item in batch if item is not None]
+            if batch:
+                self._write(batch)
+    
+    def _write(self, batch: List[Tuple[str, Tuple[str, str, str], Dict[str, Any], bool]]) -> None:
+        changed = set()
+        with self._db_lock:
+            try:
+                for dialog_id, key, figures, counted in batch:
+                    if not counted:
+                        row = self._db.execute(
+                            "SELECT experiment, variant, prompt_hash, figures FROM dialogs WHERE dialog_id = ?",
+                            (dialog_id,)
+                        ).fetchone()
+                        if row:
+                            with self._lock:
+                                self._totals(row[:3]).add(json.loads(row[3]), -1)
+                            changed.add(row[:3])
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO dialogs (dialog_id, experiment, variant, prompt_hash, figures) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (dialog_id, *key, json.dumps(figures))
+                    )
+                    changed.add(key)
+                
+                with self._lock:
+                    states = [(*key, self.shard, json.dumps(self._stats[key].to_state())) for key in changed]
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO variant_stats (experiment, variant, prompt_hash, shard, stats) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    states
+                )
+                self._db.commit()
+            except Exception as e:
+                self._db.rollback()
+                logging.error(f"Error saving experiment figures of {len(batch)} dialogs: {e}")
+    
+    def _totals(self, key: Tuple[str, str, str]) -> VariantStats:
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = VariantStats()
+        return stats
+    
+    def stats(self, experiment: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Summaries of every prompt version of an experiment, the active one by default"""
+        name = experiment or (self.active.name if self.active else None)
+        totals = self._experiment_totals(name)
+        versions = self._experiment_versions(name)
+        rows = [
+            {
+                'variant': variant,
+                'version': versions.get((variant, hash_), 0),
+                'prompt_hash': hash_,
+                **stats.summary()
+            }
+            for (variant, hash_), stats in totals.items()
+        ]
+        return sorted(rows, key=lambda row: (row['variant'], row['version']))
+    
+    def _experiment_totals(self, name: Optional[str]) -> Dict[Tuple[str, str], VariantStats]:
+        """Totals of an experiment's prompt versions, this process's added to the other shards' in the database"""
+        totals: Dict[Tuple[str, str], VariantStats] = {}
+        with self._lock:
+            for (experiment_name, variant, hash_), stats in self._stats.items():
+                if experiment_name == name:
+                    totals[(variant, hash_)] = VariantStats.from_state(stats.to_state())
+        if not self._db:
+            return totals
+        
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT variant, prompt_hash, stats FROM variant_stats WHERE experiment = ? AND shard != ?",
+                (name, self.shard)
+            ).fetchall()
+        for variant, hash_, state in rows:
+            totals.setdefault((variant, hash_), VariantStats()).merge(VariantStats.from_state(json.loads(state)))
+        return totals
+    
+    def _experiment_versions(self, name: Optional[str]) -> Dict[Tuple[str, str], int]:
+        """Prompt versions of an experiment, including ones registered by other processes"""
+        if self._db:
+            with self._db_lock:
+                rows = self._db.execute(
+                    "SELECT variant, prompt_hash, version FROM prompts WHERE experiment = ?", (name,)
+                ).fetchall()
+            return {(variant, hash_): version for variant, hash_, version in rows}
+        with self._lock:
+            return {
+                (variant, hash_): version
+                for (experiment_name, variant, hash_), version in self._versions.items()
+                if experiment_name == name
+            }
+    
+    def report(self, experiment: Optional[str] = None) -> str:
+        """Plain-text statistics of an experiment for a chat message"""
+        name = experiment or (self.active.name if self.active else None)
+        rows = self.stats(name)
+        if not rows:
+            return f"Нет данных по эксперименту {name}." if name else "Нет активного эксперимента."
+        
+        def number(value: Optional[float], digits: int = 1) -> str:
+            return "—" if value is None else f"{value:.{digits}f}"
+        
+        lines = [f"Эксперимент {name}:"]
+        for row in rows:
+            interval = row['success_interval']
+            success = (
+                f"{row['success_rate']:.0%} [{interval[0]:.0%}–{interval[1]:.0%}] из {row['rated']}"
+                if row['rated'] else "—"
+            )
+            lines.append(
+                f"\n{row['variant']} v{row['version']} ({row['prompt_hash'][:8]}): {row['dialogs']} диалогов\n"
+                f"  успешность: {success}\n"
+                f"  естественность: {number(row['naturalness_mean'])} "
+                f"({' / '.join(str(count) for count in row['naturalness_counts'])})\n"
+                f"  ходов: {number(row['turns_mean'])}, токенов: {number(row['tokens_mean'], 0)}, "
+                f"ответ: {number(row['reply_seconds_mean'], 2)} с"
+            )
+        return "\n".join(lines)
+    
+    def close(self) -> None:
+        """Save the queued dialogs and close the SQLite connection"""
+        if not self._db:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        with self._db_lock:
+            self._db.close()
+            self._db = None
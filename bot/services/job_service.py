@@ -0,0 +1,129 @@
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+Job = Callable[[], Awaitable[Any]]
+ResultCallback = Callable[[Any], Awaitable[None]]
+ErrorCallback = Callable[[Exception], Awaitable[None]]
+
+class JobQueueService:
+    """Service for running background jobs with retries and a bounded backlog"""
+    
+    def __init__(
+        self,
+        workers: int = 2,
+        max_backlog: int = 100,
+        max_retries: int = 3,
+        retry_delay: float = 2.0,
+        name: str = "jobs"
+    ):
+        self.workers = workers
+        self.max_backlog = max_backlog
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.name = name
+        
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._running = 0
+        self._counters = {'submitted': 0, 'completed': 0, 'failed': 0, 'retried': 0, 'rejected': 0}
+        self._latencies = deque(maxlen=500)
+    
+    def start(self) -> None:
+        """Start the worker tasks on the running event loop"""
+        self._queue = asyncio.Queue(maxsize=self.max_backlog)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self) -> None:
+        """Finish the queued jobs and stop the workers"""
+        if not self._queue:
+            return
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    def submit(
+        self,
+        job: Job,
+        on_done: Optional[ResultCallback] = None,
+        on_error: Optional[ErrorCallback] = None
+    ) -> bool:
+        """Queue a job, return False if the backlog is full"""
+        try:
+            self._queue.put_nowait((time.monotonic(), job, on_done, on_error))
+        except asyncio.QueueFull:
+            self._counters['rejected'] += 1
+            logging.warning(f"Job queue {self.name} is full, job rejected")
+            return False
+        self._counters['submitted'] += 1
+        return True
+    
+    async def _worker(self) -> None:
+        """Take jobs from the queue until cancelled"""
+        while True:
+            submitted_at, job, on_done, on_error = await self._queue.get()
+            self._running += 1
+            try:
+                await self._run_job(submitted_at, job, on_done, on_error)
+            finally:
+                self._running -= 1
+                self._queue.task_done()
+    
+    async def _run_job(
+        self,
+        submitted_at: float,
+        job: Job,
+        on_done: Optional[ResultCallback],
+        on_error: Optional[ErrorCallback]
+    ) -> None:
+        """Run a job with retries and deliver its result"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = await job()
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    self._counters['failed'] += 1
+                    logging.error(f"Job in {self.name} failed after {attempt + 1} attempts: {e}")
+                    await self._call(on_error, e)
+                    return
+                self._counters['retried'] += 1
+                # Exponential backoff with jitter
+                await asyncio.sleep(self.retry_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+        
+        latency = time.monotonic() - submitted_at
+        self._latencies.append(latency)
+        self._counters['completed'] += 1
+        logging.info(f"Job in {self.name} finished in {latency:.2f}s, queue depth {self._queue.qsize()}")
+        await self._call(on_done, result)
+    
+    @staticmethod
+    async def _call(callback: Optional[Callable[[Any], Awaitable[None]]], value: Any) -> None:
+        """Run a result callback without letting its errors stop the worker"""
+        if not callback:
+            return
+        try:
+            await callback(value)
+        except Exception as e:
+            logging.error(f"Error in job callback: {e}")
+    
+    def metrics(self) -> Dict[str, float]:
+        """Get queue depth, job counters and job latency percentiles"""
+        latencies = sorted(self._latencies)
+        
+        def percentile(p: float) -> float:
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+        
+        return {
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'running': self._running,
+            **self._counters,
+            'latency_p50': percentile(0.5),
+            'latency_p95': percentile(0.95),
+            'latency_max': latencies[-1] if latencies else 0.0
+        }
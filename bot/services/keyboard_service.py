@@ -3,12 +3,17 @@ from telebot import types
 class KeyboardService:
     """Service for creating Telegram keyboards"""
     
+    SET_PROMPT_BUTTON = "🎯 Установить промпт"
+    START_CHAT_BUTTON = "▶️ Начать диалог"
+    END_CHAT_BUTTON = "⏹ Завершить диалог"
+    MENU_BUTTONS = (SET_PROMPT_BUTTON, START_CHAT_BUTTON, END_CHAT_BUTTON)
+    
     @staticmethod
     def create_main_keyboard() -> types.ReplyKeyboardMarkup:
         """Create main menu keyboard"""
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        markup.row("🎯 Установить промпт")
-        markup.row("▶️ Начать диалог", "⏹ Завершить диалог")
+        markup.row(KeyboardService.SET_PROMPT_BUTTON)
+        markup.row(KeyboardService.START_CHAT_BUTTON, KeyboardService.END_CHAT_BUTTON)
         return markup
     
     @staticmethod
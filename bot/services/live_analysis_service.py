@@ -0,0 +1,138 @@
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Optional, Set
+
+from .llm_service import LLMService
+from .metrics_service import MetricsService
+
+class RunningAnalysis:
+    """Analysis of a dialog so far and the number of turns it covers"""
+    
+    __slots__ = ('text', 'turns', 'task')
+    
+    def __init__(self, text: str = "", turns: int = 0):
+        self.text = text
+        self.turns = turns
+        self.task: Optional[asyncio.Task] = None
+    
+    def to_state(self) -> Dict[str, Any]:
+        return {'text': self.text, 'turns': self.turns}
+    
+    @classmethod
+    def from_state(cls, state: Optional[Dict[str, Any]]) -> Optional['RunningAnalysis']:
+        return cls(state['text'], state['turns']) if state else None
+
+class LiveAnalysisService:
+    """Analyzes dialogs while they run, so the final analysis is ready when the user rates
+    
+    Every window exchanges the new turns are folded into the running analysis
+    of the conversation in the background, one update per conversation at a
+    time; turns that arrive during an update are folded in right after it.
+    Once a dialog ends its last turns are folded in while the user rates it.
+    Each update reads only the new turns and the analysis so far, so the
+    tokens of an update grow with new content instead of the whole transcript.
+    After each update the conversation is handed to saved, so the running
+    analysis is stored with it and survives restarts and cache evictions.
+    The live prompt is read with every update, so a reloaded one applies at once.
+    """
+    
+    def __init__(
+        self,
+        llm_service: LLMService,
+        live_prompt: Callable[[], str],
+        window: int = 2,
+        metrics: Optional[MetricsService] = None,
+        saved: Optional[Callable[[Dict[str, Any]], None]] = None
+    ):
+        self.llm_service = llm_service
+        self.live_prompt = live_prompt
+        self.window = window
+        self.saved = saved
+        self.metrics = metrics or MetricsService()
+        self._tasks: Set[asyncio.Task] = set()
+        self._counters = {'updates': 0, 'failed': 0, 'finished': 0, 'finished_instantly': 0}
+    
+    def observe(self, conversation: Dict[str, Any], analysis_prompt: str) -> None:
+        """Update the running analysis in the background once a window of new turns is complete
+        
+        For a dialog that has ended any new turn is enough.
+        """
+        analysis = conversation.get('analysis')
+        if analysis is None:
+            analysis = conversation['analysis'] = RunningAnalysis()
+        if analysis.task and not analysis.task.done():
+            return
+        window = self.window * 2 if conversation['active'] else 1
+        if len(conversation['memory'].turns) - analysis.turns < window:
+            return
+        
+        def updated(task: asyncio.Task) -> None:
+            self._tasks.discard(task)
+            # Catch up with the turns added meanwhile, a failed update waits for the next turn
+            if not task.cancelled() and task.result():
+                self.observe(conversation, analysis_prompt)
+        
+        analysis.task = asyncio.create_task(self._run_update(conversation, analysis, analysis_prompt))
+        self._tasks.add(analysis.task)
+        analysis.task.add_done_callback(updated)
+    
+    async def _update(self, conversation: Dict[str, Any], analysis: RunningAnalysis, analysis_prompt: str) -> None:
+        """Fold the turns after the covered ones into the running analysis"""
+        turns = conversation['memory'].turns
+        end = len(turns)
+        new_log = "\n".join(turn.render() for turn in turns[analysis.turns:end])
+        with self.metrics.span("live_analysis"):
+            text = await self.llm_service.aupdate_analysis(
+                self.live_prompt(),
+                analysis_prompt,
+                conversation['system_prompt'],
+                analysis.text,
+                new_log
+            )
+        # The conversation may have started over with a new prompt meanwhile
+        if conversation.get('analysis') is analysis:
+            analysis.text = text
+            analysis.turns = end
+            self._counters['updates'] += 1
+            if self.saved:
+                self.saved(conversation)
+    
+    async def _run_update(self, conversation: Dict[str, Any], analysis: RunningAnalysis, analysis_prompt: str) -> bool:
+        try:
+            await self._update(conversation, analysis, analysis_prompt)
+            return True
+        except Exception as e:
+            self._counters['failed'] += 1
+            logging.error(f"Error updating live analysis: {e}")
+            return False
+    
+    def prompt(self, analysis_prompt: str) -> str:
+        """Prompt the analyses are made with, the live prompt wrapping the analysis prompt"""
+        return self.live_prompt().replace("{task}", analysis_prompt)
+    
+    async def finish(self, conversation: Dict[str, Any], analysis_prompt: str) -> str:
+        """Final analysis of a dialog, analysis errors are raised"""
+        analysis = conversation.get('analysis')
+        if analysis is None:
+            analysis = conversation['analysis'] = RunningAnalysis()
+        if analysis.task and not analysis.task.done():
+            await asyncio.gather(analysis.task, return_exceptions=True)
+        
+        self._counters['finished'] += 1
+        if analysis.turns < len(conversation['memory'].turns) or not analysis.text:
+            # A second rating of the dialog waits for this update instead of repeating it
+            analysis.task = asyncio.ensure_future(self._update(conversation, analysis, analysis_prompt))
+            await analysis.task
+        else:
+            self._counters['finished_instantly'] += 1
+        return analysis.text
+    
+    async def close(self) -> None:
+        """Stop the running updates, their turns are read again at the end of the dialog"""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+    
+    def stats(self) -> Dict[str, int]:
+        """Get update and final analysis counters"""
+        return {**self._counters, 'running': len(self._tasks)}
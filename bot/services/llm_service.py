@@ -1,81 +1,387 @@
 import os
+import asyncio
 import logging
-from typing import Optional
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import SystemMessage
+import httpx
+from langchain_core.messages import SystemMessage, BaseMessage
+
+from .analysis_cache import AnalysisCache
+from .log_sink import prompt_hash
+
+# Provider SDKs take seconds to import, they are loaded with the first client of their provider
+if TYPE_CHECKING:
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+    from .provider_router import ProviderRouter
+
+PROVIDER_MODELS = {
+    "gpt": "gpt-4o",
+    "gemini": "gemini-pro",
+}
+
+OPENAI_BASE_URL = "https://api.openai.com/v1"
+
+# Chat chains kept for distinct system prompts
+MAX_CHAT_CHAINS = 256
 
 class LLMService:
     """Service for handling LLM operations"""
     
-    def __init__(self, llm_provider: str = "gpt"):
+    def __init__(
+        self,
+        llm_provider: str = "gpt",
+        analysis_provider: Optional[str] = None,
+        max_connections: int = 100,
+        keepalive_expiry: float = 120.0,
+        analysis_cache: Optional[AnalysisCache] = None,
+        routing: Optional[Dict[str, Any]] = None
+    ):
         self.llm_provider = llm_provider
+        self.analysis_provider = analysis_provider or llm_provider
+        self.analysis_cache = analysis_cache
+        # Settings of the provider router, without them calls go straight to one client
+        self.routing = routing
+        
+        # Long-lived clients keyed by (provider, model, temperature)
+        self._clients: Dict[Tuple[str, str, float], Any] = {}
+        self._clients_lock = threading.Lock()
+        
+        # Provider clients behind the router, prebuilt ones included
+        self._provider_clients: Dict[Tuple[str, str, float], Any] = {}
+        self._rate_limiters: Dict[str, Any] = {}
+        
+        # Chains keyed by (provider, prompt hash), shared by all conversations with that prompt
+        self._chains: OrderedDict[Tuple[str, str], Any] = OrderedDict()
+        
+        # Token usage reported by the provider, for the prompt cache hit rate
+        self._usage = {'calls': 0, 'input_tokens': 0, 'cached_input_tokens': 0}
+        self._usage_lock = threading.Lock()
+        
+        # One keep-alive connection pool shared by every OpenAI client
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self._http_client = httpx.Client(limits=limits)
+        self._http_async_client = httpx.AsyncClient(limits=limits)
+    
+    def create_llm(
+        self,
+        temperature: float = 0.7,
+        provider: Optional[str] = None
+    ) -> Optional['ChatOpenAI | ChatGoogleGenerativeAI']:
+        """Get the shared LLM client for a provider, creating it on first use"""
+        provider = provider or self.llm_provider
+        key = (provider, PROVIDER_MODELS.get(provider, ""), temperature)
+        
+        llm = self._clients.get(key)
+        if llm:
+            return llm
+        
+        with self._clients_lock:
+            llm = self._clients.get(key)
+            if not llm:
+                llm = self._provider_llm(provider, temperature)
+                if llm and self.routing:
+                    llm = self._build_router(provider, temperature, llm)
+                if llm:
+                    self._clients[key] = llm
+            return llm
+    
+    def _provider_llm(self, provider: str, temperature: float):
+        """Get the client of a single provider, building it if none was registered"""
+        key = (provider, PROVIDER_MODELS.get(provider, ""), temperature)
+        llm = self._provider_clients.get(key)
+        if not llm:
+            llm = self._build_llm(provider, temperature)
+            if llm:
+                self._provider_clients[key] = llm
+        return llm
+    
+    def _build_router(self, provider: str, temperature: float, llm) -> 'ProviderRouter':
+        """Put a provider client behind the router, with the fallback provider as second route"""
+        from .provider_router import ProviderRoute, ProviderRouter
+        
+        routes = [ProviderRoute(provider, llm, self._rate_limiter(provider))]
+        
+        fallback_provider = self.routing.get('fallback_provider')
+        if fallback_provider and fallback_provider != provider:
+            fallback_llm = self._provider_llm(fallback_provider, temperature)
+            if fallback_llm:
+                routes.append(ProviderRoute(fallback_provider, fallback_llm, self._rate_limiter(fallback_provider)))
+            else:
+                logging.error(f"Fallback provider {fallback_provider} is unavailable, {provider} calls have no fallback")
+        
+        return ProviderRouter(
+            routes=routes,
+            model_name=getattr(llm, 'model_name', None) or getattr(llm, 'model', ''),
+            timeout=self.routing.get('timeout') or 60,
+            max_retries=self.routing.get('max_retries', 2),
+            hedge_percentile=self.routing.get('hedge_percentile') or None,
+            hedge_min_samples=self.routing.get('hedge_min_samples') or 20
+        )
     
-    def create_llm(self, temperature: float = 0.7) -> Optional[ChatOpenAI | ChatGoogleGenerativeAI]:
-        """Create LLM instance based on provider"""
+    def _rate_limiter(self, provider: str):
+        """Token bucket of a provider, shared by all of its clients"""
+        if provider not in self._rate_limiters:
+            from .provider_router import create_rate_limiter
+            limits = self.routing.get('requests_per_minute') or {}
+            self._rate_limiters[provider] = create_rate_limiter(limits.get(provider))
+        return self._rate_limiters[provider]
+    
+    def register_llm(
+        self,
+        llm,
+        temperature: float = 0.7,
+        provider: Optional[str] = None
+    ) -> None:
+        """Use a prebuilt client for a provider, e.g. a local fake model in benchmarks"""
+        provider = provider or self.llm_provider
+        with self._clients_lock:
+            self._provider_clients[(provider, PROVIDER_MODELS.get(provider, ""), temperature)] = llm
+            # Routers and chains built over the previous client must not be reused
+            self._clients.clear()
+            self._chains.clear()
+    
+    def _build_llm(self, provider: str, temperature: float) -> Optional['ChatOpenAI | ChatGoogleGenerativeAI']:
+        """Build a new LLM client for a provider, None if it cannot be built"""
         try:
-            if self.llm_provider == "gemini":
-                try:
-                    return ChatGoogleGenerativeAI(
-                        model="gemini-pro",
-                        temperature=temperature,
-                        google_api_key=os.getenv('GOOGLE_API_KEY')
-                    )
-                except Exception as gemini_error:
-                    logging.warning(f"Gemini initialization failed: {gemini_error}")
-                    return self._create_openai_llm(temperature)
-            elif self.llm_provider == "gpt":
+            if provider == "gemini":
+                from langchain_google_genai import ChatGoogleGenerativeAI
+                return ChatGoogleGenerativeAI(
+                    model=PROVIDER_MODELS["gemini"],
+                    temperature=temperature,
+                    google_api_key=os.getenv('GOOGLE_API_KEY'),
+                    **self._client_retry_settings()
+                )
+            elif provider == "gpt":
                 return self._create_openai_llm(temperature)
             else:
-                logging.error(f"Unknown LLM provider: {self.llm_provider}")
-                return self._create_openai_llm(temperature)
+                logging.error(f"Unknown LLM provider: {provider}")
+                return None
         except Exception as e:
-            logging.error(f"Error creating LLM: {e}")
+            # Another provider's client would be called under this provider's name
+            logging.error(f"Error creating {provider} LLM: {e}")
             return None
 
-    def _create_openai_llm(self, temperature: float) -> ChatOpenAI:
-        """Create OpenAI LLM instance"""
+    def _create_openai_llm(self, temperature: float) -> 'ChatOpenAI':
+        """Create OpenAI LLM instance on the shared connection pool"""
+        from langchain_openai import ChatOpenAI
+        
         return ChatOpenAI(
-            model="gpt-4o",
+            model=PROVIDER_MODELS["gpt"],
             temperature=temperature,
-            openai_api_key=os.getenv('OPENAI_API_KEY')
+            openai_api_key=os.getenv('OPENAI_API_KEY'),
+            # Report token usage in streamed replies as well
+            stream_usage=True,
+            **self._client_retry_settings(),
+            http_client=self._http_client,
+            http_async_client=self._http_async_client
         )
 
-    def create_chat_chain(self, system_prompt: str):
-        """Create a LangChain chat chain with system prompt"""
-        llm = self.create_llm()
+    def _client_retry_settings(self) -> Dict[str, Any]:
+        """The router retries across providers, clients behind it must fail fast"""
+        return {'max_retries': 0} if self.routing else {}
+
+    async def warm_up(self) -> None:
+        """Create the default clients and open a pooled connection ahead of the first reply"""
+        # Creating the first clients imports the provider SDKs, which would stall the event loop
+        await asyncio.to_thread(self._create_default_clients)
+        
+        if "gpt" in (self.llm_provider, self.analysis_provider):
+            try:
+                # Any response will do, the point is the TLS handshake
+                await self._http_async_client.head(OPENAI_BASE_URL)
+            except Exception as e:
+                logging.warning(f"LLM connection warm-up failed: {e}")
+
+    def _create_default_clients(self) -> None:
+        """Create the chat and analysis clients"""
+        self.create_llm()
+        self.create_llm(temperature=0.2, provider=self.analysis_provider)
+    
+    def create_embeddings(self, model: str = "text-embedding-3-small") -> Optional['OpenAIEmbeddings']:
+        """Create an OpenAI embeddings client on the shared connection pool"""
+        try:
+            from langchain_openai import OpenAIEmbeddings
+            return OpenAIEmbeddings(
+                model=model,
+                openai_api_key=os.getenv('OPENAI_API_KEY'),
+                http_client=self._http_client,
+                http_async_client=self._http_async_client
+            )
+        except Exception as e:
+            logging.error(f"Error creating embeddings: {e}")
+            return None
+
+    async def aclose(self) -> None:
+        """Close the shared connection pools"""
+        self._http_client.close()
+        await self._http_async_client.aclose()
+
+    def create_chat_chain(self, system_prompt: str, provider: Optional[str] = None):
+        """Get the LangChain chat chain for a system prompt over the shared client
+        
+        The template owns the system prompt and the incoming user message,
+        chat_history must only contain earlier turns. Every conversation with
+        the same prompt shares one chain, so requests start with a byte-identical
+        prefix that the provider can serve from its prompt cache.
+        """
+        provider = provider or self.llm_provider
+        key = (provider, prompt_hash(system_prompt))
+        with self._clients_lock:
+            chain = self._chains.get(key)
+            if chain:
+                self._chains.move_to_end(key)
+                return chain
+        
+        llm = self.create_llm(provider=provider)
         if not llm:
             return None
         
         try:
+            from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+            
+            llm = self._with_prompt_cache_key(llm, f"system-prompt-{key[1]}")
+            
             prompt = ChatPromptTemplate.from_messages([
                 SystemMessage(content=system_prompt),
                 MessagesPlaceholder(variable_name="chat_history"),
                 ("human", "{input}")
             ])
-            
-            return prompt | llm
+            chain = prompt | llm
         except Exception as e:
             logging.error(f"Error creating chat chain: {e}")
             return None
+        
+        with self._clients_lock:
+            self._chains[key] = chain
+            while len(self._chains) > MAX_CHAT_CHAINS:
+                self._chains.popitem(last=False)
+        return chain
+    
+    @classmethod
+    def _with_prompt_cache_key(cls, llm, cache_key: str):
+        """Bind a prompt cache key to OpenAI clients, directly or behind the router"""
+        from langchain_openai import ChatOpenAI
+        from .provider_router import ProviderRouter
+        
+        if isinstance(llm, ProviderRouter):
+            return llm.map_routes(lambda name, route_llm: cls._with_prompt_cache_key(route_llm, cache_key))
+        if isinstance(llm, ChatOpenAI):
+            # Requests with the same key are routed to the same prompt cache, the argument
+            # needs openai 1.98 or later, older SDKs reject it on every call
+            return llm.bind(prompt_cache_key=cache_key)
+        return llm
+    
+    def record_usage(self, usage: Optional[Dict[str, Any]]) -> None:
+        """Add the token usage of a response to the prompt cache statistics"""
+        if not usage:
+            return
+        details = usage.get('input_token_details') or {}
+        with self._usage_lock:
+            self._usage['calls'] += 1
+            self._usage['input_tokens'] += usage.get('input_tokens', 0)
+            self._usage['cached_input_tokens'] += details.get('cache_read', 0) or 0
+    
+    def prompt_cache_stats(self) -> Dict[str, float]:
+        """Get input token totals and the share of them served from the provider prompt cache"""
+        with self._usage_lock:
+            stats = dict(self._usage)
+        stats['hit_rate'] = stats['cached_input_tokens'] / stats['input_tokens'] if stats['input_tokens'] else 0.0
+        return stats
 
-    def analyze_conversation(self, conversation_log: str, system_prompt: str, analysis_prompt: str) -> str:
-        """Analyze conversation naturalness"""
-        try:
-            # Use lower temperature for analysis
-            llm = self.create_llm(temperature=0.2)
-            if not llm:
-                return "Unable to analyze conversation"
-            
-            formatted_prompt = analysis_prompt.format(
-                conversation_log=conversation_log,
-                system_prompt=system_prompt
-            )
-            
-            response = llm.invoke(formatted_prompt)
+    @staticmethod
+    def build_chain_input(chat_history: List[BaseMessage], user_input: str) -> Dict[str, Any]:
+        """Build the input of a chat chain from earlier turns and the new user message"""
+        return {
+            "chat_history": chat_history,
+            "input": user_input
+        }
+
+    async def aanalyze_conversation(self, conversation_log: str, system_prompt: str, analysis_prompt: str) -> str:
+        """Analyze conversation naturalness without blocking the event loop
+        
+        Errors are raised instead of being swallowed so callers can retry.
+        """
+        llm = self.create_llm(temperature=0.2, provider=self.analysis_provider)
+        if not llm:
+            raise RuntimeError("Unable to create LLM for analysis")
+        
+        async def analyze() -> str:
+            formatted_prompt = self._format_analysis_prompt(conversation_log, system_prompt, analysis_prompt)
+            response = await llm.ainvoke(formatted_prompt)
+            self.record_usage(response.usage_metadata)
             return response.content
-        except Exception as e:
-            logging.error(f"Error analyzing conversation: {e}")
-            return "Unable to analyze conversation" 
\ No newline at end of file
+        
+        if not self.analysis_cache:
+            return await analyze()
+        
+        key = self._analysis_key(llm, conversation_log, system_prompt, analysis_prompt)
+        return await self.analysis_cache.get_or_compute(key, analyze)
+
+    async def aupdate_analysis(
+        self,
+        live_prompt: str,
+        analysis_prompt: str,
+        system_prompt: str,
+        previous_analysis: str,
+        new_log: str
+    ) -> str:
+        """Fold the new part of a running conversation into its analysis so far"""
+        llm = self.create_llm(temperature=0.2, provider=self.analysis_provider)
+        if not llm:
+            raise RuntimeError("Unable to create LLM for analysis")
+
+        formatted_prompt = live_prompt.format(
+            analysis=previous_analysis or "-",
+            # The analysis task sees only the messages added since the last update
+            task=self._format_analysis_prompt(new_log, system_prompt, analysis_prompt)
+        )
+        response = await llm.ainvoke(formatted_prompt)
+        self.record_usage(response.usage_metadata)
+        return response.content
+
+    async def asummarize_history(
+        self,
+        summary_prompt: str,
+        previous_summary: str,
+        messages: List[BaseMessage]
+    ) -> str:
+        """Fold new dialog messages into a running conversation summary"""
+        llm = self.create_llm(temperature=0.2)
+        if not llm:
+            raise RuntimeError("Unable to create LLM for summarization")
+        
+        formatted_prompt = summary_prompt.format(
+            summary=previous_summary or "-",
+            conversation_log="\n".join(f"{msg.type.upper()}: {msg.content}" for msg in messages)
+        )
+        response = await llm.ainvoke(formatted_prompt)
+        self.record_usage(response.usage_metadata)
+        return response.content
+
+    def analysis_key(self, conversation_log: str, system_prompt: str, analysis_prompt: str) -> Optional[str]:
+        """Cache key of an analysis made by the current analysis model"""
+        llm = self.create_llm(temperature=0.2, provider=self.analysis_provider)
+        if not llm:
+            return None
+        return self._analysis_key(llm, conversation_log, system_prompt, analysis_prompt)
+
+    @staticmethod
+    def _analysis_key(llm, conversation_log: str, system_prompt: str, analysis_prompt: str) -> str:
+        """Cache key of an analysis made by a specific model"""
+        model = getattr(llm, 'model_name', None) or getattr(llm, 'model', '')
+        return AnalysisCache.make_key(conversation_log, system_prompt, analysis_prompt, model)
+
+    @staticmethod
+    def _format_analysis_prompt(conversation_log: str, system_prompt: str, analysis_prompt: str) -> str:
+        """Fill the analysis prompt template"""
+        return analysis_prompt.format(
+            conversation_log=conversation_log,
+            system_prompt=system_prompt
+        ) 
\ No newline at end of file
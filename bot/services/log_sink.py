@@ -0,0 +1,283 @@
+import os
+import csv
+import time
+import queue
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+from .metrics_service import MetricsService
+from .search_index import DialogSearchIndex
+
+SCHEMA_VERSION = 2
+
+CSV_COLUMNS = [
+    'Schema Version', 'Timestamp', 'User ID', 'User UUID',
+    'Prompt Hash', 'System Prompt',
+    'Dialog Rating', 'Naturalness Rating',
+    'Analysis Prompt Hash', 'Analysis Result', 'Conversation Log'
+]
+
+FSYNC_POLICIES = ('always', 'batch', 'never')
+
+def prompt_hash(prompt: Optional[str]) -> str:
+    """Short stable hash identifying a prompt text"""
+    if not prompt:
+        return ""
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]
+
+class ConversationLogSink:
+    """Single append-only writer for the conversation CSV
+    
+    Rows are queued by any thread and written in batches by one writer
+    thread, so handlers never touch the file directly. The fsync policy
+    trades durability for throughput: 'always' syncs every row, 'batch'
+    every batch and 'never' leaves it to the OS. With a search index the
+    same thread adds each written batch to it.
+    """
+    
+    def __init__(
+        self,
+        csv_path: str,
+        batch_size: int = 50,
+        flush_interval: float = 1.0,
+        fsync_policy: str = 'batch',
+        metrics: Optional[MetricsService] = None,
+        search_index: Optional[DialogSearchIndex] = None
+    ):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync_policy}")
+        
+        self.csv_path = csv_path
+        self.batch_size = 1 if fsync_policy == 'always' else batch_size
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync_policy
+        self.metrics = metrics
+        self.search_index = search_index
+        
+        self._queue: queue.Queue = queue.Queue()
+        self._file = self._open()
+        self._writer = csv.writer(self._file)
+        self._thread = threading.Thread(target=self._run, name="conversation-log-sink", daemon=True)
+        self._thread.start()
+    
+    def _open(self):
+        """Open the CSV for appending, rotating away a file with another schema"""
+        if os.path.exists(self.csv_path):
+            with open(self.csv_path, 'r', newline='', encoding='utf-8') as csvfile:
+                header = next(csv.reader(csvfile), None)
+            if header and header != CSV_COLUMNS:
+                rotated_path = self._rotated_path(header)
+                os.replace(self.csv_path, rotated_path)
+                logging.warning(f"Conversation log schema changed, old log moved to {rotated_path}")
+        
+        is_new = not os.path.exists(self.csv_path) or os.path.getsize(self.csv_path) == 0
+        csvfile = open(self.csv_path, 'a', newline='', encoding='utf-8')
+        if is_new:
+            csv.writer(csvfile).writerow(CSV_COLUMNS)
+            csvfile.flush()
+        return csvfile
+    
+    def _rotated_path(self, header: List[str]) -> str:
+        """Path for a log file written with an older schema"""
+        stem, ext = os.path.splitext(self.csv_path)
+        version = 'v1' if header[0] != 'Schema Version' else 'old'
+        rotated_path = f"{stem}.{version}{ext}"
+        if os.path.exists(rotated_path):
+            rotated_path = f"{stem}.{version}.{int(time.time())}{ext}"
+        return rotated_path
+    
+    def write(self, row: Dict[str, Any]) -> None:
+        """Queue a row, keyed by column name, for writing"""
+        self._queue.put([row.get(column, "") for column in CSV_COLUMNS])
+    
+    def _run(self) -> None:
+        """Writer thread: collect rows into batches and append them"""
+        closing = False
+        while not closing:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+            
+            if batch:
+                self._write_batch(batch)
+    
+    def _write_batch(self, batch: List[list]) -> None:
+        """Append a batch of rows and apply the fsync policy"""
+        started_at = time.perf_counter()
+        try:
+            self._writer.writerows(batch)
+            self._file.flush()
+            if self.fsync_policy != 'never':
+                os.fsync(self._file.fileno())
+        except Exception as e:
+            logging.error(f"Error writing conversation log batch: {e}")
+        
+        if self.metrics:
+            self.metrics.record("csv_write", time.perf_counter() - started_at)
+            self.metrics.observe("csv_batch_rows", len(batch))
+        
+        if self.search_index:
+            started_at = time.perf_counter()
+            try:
+                self.search_index.add_rows(dict(zip(CSV_COLUMNS, row)) for row in batch)
+            except Exception as e:
+                logging.error(f"Error indexing conversation log batch: {e}")
+            if self.metrics:
+                self.metrics.record("search_index_write", time.perf_counter() - started_at)
+    
+    def close(self) -> None:
+        """Write all queued rows and close the file"""
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+def build_row(
+    user_id: int,
+    conversation: Dict[str, Any],
+    conversation_log: str,
+    analysis_result: str,
+    analysis_prompt: Optional[str] = None
+) -> Dict[str, Any]:
+    """Build a log row of the current schema from a conversation"""
+    rating = conversation.get('rating')
+    return {
+        'Schema Version': SCHEMA_VERSION,
+        'Timestamp': datetime.now().isoformat(),
+        'User ID': user_id,
+        'User UUID': conversation['user_uuid'],
+        'Prompt Hash': prompt_hash(conversation['system_prompt']),
+        'System Prompt': conversation['system_prompt'],
+        'Dialog Rating': "" if rating is None else ('Successful' if rating else 'Unsuccessful'),
+        'Naturalness Rating': conversation.get('naturalness_rating') or "",
+        'Analysis Prompt Hash': prompt_hash(analysis_prompt),
+        'Analysis Result': analysis_result,
+        'Conversation Log': conversation_log
+    }
+
+# Dialog ratings of pre-versioned logs, which were written in Russian
+LEGACY_RATINGS = {
+    'Successful': 'Successful', 'Unsuccessful': 'Unsuccessful',
+    'Успешно': 'Successful', 'Неуспешно': 'Unsuccessful'
+}
+
+def _legacy_row(values: List[str]) -> Dict[str, str]:
+    """Map a row of a pre-versioned log by position, its header does not describe its rows
+    
+    Rows start with the timestamp, user id, uuid and system prompt and end
+    with the conversation log. In between come the dialog rating, if any,
+    the naturalness rating, if any, and the analysis in one or more columns.
+    """
+    row = dict.fromkeys(CSV_COLUMNS, "")
+    row.update(zip(['Timestamp', 'User ID', 'User UUID', 'System Prompt'], values[:4]))
+    row['Conversation Log'] = values[-1] if len(values) > 4 else ""
+    
+    middle = values[4:-1]
+    if middle and middle[0] in LEGACY_RATINGS:
+        row['Dialog Rating'] = LEGACY_RATINGS[middle.pop(0)]
+    if len(middle) > 1 or (middle and middle[0].strip().isdigit()):
+        row['Naturalness Rating'] = middle.pop(0)
+    row['Analysis Result'] = "\n".join(part for part in middle if part)
+    return row
+
+def read_rows(csv_path: str) -> Iterator[Dict[str, str]]:
+    """Stream log rows of any schema version as dicts of the current columns"""
+    csv.field_size_limit(1 << 30)
+    with open(csv_path, 'r', newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, None)
+        if not header:
+            return
+        versioned = header[0] == 'Schema Version'
+        for values in reader:
+            if not values:
+                continue
+            if versioned:
+                row = dict(zip(header, values))
+                row = {column: row.get(column) or "" for column in CSV_COLUMNS}
+            else:
+                row = _legacy_row(values)
+            system_prompt = row['System Prompt']
+            yield {
+                **row,
+                'Schema Version': row['Schema Version'] or "1",
+                'Prompt Hash': row['Prompt Hash'] or prompt_hash(system_prompt)
+            }
+
+def export_parquet(csv_paths: List[str], out_dir: str, chunk_size: int = 10000) -> Dict[str, int]:
+    """Export conversation logs to Parquet, storing each distinct system prompt once
+    
+    Writes dialogs.parquet with a prompt_hash column and prompts.parquet
+    mapping prompt_hash to the prompt text. Requires pyarrow.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Parquet export requires pyarrow: pip install pyarrow") from e
+    
+    os.makedirs(out_dir, exist_ok=True)
+    dialog_schema = pa.schema([
+        ('schema_version', pa.int16()),
+        ('timestamp', pa.string()),
+        ('user_id', pa.int64()),
+        ('user_uuid', pa.string()),
+        ('prompt_hash', pa.string()),
+        ('dialog_rating', pa.string()),
+        ('naturalness_rating', pa.int16()),
+        ('analysis_prompt_hash', pa.string()),
+        ('analysis_result', pa.string()),
+        ('conversation_log', pa.string()),
+    ])
+    
+    def to_int(value: str) -> Optional[int]:
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    
+    prompts: Dict[str, str] = {}
+    dialogs = 0
+    writer = pq.ParquetWriter(os.path.join(out_dir, 'dialogs.parquet'), dialog_schema, compression='zstd')
+    try:
+        chunk: Dict[str, list] = {name: [] for name in dialog_schema.names}
+        for csv_path in csv_paths:
+            for row in read_rows(csv_path):
+                prompts.setdefault(row['Prompt Hash'], row['System Prompt'])
+                chunk['schema_version'].append(to_int(row['Schema Version']))
+                chunk['timestamp'].append(row['Timestamp'])
+                chunk['user_id'].append(to_int(row['User ID']))
+                chunk['user_uuid'].append(row['User UUID'])
+                chunk['prompt_hash'].append(row['Prompt Hash'])
+                chunk['dialog_rating'].append(row['Dialog Rating'])
+                chunk['naturalness_rating'].append(to_int(row['Naturalness Rating']))
+                chunk['analysis_prompt_hash'].append(row['Analysis Prompt Hash'])
+                chunk['analysis_result'].append(row['Analysis Result'])
+                chunk['conversation_log'].append(row['Conversation Log'])
+                dialogs += 1
+                
+                if len(chunk['timestamp']) >= chunk_size:
+                    writer.write_table(pa.table(chunk, schema=dialog_schema))
+                    chunk = {name: [] for name in dialog_schema.names}
+        
+        if chunk['timestamp']:
+            writer.write_table(pa.table(chunk, schema=dialog_schema))
+    finally:
+        writer.close()
+    
+    pq.write_table(
+        pa.table({'prompt_hash': list(prompts.keys()), 'system_prompt': list(prompts.values())}),
+        os.path.join(out_dir, 'prompts.parquet'),
+        compression='zstd'
+    )
+    return {'dialogs': dialogs, 'prompts': len(prompts)}
@@ -1,97 +1,109 @@
 import os
-import csv
-from datetime import datetime
 from typing import Dict, Any, Optional
 
 from .llm_service import LLMService
+from .log_sink import ConversationLogSink, build_row
+from .metrics_service import MetricsService
+from .experiment_service import ExperimentService
+from .live_analysis_service import LiveAnalysisService
+from .search_index import DialogSearchIndex
 
 class LoggingService:
     """Service for handling conversation logging"""
     
-    def __init__(self, llm_service: LLMService, log_dir: str = 'logs/llm_experiments'):
+    def __init__(
+        self,
+        llm_service: LLMService,
+        log_dir: str = 'logs/llm_experiments',
+        batch_size: int = 50,
+        flush_interval: float = 1.0,
+        fsync_policy: str = 'batch',
+        metrics: Optional[MetricsService] = None,
+        experiments: Optional[ExperimentService] = None,
+        live_analysis: Optional[LiveAnalysisService] = None,
+        search_index: Optional[DialogSearchIndex] = None
+    ):
         self.llm_service = llm_service
+        self.live_analysis = live_analysis
+        self.metrics = metrics or MetricsService()
+        self.experiments = experiments
         self.log_dir = log_dir
         self.csv_path = f'{log_dir}/conversations.csv'
         self._ensure_log_directory()
+        self.sink = ConversationLogSink(
+            self.csv_path,
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            fsync_policy=fsync_policy,
+            metrics=self.metrics,
+            search_index=search_index
+        )
     
     def _ensure_log_directory(self) -> None:
         """Ensure log directory exists"""
         os.makedirs(self.log_dir, exist_ok=True)
     
-    def log_conversation(
+    async def alog_conversation(
         self,
         user_id: int,
         conversation: Dict[str, Any],
         analysis_prompt: str
     ) -> Optional[str]:
-        """Log conversation details to CSV and return analysis result"""
+        """Log conversation details to CSV and return the analysis result, analysis errors are raised"""
         if not conversation:
             return None
         
-        # Get conversation log
-        conversation_log = conversation['memory'].format_conversation_log()
-        
-        # Get analysis result
-        analysis_result = self.llm_service.analyze_conversation(
-            conversation_log=conversation_log,
-            system_prompt=conversation['system_prompt'],
-            analysis_prompt=analysis_prompt
-        )
-        
-        # Write to CSV
+        with self.metrics.span("analysis"):
+            if self.live_analysis:
+                # Only the turns since the last background update are analyzed now
+                analysis_result = await self.live_analysis.finish(conversation, analysis_prompt)
+                # The log tells live analyses apart from ones made with the analysis prompt alone
+                analysis_prompt = self.live_analysis.prompt(analysis_prompt)
+            else:
+                analysis_result = await self.llm_service.aanalyze_conversation(
+                    conversation_log=conversation['memory'].format_conversation_log(),
+                    system_prompt=conversation['system_prompt'],
+                    analysis_prompt=analysis_prompt
+                )
+        await self.awrite_conversation(user_id, conversation, analysis_result, analysis_prompt)
+        return analysis_result
+    
+    async def awrite_conversation(
+        self,
+        user_id: int,
+        conversation: Dict[str, Any],
+        analysis_result: str,
+        analysis_prompt: Optional[str] = None
+    ) -> None:
+        """Write conversation details to CSV without blocking the event loop"""
+        # The sink only queues the row, its own thread does the file I/O
         self._write_to_csv(
             user_id=user_id,
             conversation=conversation,
-            conversation_log=conversation_log,
-            analysis_result=analysis_result
+            conversation_log=conversation['memory'].format_conversation_log(),
+            analysis_result=analysis_result,
+            analysis_prompt=analysis_prompt
         )
-        
-        return analysis_result
     
     def _write_to_csv(
         self,
         user_id: int,
         conversation: Dict[str, Any],
         conversation_log: str,
-        analysis_result: str
+        analysis_result: str,
+        analysis_prompt: Optional[str] = None
     ) -> None:
-        """Write conversation details to CSV file"""
-        csv_exists = os.path.exists(self.csv_path)
-        
-        with open(self.csv_path, 'a', newline='', encoding='utf-8') as csvfile:
-            csv_writer = csv.writer(csvfile)
-            
-            if not csv_exists:
-                csv_writer.writerow([
-                    'Timestamp', 'User ID', 'User UUID',
-                    'System Prompt',
-                    'Naturalness Rating', 'Analysis Result', 'Conversation Log'
-                ])
-            
-            csv_writer.writerow([
-                datetime.now().isoformat(),
-                user_id,
-                conversation['user_uuid'],
-                conversation['system_prompt'],
-                conversation['naturalness_rating'],
-                analysis_result,
-                conversation_log
-            ])
+        """Queue conversation details for the CSV log and count the dialog in its experiment"""
+        self.sink.write(build_row(
+            user_id=user_id,
+            conversation=conversation,
+            conversation_log=conversation_log,
+            analysis_result=analysis_result,
+            analysis_prompt=analysis_prompt
+        ))
+        if self.experiments:
+            self.experiments.record(conversation)
     
-    def log_conversation_to_file(
-        self,
-        user_id: int,
-        conversation: Dict[str, Any]
-    ) -> None:
-        """Log conversation details to a text file"""
-        if not conversation:
-            return
-        
-        log_filename = f"{self.log_dir}/conversation_{user_id}_{int(datetime.now().timestamp())}.log"
-        
-        with open(log_filename, 'w', encoding='utf-8') as f:
-            f.write(f"User ID: {user_id}\n")
-            f.write(f"System Prompt: {conversation['system_prompt']}\n")
-            f.write(f"Rating: {'Успешно' if conversation['rating'] else 'Неуспешно'}\n\n")
-            f.write("Conversation Log:\n")
-            f.write(conversation['memory'].format_conversation_log()) 
\ No newline at end of file
+    def close(self) -> None:
+        """Flush queued log rows and close the log file"""
+        self.sink.close()
@@ -1,42 +1,213 @@
-from typing import List
-from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, BaseMessage
+import time
+import asyncio
+import logging
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from langchain_core.messages import HumanMessage, AIMessage, BaseMessage
+
+# Takes the previous summary and the newly folded messages, returns the new summary
+Summarizer = Callable[[str, List[BaseMessage]], Awaitable[str]]
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """Load the tiktoken encoding once, if tiktoken is installed"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+def count_tokens(text: str) -> int:
+    """Count tokens in a text, estimating when tiktoken is unavailable"""
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text))
+    # Rough estimate for mixed Russian/English text
+    return max(1, len(text) // 3)
+
+def parse_conversation_log(conversation_log: str) -> List[Tuple[str, str]]:
+    """Split a log made by format_conversation_log back into (role, text) turns"""
+    turns: List[Tuple[str, str]] = []
+    for line in conversation_log.splitlines():
+        role, separator, text = line.partition(': ')
+        if separator and role in ('HUMAN', 'AI', 'SYSTEM'):
+            turns.append((role.lower(), text))
+        elif turns:
+            # Messages may span several lines
+            turns[-1] = (turns[-1][0], f"{turns[-1][1]}\n{line}")
+    return turns
+
+class Turn:
+    """One dialog message, kept compact for thousands of resident conversations"""
+    
+    __slots__ = ('role', 'text', 'timestamp', 'tokens')
+    
+    def __init__(self, role: str, text: str, timestamp: Optional[float] = None, tokens: Optional[int] = None):
+        self.role = role
+        self.text = text
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.tokens = count_tokens(text) if tokens is None else tokens
+    
+    def to_message(self) -> BaseMessage:
+        """Materialize the LangChain message for a chain call"""
+        return HumanMessage(content=self.text) if self.role == 'human' else AIMessage(content=self.text)
+    
+    def render(self) -> str:
+        """Line of the turn in the conversation log"""
+        return f"{self.role.upper()}: {self.text}"
 
 class TelegramChatMemory:
-    """Service for managing Telegram chat memory and conversation state"""
+    """Service for managing Telegram chat memory and conversation state
     
-    def __init__(self, user_id: int, system_prompt: str = None):
+    Memory only holds completed dialog turns. The system prompt and the
+    incoming user message belong to the chat prompt template. Turns are
+    stored as compact Turn objects and become LangChain messages only when
+    they are sent to a chain.
+    """
+    
+    def __init__(
+        self,
+        user_id: int,
+        token_budget: Optional[int] = None,
+        keep_last_turns: int = 6,
+        summarizer: Optional[Summarizer] = None
+    ):
         self.user_id = user_id
-        self.messages: List[BaseMessage] = []
+        self.turns: List[Turn] = []
+        
+        # Summary mode: older turns are folded into a running summary
+        self.token_budget = token_budget
+        self.keep_last_turns = keep_last_turns
+        self.summarizer = summarizer
+        self.summary = ""
+        self._context_start = 0
+        self._context_tokens = 0
+        self._summary_task: Optional[asyncio.Task] = None
         
-        if system_prompt:
-            self.add_system_message(system_prompt)
+        # Rendered conversation log and the number of turns it covers
+        self._log = ""
+        self._logged_turns = 0
+        # Turns already handed to the conversation store
+        self._saved_turns = 0
     
     def add_user_message(self, message: str) -> None:
         """Add a user message to the conversation history"""
-        self.messages.append(HumanMessage(content=message))
+        self._append(Turn('human', message))
     
     def add_ai_message(self, message: str) -> None:
         """Add an AI message to the conversation history"""
-        self.messages.append(AIMessage(content=message))
+        self._append(Turn('ai', message))
+    
+    def _append(self, turn: Turn) -> None:
+        """Append a dialog turn and keep the token budget in check"""
+        self.turns.append(turn)
+        self._context_tokens += turn.tokens
+        
+        if self.token_budget and self._context_tokens > self.token_budget:
+            self._schedule_summary()
+    
+    def add_exchange(self, user_message: str, ai_message: str) -> None:
+        """Add a completed user/AI turn to the conversation history"""
+        self.add_user_message(user_message)
+        self.add_ai_message(ai_message)
     
-    def add_system_message(self, message: str) -> None:
-        """Add or update the system message"""
-        # Remove any existing system messages first
-        self.messages = [msg for msg in self.messages if not isinstance(msg, SystemMessage)]
-        self.messages.insert(0, SystemMessage(content=message))
+    @property
+    def context_tokens(self) -> int:
+        """Tokens of the dialog messages currently sent verbatim"""
+        return self._context_tokens
+    
+    @property
+    def dialog_tokens(self) -> int:
+        """Tokens of the whole dialog, including summarized turns"""
+        return sum(turn.tokens for turn in self.turns)
     
     def get_messages(self) -> List[BaseMessage]:
-        """Get all messages in the conversation history"""
-        return self.messages
+        """Get the dialog history to send to the LLM as chat_history"""
+        messages = [turn.to_message() for turn in self.turns[self._context_start:]]
+        if not self.summary:
+            return messages
+        
+        # Providers like Gemini take one system message, first, so the summary opens the first user turn
+        summary = f"Summary of the earlier conversation:\n{self.summary}"
+        if messages and isinstance(messages[0], HumanMessage):
+            return [HumanMessage(content=f"{summary}\n\n{messages[0].content}")] + messages[1:]
+        return [HumanMessage(content=summary)] + messages
+    
+    def _schedule_summary(self) -> None:
+        """Fold turns beyond the verbatim window into the summary in the background"""
+        if not self.summarizer or (self._summary_task and not self._summary_task.done()):
+            return
+        
+        fold_end = len(self.turns) - self.keep_last_turns * 2
+        if fold_end <= self._context_start:
+            return
+        
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._summary_task = loop.create_task(self._fold(fold_end))
+    
+    async def _fold(self, fold_end: int) -> None:
+        """Summarize turns up to fold_end and drop them from the context window"""
+        fold_start = self._context_start
+        folded = self.turns[fold_start:fold_end]
+        
+        try:
+            summary = await self.summarizer(self.summary, [turn.to_message() for turn in folded])
+        except Exception as e:
+            logging.error(f"Error summarizing chat memory for {self.user_id}: {e}")
+            return
+        
+        # The memory may have been cleared while the summary was being generated
+        if self._context_start != fold_start or fold_end > len(self.turns):
+            return
+        
+        self.summary = summary
+        self._context_tokens -= sum(turn.tokens for turn in folded)
+        self._context_start = fold_end
     
     def clear(self) -> None:
-        """Clear all messages except system message"""
-        system_messages = [msg for msg in self.messages if isinstance(msg, SystemMessage)]
-        self.messages = system_messages
+        """Clear all messages and the running summary"""
+        self.turns = []
+        self.summary = ""
+        self._context_start = 0
+        self._context_tokens = 0
+        self._log = ""
+        self._logged_turns = 0
+        self._saved_turns = 0
+    
+    def to_state(self, first_turn: int = 0) -> Dict[str, Any]:
+        """Serialize the memory into a compact JSON-friendly dict, with the turns from first_turn on"""
+        return {
+            'messages': [[turn.role, turn.text, turn.timestamp, turn.tokens] for turn in self.turns[first_turn:]],
+            'first_turn': first_turn,
+            'summary': self.summary,
+            'context_start': self._context_start
+        }
+    
+    def unsaved_state(self) -> Dict[str, Any]:
+        """Serialize the memory with only the turns added since the last call, for the conversation store"""
+        state = self.to_state(self._saved_turns)
+        self._saved_turns = len(self.turns)
+        return state
+    
+    def load_state(self, state: Dict[str, Any]) -> None:
+        """Restore the memory from a dict made by to_state"""
+        self.clear()
+        for role, text, *details in state.get('messages', []):
+            # States saved before timestamps and token counts have only role and text
+            self.turns.append(Turn(role, text, *details))
+        
+        self.summary = state.get('summary', "")
+        self._context_start = state.get('context_start', 0)
+        self._context_tokens = sum(turn.tokens for turn in self.turns[self._context_start:])
+        self._saved_turns = len(self.turns)
     
     def format_conversation_log(self) -> str:
-        """Format the conversation history for logging"""
-        return "\n".join([
-            f"{msg.type.upper()}: {msg.content}" 
-            for msg in self.messages
-        ]) 
\ No newline at end of file
+        """Format the conversation history for logging, rendering only turns added since the last call"""
+        if self._logged_turns < len(self.turns):
+            new_lines = "\n".join(turn.render() for turn in self.turns[self._logged_turns:])
+            self._log = f"{self._log}\n{new_lines}" if self._log else new_lines
+            self._logged_turns = len(self.turns)
+        return self._log
@@ -0,0 +1,187 @@
+import json
+import time
+import logging
+import threading
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Bucket upper bounds of span durations, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Bucket upper bounds of token counts and history lengths
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 50000)
+
+Collector = Callable[[], Dict[str, float]]
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus layout"""
+    
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Trace:
+    """Spans and values recorded while one update is handled"""
+    
+    def __init__(self, name: str, attributes: Dict[str, object]):
+        self.name = name
+        self.attributes = attributes
+        self.spans: Dict[str, float] = {}
+        self.values: Dict[str, float] = {}
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar('trace', default=None)
+
+class MetricsService:
+    """Service for timing spans on the hot path and exposing them as Prometheus metrics
+    
+    Spans and values go into in-process histograms, which cost a lock and a
+    bisect per record. A trace groups the spans of one handled update and,
+    with json_logs on, writes them as one structured log line.
+    """
+    
+    def __init__(self, json_logs: bool = False):
+        self.json_logs = json_logs
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, str, str], Histogram] = {}
+        self._counters: Dict[Tuple[str, str], float] = {}
+        self._collectors: List[Tuple[str, Collector]] = []
+        self._server = None
+        self._logger = logging.getLogger('metrics')
+    
+    def register_collector(self, prefix: str, collector: Collector) -> None:
+        """Expose the values returned by collector as gauges named prefix_<key>"""
+        self._collectors.append((prefix, collector))
+    
+    def _observe(self, metric: str, label_name: str, label: str, value: float, buckets: Tuple[float, ...]) -> None:
+        key = (metric, label_name, label)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+    
+    def record(self, name: str, seconds: float) -> None:
+        """Record the duration of a span"""
+        self._observe('bot_span_seconds', 'span', name, seconds, DURATION_BUCKETS)
+        trace = _current_trace.get()
+        if trace:
+            # Spans repeated within a trace, like Telegram edits, add up
+            trace.spans[name] = trace.spans.get(name, 0.0) + seconds
+    
+    def observe(self, name: str, value: float) -> None:
+        """Record a size, such as a token count or the length of the message history"""
+        self._observe('bot_value', 'name', name, value, SIZE_BUCKETS)
+        trace = _current_trace.get()
+        if trace:
+            trace.values[name] = trace.values.get(name, 0) + value
+    
+    def increment(self, name: str, labels: str = "", amount: float = 1) -> None:
+        """Increase a counter, labels are given in exposition format"""
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + amount
+    
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Time a block of code, async blocks included"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started_at)
+    
+    @contextmanager
+    def trace(self, name: str, **attributes) -> Iterator[Trace]:
+        """Group the spans of one handled update and count it as a request"""
+        trace = Trace(name, attributes)
+        token = _current_trace.set(trace)
+        started_at = time.perf_counter()
+        status = 'ok'
+        try:
+            yield trace
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            duration = time.perf_counter() - started_at
+            _current_trace.reset(token)
+            self.record(name, duration)
+            self.increment('bot_requests_total', f'trace="{name}",status="{status}"')
+            if self.json_logs:
+                self._logger.info(json.dumps({
+                    'trace': name,
+                    'status': status,
+                    'duration_ms': round(duration * 1000, 1),
+                    **trace.attributes,
+                    'spans_ms': {span: round(seconds * 1000, 1) for span, seconds in trace.spans.items()},
+                    **trace.values
+                }, ensure_ascii=False))
+    
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            histograms = [
+                (key, histogram.buckets, list(histogram.counts), histogram.sum, histogram.count)
+                for key, histogram in histograms
+            ]
+        
+        declared = set()
+        for (metric, label_name, label), buckets, counts, total, count in histograms:
+            if metric not in declared:
+                lines.append(f"# TYPE {metric} histogram")
+                declared.add(metric)
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'{metric}_bucket{{{label_name}="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{{label_name}="{label}"}} {total}')
+            lines.append(f'{metric}_count{{{label_name}="{label}"}} {count}')
+        
+        for (name, labels), value in counters:
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        
+        for prefix, collector in self._collectors:
+            try:
+                values = collector()
+            except Exception as e:
+                logging.error(f"Error collecting metrics {prefix}: {e}")
+                continue
+            for key, value in values.items():
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {float(value)}")
+        
+        return "\n".join(lines) + "\n"
+    
+    async def start_server(self, host: str = '127.0.0.1', port: int = 9100) -> None:
+        """Serve GET /metrics on a local port"""
+        from aiohttp import web
+        
+        async def handle_metrics(request):
+            return web.Response(text=self.render(), content_type='text/plain', charset='utf-8')
+        
+        app = web.Application()
+        app.router.add_get('/metrics', handle_metrics)
+        self._server = web.AppRunner(app, access_log=None)
+        await self._server.setup()
+        await web.TCPSite(self._server, host, port).start()
+        logging.info(f"Metrics available at http://{host}:{port}/metrics")
+    
+    async def stop_server(self) -> None:
+        """Stop the metrics endpoint"""
+        if self._server:
+            await self._server.cleanup()
+            self._server = None
@@ -0,0 +1,260 @@
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from pydantic import ConfigDict
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.rate_limiters import InMemoryRateLimiter
+
+class ProviderRoute:
+    """One provider behind the router with its rate limit and recent latencies"""
+    
+    def __init__(self, name: str, llm, rate_limiter: Optional[InMemoryRateLimiter] = None):
+        self.name = name
+        self.llm = llm
+        self.rate_limiter = rate_limiter
+        self.latencies: Deque[float] = deque(maxlen=200)
+    
+    def with_llm(self, llm) -> 'ProviderRoute':
+        """Same route, rate limit and statistics over another client, e.g. one with bound arguments"""
+        route = ProviderRoute(self.name, llm, self.rate_limiter)
+        route.latencies = self.latencies
+        return route
+    
+    def percentile(self, p: float) -> Optional[float]:
+        """Latency percentile of recent successful calls"""
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+def create_rate_limiter(requests_per_minute: Optional[float]) -> Optional[InMemoryRateLimiter]:
+    """Token bucket that allows short bursts of up to a tenth of the per-minute limit"""
+    if not requests_per_minute:
+        return None
+    return InMemoryRateLimiter(
+        requests_per_second=requests_per_minute / 60,
+        check_every_n_seconds=0.05,
+        max_bucket_size=max(1, requests_per_minute / 10)
+    )
+
+# Exception class names that SDKs of the providers use for an exhausted quota
+RATE_LIMIT_ERRORS = ('RateLimitError', 'ResourceExhausted', 'TooManyRequests')
+
+# Failures that may pass when the request is repeated
+TRANSIENT_STATUSES = (408, 409, 425, 429, 500, 502, 503, 504, 529)
+TRANSIENT_ERRORS = RATE_LIMIT_ERRORS + (
+    'APITimeoutError', 'APIConnectionError', 'InternalServerError', 'ServerError', 'ServiceUnavailable',
+    'DeadlineExceeded', 'TimeoutException', 'NetworkError', 'RemoteProtocolError'
+)
+
+def error_status(error: BaseException) -> Optional[int]:
+    """HTTP status of a provider error, whichever SDK raised it"""
+    response = getattr(error, 'response', None)
+    for status in (getattr(error, 'status_code', None), getattr(error, 'code', None), getattr(response, 'status_code', None)):
+        if isinstance(status, int) and not isinstance(status, bool):
+            return status
+    return None
+
+def _error_chain(error: Optional[BaseException]) -> Iterator[BaseException]:
+    """An error and the errors it was raised from, LangChain wraps SDK errors in its own"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        error = error.__cause__ or error.__context__
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """Whether a provider turned a request away for its rate limit or quota"""
+    return any(
+        error_status(cause) == 429 or type(cause).__name__ in RATE_LIMIT_ERRORS
+        for cause in _error_chain(error)
+    )
+
+def is_transient_error(error: BaseException) -> bool:
+    """Whether a provider call failed for a reason a retry may get past: rate limits, timeouts, server errors"""
+    return any(
+        isinstance(cause, (TimeoutError, ConnectionError))
+        or error_status(cause) in TRANSIENT_STATUSES
+        or type(cause).__name__ in TRANSIENT_ERRORS
+        for cause in _error_chain(error)
+    )
+
+class ProviderRouter(BaseChatModel):
+    """Chat model that spreads calls over several providers
+    
+    Calls go to the first route, wait for its rate limiter and are cut off
+    after timeout. A call that failed for a transient reason falls back to
+    the next route right away; when every route failed, the round is retried
+    with jittered backoff. Other errors, e.g. a bad request, are raised at
+    once. With hedge_percentile set and a second route, a slow call gets a
+    twin on that route once it runs longer than that latency percentile of
+    its route. The first answer wins. Streams are routed on their first
+    chunk, later errors are not retried.
+    """
+    
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+    
+    routes: List[ProviderRoute]
+    model_name: str = ""
+    timeout: float = 60.0
+    max_retries: int = 2
+    retry_delay: float = 0.5
+    hedge_percentile: Optional[float] = None
+    hedge_min_samples: int = 20
+    
+    @property
+    def _llm_type(self) -> str:
+        return "provider-router"
+    
+    def map_routes(self, function: Callable[[str, Any], Any]) -> 'ProviderRouter':
+        """Copy of the router with function(name, llm) applied to every route client"""
+        return self.model_copy(update={
+            'routes': [route.with_llm(function(route.name, route.llm)) for route in self.routes]
+        })
+    
+    def _hedge_delay(self, route: ProviderRoute) -> Optional[float]:
+        """Seconds after which a call on a route gets a hedged twin"""
+        if not self.hedge_percentile or len(route.latencies) < self.hedge_min_samples:
+            return None
+        return route.percentile(self.hedge_percentile)
+    
+    async def _attempt(self, route: ProviderRoute, call: Callable[[Any], Awaitable[Any]]) -> Any:
+        """Run one call on a route within its rate limit and the timeout"""
+        if route.rate_limiter:
+            await route.rate_limiter.aacquire()
+        started_at = time.monotonic()
+        result = await asyncio.wait_for(call(route.llm), self.timeout)
+        route.latencies.append(time.monotonic() - started_at)
+        return result
+    
+    async def _round(self, call: Callable[[Any], Awaitable[Any]], discard: Callable[[Any], Awaitable[None]]) -> Any:
+        """Try the routes in order, hedging slow calls, and return the first success"""
+        waiting = list(self.routes)
+        running: Dict[asyncio.Task, ProviderRoute] = {}
+        errors: List[Tuple[str, BaseException]] = []
+        hedged = False
+        
+        def launch(route: ProviderRoute) -> None:
+            running[asyncio.ensure_future(self._attempt(route, call))] = route
+        
+        first_route = waiting.pop(0)
+        launch(first_route)
+        try:
+            while running:
+                # A twin on the same provider would only double its load
+                delay = None if hedged or not waiting else self._hedge_delay(first_route)
+                done, _ = await asyncio.wait(running, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                
+                if not done:
+                    hedged = True
+                    hedge_route = waiting.pop(0)
+                    logging.info(f"Hedging a slow call to {first_route.name} with {hedge_route.name}")
+                    launch(hedge_route)
+                    continue
+                
+                results = []
+                for task in done:
+                    route = running.pop(task)
+                    if task.exception() is None:
+                        results.append(task.result())
+                    else:
+                        errors.append((route.name, task.exception()))
+                        logging.warning(f"LLM call to {route.name} failed: {task.exception()!r}")
+                if results:
+                    for extra in results[1:]:
+                        await discard(extra)
+                    return results[0]
+                if not is_transient_error(errors[-1][1]):
+                    # Another provider or another round would fail the same way
+                    break
+                
+                if not running and waiting:
+                    launch(waiting.pop(0))
+        finally:
+            for task in running:
+                task.cancel()
+        
+        raise errors[-1][1]
+    
+    async def _route(self, call: Callable[[Any], Awaitable[Any]], discard: Callable[[Any], Awaitable[None]]) -> Any:
+        """Run routing rounds with exponential backoff and jitter between them"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._round(call, discard)
+            except Exception as e:
+                if attempt == self.max_retries or not is_transient_error(e):
+                    raise
+                await asyncio.sleep(self.retry_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+    
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        async def call(llm):
+            return await llm.ainvoke(messages, stop=stop, **kwargs)
+        
+        async def discard(message):
+            pass
+        
+        message = await self._route(call, discard)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+    
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        async def call(llm):
+            chunks = llm.astream(messages, stop=stop, **kwargs).__aiter__()
+            try:
+                return chunks, await chunks.__anext__()
+            except BaseException:
+                await chunks.aclose()
+                raise
+        
+        async def discard(started):
+            await started[0].aclose()
+        
+        chunks, chunk = await self._route(call, discard)
+        try:
+            while True:
+                yield ChatGenerationChunk(message=chunk)
+                try:
+                    # A stalled stream is cut off like a stalled call
+                    chunk = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                except StopAsyncIteration:
+                    return
+        finally:
+            await chunks.aclose()
+    
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        """Blocking calls fall back and retry like async ones but are not hedged"""
+        error = None
+        for attempt in range(self.max_retries + 1):
+            for route in self.routes:
+                try:
+                    message = self._attempt_sync(route, messages, stop, **kwargs)
+                    return ChatResult(generations=[ChatGeneration(message=message)])
+                except Exception as e:
+                    error = e
+                    logging.warning(f"LLM call to {route.name} failed: {e!r}")
+                    if not is_transient_error(e):
+                        raise
+            if attempt < self.max_retries:
+                time.sleep(self.retry_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+        raise error
+    
+    def _attempt_sync(self, route: ProviderRoute, messages, stop, **kwargs) -> Any:
+        """Blocking call on a route within its rate limit and the timeout"""
+        if route.rate_limiter:
+            route.rate_limiter.acquire()
+        started_at = time.monotonic()
+        # A blocking client cannot be interrupted, a call past the timeout is left to finish in its thread
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            message = executor.submit(route.llm.invoke, messages, stop=stop, **kwargs).result(self.timeout)
+        except FutureTimeoutError:
+            raise TimeoutError(f"LLM call to {route.name} timed out after {self.timeout}s") from None
+        finally:
+            executor.shutdown(wait=False)
+        route.latencies.append(time.monotonic() - started_at)
+        return message
@@ -0,0 +1,158 @@
+import re
+import math
+import time
+import random
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.messages import BaseMessage
+
+from .log_sink import prompt_hash
+
+class CacheProbe:
+    """Result of a cache lookup that can also store the reply of a miss"""
+    
+    def __init__(self, context_key: str, text_key: str, vector: Optional[List[float]], reply: Optional[str]):
+        self.context_key = context_key
+        self.text_key = text_key
+        self.vector = vector
+        self.reply = reply
+
+class ResponseCache:
+    """Cache of client replies to near-identical manager openers
+    
+    Replies are grouped by system prompt and the whole earlier dialog, so only
+    the first turns of a conversation are cached. Within a group the incoming
+    message is matched by embedding similarity, or exactly after normalization
+    when no embeddings are configured. Each entry keeps its latest few reply
+    variants, and a share of hits is sent to the LLM anyway for a new one that
+    replaces the oldest, so the role-play does not turn into a script.
+    """
+    
+    def __init__(
+        self,
+        embeddings=None,
+        similarity_threshold: float = 0.92,
+        max_history: int = 2,
+        bypass_rate: float = 0.3,
+        max_variants: int = 5,
+        max_entries: int = 2000,
+        ttl: Optional[float] = 86400
+    ):
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self.max_history = max_history
+        self.bypass_rate = bypass_rate
+        self.max_variants = max_variants
+        self.max_entries = max_entries
+        self.ttl = ttl
+        
+        # (context key, text key) -> (created at, unit vector, reply variants), oldest use first
+        self._entries: OrderedDict[Tuple[str, str], Tuple[float, Optional[List[float]], List[str]]] = OrderedDict()
+        # Text keys of the entries of every context, for similarity search
+        self._contexts: Dict[str, set] = {}
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+    
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Lowercase text without punctuation and extra spaces"""
+        text = text.lower().replace('ё', 'е')
+        return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+    
+    def _context_key(self, system_prompt: str, chat_history: List[BaseMessage]) -> str:
+        history = "\n".join(f"{msg.type}:{self.normalize(str(msg.content))}" for msg in chat_history)
+        return f"{prompt_hash(system_prompt)}:{prompt_hash(history)}"
+    
+    async def _embed(self, text: str) -> Optional[List[float]]:
+        """Unit-length embedding of a text, None when embeddings are off or fail"""
+        if not self.embeddings:
+            return None
+        try:
+            vector = await self.embeddings.aembed_query(text)
+        except Exception as e:
+            logging.warning(f"Embedding for the response cache failed: {e}")
+            return None
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+    
+    def _find(self, context_key: str, text_key: str, vector: Optional[List[float]]) -> Optional[Tuple[str, str]]:
+        """Key of the live entry closest to the message, if it is close enough"""
+        now = time.monotonic()
+        best_key, best_score = None, self.similarity_threshold
+        for candidate in list(self._contexts.get(context_key, ())):
+            key = (context_key, candidate)
+            created_at, candidate_vector, _ = self._entries[key]
+            if self.ttl and now - created_at > self.ttl:
+                self._remove(key)
+                continue
+            if candidate == text_key:
+                return key
+            if vector and candidate_vector:
+                score = sum(a * b for a, b in zip(vector, candidate_vector))
+                if score >= best_score:
+                    best_key, best_score = key, score
+        return best_key
+    
+    async def probe(self, system_prompt: str, chat_history: List[BaseMessage], user_text: str) -> Optional[CacheProbe]:
+        """Look up a reply, returns None when the dialog is past the cached openers"""
+        if len(chat_history) > self.max_history:
+            return None
+        
+        context_key = self._context_key(system_prompt, chat_history)
+        text_key = self.normalize(user_text)
+        # A live exact match lends its embedding, anything else needs one for similarity search and storing
+        entry = self._entries.get((context_key, text_key))
+        if entry and entry[1] and not (self.ttl and time.monotonic() - entry[0] > self.ttl):
+            vector = entry[1]
+        else:
+            vector = await self._embed(text_key)
+        
+        key = self._find(context_key, text_key, vector)
+        if key is None:
+            self.misses += 1
+            return CacheProbe(context_key, text_key, vector, None)
+        
+        self._entries.move_to_end(key)
+        _, _, replies = self._entries[key]
+        if random.random() < self.bypass_rate:
+            self.bypassed += 1
+            # The fresh reply becomes another variant of the matched entry
+            return CacheProbe(context_key, key[1], vector, None)
+        
+        self.hits += 1
+        return CacheProbe(context_key, key[1], vector, random.choice(replies))
+    
+    def store(self, probe: CacheProbe, reply: str) -> None:
+        """Add the LLM reply of a missed or bypassed probe"""
+        key = (probe.context_key, probe.text_key)
+        entry = self._entries.get(key)
+        if entry:
+            created_at, vector, replies = entry
+            if reply not in replies:
+                replies.append(reply)
+                del replies[:-self.max_variants]
+            if vector is None and probe.vector:
+                # An entry stored while embeddings failed becomes reachable by similarity again
+                self._entries[key] = (created_at, probe.vector, replies)
+            self._entries.move_to_end(key)
+            return
+        
+        self._entries[key] = (time.monotonic(), probe.vector, [reply])
+        self._contexts.setdefault(probe.context_key, set()).add(probe.text_key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+    
+    def _remove(self, key: Tuple[str, str]) -> None:
+        del self._entries[key]
+        texts = self._contexts.get(key[0])
+        if texts is not None:
+            texts.discard(key[1])
+            if not texts:
+                del self._contexts[key[0]]
+    
+    def stats(self) -> Dict[str, float]:
+        """Get entry count and lookup counters"""
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'bypassed': self.bypassed}
@@ -0,0 +1,309 @@
+import os
+import logging
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Rating filter values and the Dialog Rating they match in the log
+RATINGS = {'successful': 'Successful', 'unsuccessful': 'Unsuccessful', 'unrated': ''}
+
+# Filters of a search query, written as key:value between the words to find
+QUERY_FILTERS = {
+    'id': ('dialog_id', int),
+    'user': ('user_id', int),
+    'prompt': ('prompt', str),
+    'rating': ('rating', str),
+    'natural': ('naturalness', int),
+    'since': ('since', str),
+    'until': ('until', str),
+    'page': ('page', int)
+}
+
+# A text query scans the filtered dialogs instead of its matches when it matches more dialogs
+FILTER_FIRST_MATCHES = 2000
+
+def parse_query(query: str) -> Dict[str, Any]:
+    """Split a search query into the words to find and its key:value filters, bad values raise ValueError"""
+    search: Dict[str, Any] = {}
+    words = []
+    for word in query.split():
+        key, separator, value = word.partition(':')
+        if separator and value and key.lower() in QUERY_FILTERS:
+            name, convert = QUERY_FILTERS[key.lower()]
+            search[name] = convert(value)
+        else:
+            words.append(word)
+    if search.get('rating') is not None and search['rating'] not in RATINGS:
+        raise ValueError(f"rating must be one of {', '.join(RATINGS)}")
+    search['text'] = " ".join(words)
+    return search
+
+def fts_query(text: str) -> str:
+    """FTS5 query matching every word of free text, a trailing * matches a word prefix"""
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*') and len(word) > 1
+        word = word.rstrip('*').replace('"', '""')
+        if word:
+            terms.append(f'"{word}"*' if prefix else f'"{word}"')
+    return " ".join(terms)
+
+def _to_int(value: Any) -> Optional[int]:
+    """Integer of a log field, None if it is empty or not a number"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+class DialogSearchIndex:
+    """SQLite index of logged dialogs for search by phrase, user, prompt, rating and time
+    
+    Transcripts and analyses are indexed with FTS5, the other fields with
+    B-tree indexes. Each dialog is one row keyed by its uuid, so logging a
+    dialog again, e.g. after a second rating, replaces the earlier row.
+    Results come newest first, one page at a time.
+    """
+    
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        # Several bot processes may write the same index
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS dialogs ("
+            "id INTEGER PRIMARY KEY, user_uuid TEXT UNIQUE, user_id INTEGER, prompt_hash TEXT NOT NULL, "
+            "dialog_rating TEXT NOT NULL, naturalness_rating INTEGER, timestamp TEXT NOT NULL, "
+            "analysis_result TEXT NOT NULL, conversation_log TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS dialogs_user ON dialogs (user_id);"
+            "CREATE INDEX IF NOT EXISTS dialogs_prompt ON dialogs (prompt_hash);"
+            "CREATE INDEX IF NOT EXISTS dialogs_rating ON dialogs (dialog_rating);"
+            "CREATE INDEX IF NOT EXISTS dialogs_naturalness ON dialogs (naturalness_rating);"
+            "CREATE INDEX IF NOT EXISTS dialogs_timestamp ON dialogs (timestamp);"
+            "CREATE TABLE IF NOT EXISTS prompts (prompt_hash TEXT PRIMARY KEY, prompt TEXT NOT NULL);"
+            # The text lives in dialogs only, the FTS table keeps just the index
+            "CREATE VIRTUAL TABLE IF NOT EXISTS dialogs_fts USING fts5("
+            "conversation_log, analysis_result, content='dialogs', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2');"
+        )
+        self._db.commit()
+    
+    def add_rows(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """Index conversation log rows in one transaction, returns the number of rows indexed
+        
+        Rows with an unreadable User ID are logged and skipped.
+        """
+        count = 0
+        with self._lock:
+            try:
+                for row in rows:
+                    try:
+                        values = self._row_values(row)
+                    except ValueError as e:
+                        logging.warning(f"Skipped log row of dialog {row.get('User UUID') or '-'}: {e}")
+                        continue
+                    self._add_row(row, values)
+                    count += 1
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+        return count
+    
+    @staticmethod
+    def _row_values(row: Dict[str, Any]) -> Tuple[Any, ...]:
+        """Column values of a log row, checked before anything is written"""
+        user_id = row.get('User ID')
+        return (
+            int(user_id) if user_id not in (None, "") else None,
+            row.get('Prompt Hash') or "",
+            row.get('Dialog Rating') or "",
+            # Rows of old logs may carry text in place of the rating
+            _to_int(row.get('Naturalness Rating')),
+            row.get('Timestamp') or "",
+            row.get('Analysis Result') or "",
+            row.get('Conversation Log') or ""
+        )
+    
+    def _add_row(self, row: Dict[str, Any], values: Tuple[Any, ...]) -> None:
+        # Rows of old logs may lack a uuid, each of them is a dialog of its own
+        user_uuid = row.get('User UUID') or None
+        existing = user_uuid and self._db.execute(
+            "SELECT id, conversation_log, analysis_result FROM dialogs WHERE user_uuid = ?", (user_uuid,)
+        ).fetchone()
+        
+        if existing:
+            dialog_id = existing[0]
+            self._db.execute(
+                "INSERT INTO dialogs_fts (dialogs_fts, rowid, conversation_log, analysis_result) "
+                "VALUES ('delete', ?, ?, ?)",
+                existing
+            )
+            self._db.execute(
+                "UPDATE dialogs SET user_id = ?, prompt_hash = ?, dialog_rating = ?, naturalness_rating = ?, "
+                "timestamp = ?, analysis_result = ?, conversation_log = ? WHERE id = ?",
+                values + (dialog_id,)
+            )
+        else:
+            dialog_id = self._db.execute(
+                "INSERT INTO dialogs (user_uuid, user_id, prompt_hash, dialog_rating, naturalness_rating, "
+                "timestamp, analysis_result, conversation_log) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_uuid,) + values
+            ).lastrowid
+        
+        self._db.execute(
+            "INSERT INTO dialogs_fts (rowid, conversation_log, analysis_result) VALUES (?, ?, ?)",
+            (dialog_id, values[6], values[5])
+        )
+        if values[1] and row.get('System Prompt'):
+            self._db.execute(
+                "INSERT OR IGNORE INTO prompts (prompt_hash, prompt) VALUES (?, ?)",
+                (values[1], row['System Prompt'])
+            )
+    
+    def search(
+        self,
+        text: Optional[str] = None,
+        user_id: Optional[int] = None,
+        prompt: Optional[str] = None,
+        rating: Optional[str] = None,
+        naturalness: Optional[int] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        page: int = 1,
+        page_size: int = 10
+    ) -> Tuple[List[Dict[str, Any]], bool]:
+        """One page of matching dialogs, newest first, and whether more pages follow
+        
+        prompt is a prefix of the prompt hash, rating is one of RATINGS, since
+        and until are ISO dates or timestamps.
+        """
+        if rating is not None and rating not in RATINGS:
+            raise ValueError(f"Unknown rating filter: {rating}")
+        
+        conditions: List[str] = []
+        params: List[Any] = []
+        if user_id is not None:
+            conditions.append("d.user_id = ?")
+            params.append(user_id)
+        if prompt:
+            # Hashes are lowercase hex, so the range holds every hash with the prefix
+            conditions.append("d.prompt_hash >= ? AND d.prompt_hash < ?")
+            params += [prompt.lower(), prompt.lower() + "~"]
+        if rating is not None:
+            conditions.append("d.dialog_rating = ?")
+            params.append(RATINGS[rating])
+        if naturalness is not None:
+            conditions.append("d.naturalness_rating = ?")
+            params.append(naturalness)
+        if since:
+            conditions.append("d.timestamp >= ?")
+            params.append(since)
+        if until:
+            conditions.append("d.timestamp < ?")
+            params.append(until)
+        
+        page = max(1, page)
+        query = fts_query(text) if text else ""
+        with self._lock:
+            # FTS5 drives the join unless the words are common and the filters narrow the dialogs
+            # down, then the newest filtered dialogs are checked one by one until the page is full
+            filter_first = bool(query and conditions) and self._matches_more(query, FILTER_FIRST_MATCHES)
+            if query and not filter_first:
+                source = "dialogs_fts JOIN dialogs d ON d.id = dialogs_fts.rowid"
+                excerpt = "snippet(dialogs_fts, -1, '«', '»', '…', 12)"
+                order = "dialogs_fts.rowid"
+                conditions.insert(0, "dialogs_fts MATCH ?")
+                params.insert(0, query)
+            else:
+                source = "dialogs d"
+                excerpt = "substr(d.conversation_log, 1, 160)"
+                order = "d.id"
+                if filter_first:
+                    conditions.append("EXISTS (SELECT 1 FROM dialogs_fts WHERE dialogs_fts MATCH ? AND rowid = d.id)")
+                    params.append(query)
+            
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            # One extra row tells whether another page follows without counting every match
+            params += [page_size + 1, (page - 1) * page_size]
+            rows = self._db.execute(
+                f"SELECT d.id, d.timestamp, d.user_id, d.prompt_hash, d.dialog_rating, d.naturalness_rating, {excerpt} "
+                f"FROM {source} {where} ORDER BY {order} DESC LIMIT ? OFFSET ?",
+                params
+            ).fetchall()
+            if filter_first:
+                rows = [row[:6] + (self._snippet(row[0], query),) for row in rows[:page_size]] + rows[page_size:]
+        
+        results = [
+            {
+                'id': row[0],
+                'timestamp': row[1],
+                'user_id': row[2],
+                'prompt_hash': row[3],
+                'dialog_rating': row[4],
+                'naturalness_rating': row[5],
+                'snippet': row[6]
+            }
+            for row in rows[:page_size]
+        ]
+        return results, len(rows) > page_size
+    
+    def _matches_more(self, query: str, count: int) -> bool:
+        """Whether more than count dialogs match, reading at most count + 1 rowids"""
+        return self._db.execute(
+            "SELECT rowid FROM dialogs_fts WHERE dialogs_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+            (query, count)
+        ).fetchone() is not None
+    
+    def _snippet(self, dialog_id: int, query: str) -> str:
+        row = self._db.execute(
+            "SELECT snippet(dialogs_fts, -1, '«', '»', '…', 12) FROM dialogs_fts WHERE dialogs_fts MATCH ? AND rowid = ?",
+            (query, dialog_id)
+        ).fetchone()
+        return row[0] if row else ""
+    
+    def dialog(self, dialog_id: int) -> Optional[Dict[str, Any]]:
+        """Full record of an indexed dialog, with its system prompt"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT d.id, d.user_uuid, d.user_id, d.timestamp, d.prompt_hash, p.prompt, d.dialog_rating, "
+                "d.naturalness_rating, d.analysis_result, d.conversation_log "
+                "FROM dialogs d LEFT JOIN prompts p ON p.prompt_hash = d.prompt_hash WHERE d.id = ?",
+                (dialog_id,)
+            ).fetchone()
+        if not row:
+            return None
+        keys = (
+            'id', 'user_uuid', 'user_id', 'timestamp', 'prompt_hash', 'system_prompt', 'dialog_rating',
+            'naturalness_rating', 'analysis_result', 'conversation_log'
+        )
+        return dict(zip(keys, row))
+    
+    def count(self) -> int:
+        """Number of indexed dialogs"""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM dialogs").fetchone()[0]
+    
+    def rebuild(self, rows: Iterable[Dict[str, Any]], batch_size: int = 5000) -> int:
+        """Index every row of existing logs, rows already indexed are replaced"""
+        total = 0
+        batch: List[Dict[str, Any]] = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                total += self.add_rows(batch)
+                batch = []
+        total += self.add_rows(batch)
+        with self._lock:
+            self._db.execute("INSERT INTO dialogs_fts (dialogs_fts) VALUES ('optimize')")
+            # Row counts of the B-tree indexes let the planner pick the narrowest filter
+            self._db.execute("ANALYZE")
+            self._db.commit()
+        return total
+    
+    def close(self) -> None:
+        """Close the SQLite connection"""
+        with self._lock:
+            self._db.close()
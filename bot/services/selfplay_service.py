@@ -0,0 +1,142 @@
+import time
+import random
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+from .conversation_service import ConversationService
+from .logging_service import LoggingService
+from .memory_service import TelegramChatMemory
+from .provider_router import is_rate_limit_error
+
+class RateLimiter:
+    """Spaces out LLM requests to stay under a requests-per-minute limit"""
+    
+    def __init__(self, requests_per_minute: float = 0):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self) -> None:
+        """Wait for the next free request slot"""
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_at - now
+            self._next_at = max(now, self._next_at) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+    
+    def slow_down(self, seconds: float) -> None:
+        """Push every later request back after the provider reported a rate limit"""
+        self._next_at = max(self._next_at, time.monotonic() + seconds)
+
+class SelfPlayService:
+    """Service for running headless dialogs between an LLM sales manager and the LLM client
+    
+    The client is an ordinary conversation of ConversationService, the manager
+    is a second chat chain with its own memory that sees the dialog from the
+    other side. Finished dialogs go through the usual logging and analysis.
+    """
+    
+    def __init__(
+        self,
+        conversation_service: ConversationService,
+        logging_service: LoggingService,
+        manager_prompt: str,
+        analysis_prompt: str,
+        manager_provider: Optional[str] = None,
+        opening_message: str = "Алло, здравствуйте",
+        stop_phrases: Optional[List[str]] = None,
+        max_turns: int = 12,
+        concurrency: int = 20,
+        requests_per_minute: float = 0,
+        max_retries: int = 5
+    ):
+        self.conversation_service = conversation_service
+        self.logging_service = logging_service
+        self.llm_service = conversation_service.llm_service
+        self.manager_prompt = manager_prompt
+        self.analysis_prompt = analysis_prompt
+        self.manager_provider = manager_provider
+        self.opening_message = opening_message
+        self.stop_phrases = [phrase.lower() for phrase in (stop_phrases or [])]
+        self.max_turns = max_turns
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._limiter = RateLimiter(requests_per_minute)
+    
+    async def _ask(self, chain, memory: TelegramChatMemory, text: str) -> str:
+        """Get the next reply of one side, waiting out rate limits"""
+        chain_input = self.llm_service.build_chain_input(memory.get_messages(), text)
+        for attempt in range(self.max_retries + 1):
+            await self._limiter.acquire()
+            try:
+                response = await chain.ainvoke(chain_input)
+                break
+            except Exception as e:
+                # Rate limits of any provider are waited out, other errors end the dialog
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                # Exponential backoff with jitter, shared by all dialogs
+                delay = 2 ** attempt * random.uniform(1.0, 2.0)
+                self._limiter.slow_down(delay)
+                logging.warning(f"Rate limited, retrying in {delay:.1f}s: {e}")
+        
+        memory.add_exchange(text, response.content)
+        return response.content
+    
+    def _is_finished(self, text: str) -> bool:
+        """Check whether a reply ends the call"""
+        text = text.lower()
+        return any(phrase in text for phrase in self.stop_phrases)
+    
+    async def run_dialog(self, user_id: int, client_prompt: Optional[str] = None) -> Dict[str, Any]:
+        """Play one dialog to the end, log it and return its analysis"""
+        async with self._semaphore:
+            conversation = self.conversation_service.create_conversation(user_id, client_prompt)
+            manager_chain = self.llm_service.create_chat_chain(self.manager_prompt, provider=self.manager_provider)
+            if not conversation['chain'] or not manager_chain:
+                raise RuntimeError("Unable to create chat chains for self-play")
+            manager_memory = TelegramChatMemory(user_id)
+            
+            client_text = self.opening_message
+            turns = 0
+            while turns < self.max_turns:
+                manager_text = await self._ask(manager_chain, manager_memory, client_text)
+                client_text = await self._ask(conversation['chain'], conversation['memory'], manager_text)
+                turns += 1
+                if self._is_finished(manager_text) or self._is_finished(client_text):
+                    break
+            
+            self.conversation_service.end_conversation(user_id)
+            analysis_result = await self.logging_service.alog_conversation(
+                user_id,
+                conversation,
+                self.analysis_prompt
+            )
+            # Nothing reads self-play dialogs again once they are logged
+            self.conversation_service.conversations.pop(user_id)
+            return {'user_id': user_id, 'turns': turns, 'analysis': analysis_result}
+    
+    async def run(self, dialogs: int, client_prompt: Optional[str] = None) -> Dict[str, Any]:
+        """Run many dialogs concurrently and summarize the batch"""
+        started_at = time.monotonic()
+        # Negative ids never collide with Telegram users
+        results = await asyncio.gather(
+            *(self.run_dialog(-(i + 1), client_prompt) for i in range(dialogs)),
+            return_exceptions=True
+        )
+        
+        finished = [result for result in results if not isinstance(result, BaseException)]
+        for result in results:
+            if isinstance(result, BaseException):
+                logging.error(f"Self-play dialog failed: {result}")
+        
+        return {
+            'dialogs': len(finished),
+            'failed': dialogs - len(finished),
+            'turns': sum(result['turns'] for result in finished),
+            'elapsed': time.monotonic() - started_at
+        }
@@ -0,0 +1,269 @@
+import json
+import bisect
+import asyncio
+import hashlib
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Set
+
+import aiohttp
+from aiohttp import web
+from telebot import types
+
+def update_user_id(update: Dict[str, Any]) -> int:
+    """Id of the user a raw Telegram update belongs to, 0 when it has none"""
+    for event in update.values():
+        if isinstance(event, dict) and isinstance(event.get('from'), dict):
+            return event['from'].get('id', 0)
+    return 0
+
+class HashRing:
+    """Consistent hash ring mapping user ids onto shards
+    
+    Every shard owns many points of the ring, so users are spread evenly and
+    changing the number of shards moves only the users of the shards that
+    were added or removed.
+    """
+    
+    def __init__(self, shards: int, points_per_shard: int = 128):
+        ring = sorted(
+            (self._hash(f"shard-{shard}-{point}"), shard)
+            for shard in range(shards)
+            for point in range(points_per_shard)
+        )
+        self._points = [point for point, _ in ring]
+        self._shards = [shard for _, shard in ring]
+    
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+    
+    def shard(self, user_id: int) -> int:
+        """Shard that owns a user"""
+        index = bisect.bisect(self._points, self._hash(str(user_id))) % len(self._points)
+        return self._shards[index]
+
+class ShardForwarder:
+    """In-order delivery of updates to one worker process
+    
+    Updates are sent in batches, one request at a time, so the worker gets
+    every user's updates in arrival order. While the worker restarts or
+    rejects updates they stay buffered and are retried; when the buffer is
+    full the oldest updates are dropped.
+    """
+    
+    def __init__(self, shard: int, url: str, session: aiohttp.ClientSession, max_buffer: int = 10000, batch_size: int = 100):
+        self.shard = shard
+        self.url = url
+        self.session = session
+        self.max_buffer = max_buffer
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.forwarded = 0
+        self._buffer: Deque[Dict[str, Any]] = deque()
+        self._in_flight = 0
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+    
+    def put(self, update: Dict[str, Any]) -> None:
+        """Queue an update for the worker"""
+        if len(self._buffer) >= self.max_buffer:
+            self._buffer.popleft()
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logging.error(f"Update buffer of shard {self.shard} is full, {self.dropped} updates dropped")
+        self._buffer.append(update)
+        self._ready.set()
+    
+    def pending(self) -> int:
+        """Updates the worker has not accepted yet"""
+        return len(self._buffer) + self._in_flight
+    
+    async def _run(self) -> None:
+        """Send buffered batches, backing off while the worker is unavailable"""
+        delay = 0.05
+        while True:
+            await self._ready.wait()
+            batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            self._in_flight = len(batch)
+            try:
+                async with self.session.post(self.url, json=batch) as response:
+                    # 503 means the worker is draining before a restart
+                    if response.status != 200:
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, (), status=response.status, message=response.reason
+                        )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # The batch goes back in front of updates that arrived meanwhile
+                self._buffer.extendleft(reversed(batch))
+                self._in_flight = 0
+                logging.warning(f"Shard {self.shard} is unavailable, retrying in {delay:.2f}s: {e!r}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
+                continue
+            
+            delay = 0.05
+            self._in_flight = 0
+            self.forwarded += len(batch)
+            if not self._buffer:
+                self._ready.clear()
+    
+    async def flush(self, timeout: float = 30.0) -> None:
+        """Wait until the buffer is delivered or the timeout ends, then stop"""
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self.pending() and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.05)
+        if self.pending():
+            logging.error(f"Shard {self.shard} still had {self.pending()} undelivered updates on shutdown")
+        self._task.cancel()
+
+class WebhookIngress:
+    """Receives Telegram webhook updates and routes each user to one worker process
+    
+    The ingress does no bot work: it checks the secret token, reads the
+    user id from the raw update and hands the update to the forwarder of the
+    user's shard. Telegram gets its answer as soon as the update is queued.
+    """
+    
+    def __init__(
+        self,
+        worker_urls: List[str],
+        path: str = '/telegram',
+        secret_token: Optional[str] = None,
+        max_buffer: int = 10000,
+        batch_size: int = 100
+    ):
+        self.worker_urls = worker_urls
+        self.path = path
+        self.secret_token = secret_token
+        self.max_buffer = max_buffer
+        self.batch_size = batch_size
+        self.ring = HashRing(len(worker_urls))
+        self.received = 0
+        self.forwarders: List[ShardForwarder] = []
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._server: Optional[web.AppRunner] = None
+    
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret_token and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except json.JSONDecodeError:
+            return web.Response(status=400)
+        
+        self.received += 1
+        self.forwarders[self.ring.shard(update_user_id(update))].put(update)
+        return web.Response()
+    
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response(self.status())
+    
+    def status(self) -> Dict[str, Any]:
+        """Received updates and the delivery state of every shard"""
+        return {
+            'received': self.received,
+            'shards': [
+                {'pending': forwarder.pending(), 'forwarded': forwarder.forwarded, 'dropped': forwarder.dropped}
+                for forwarder in self.forwarders
+            ]
+        }
+    
+    async def start(self, host: str = '0.0.0.0', port: int = 8443) -> None:
+        """Start forwarding to the workers and accept webhook requests"""
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=2),
+            timeout=aiohttp.ClientTimeout(total=30)
+        )
+        self.forwarders = [
+            ShardForwarder(shard, url, self._session, self.max_buffer, self.batch_size)
+            for shard, url in enumerate(self.worker_urls)
+        ]
+        
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get('/health', self.handle_health)
+        self._server = web.AppRunner(app, access_log=None)
+        await self._server.setup()
+        await web.TCPSite(self._server, host, port).start()
+        logging.info(f"Webhook ingress listening on {host}:{port}{self.path} for {len(self.worker_urls)} workers")
+    
+    async def stop(self) -> None:
+        """Stop accepting updates and deliver what is buffered"""
+        if self._server:
+            await self._server.cleanup()
+            self._server = None
+        await asyncio.gather(*(forwarder.flush() for forwarder in self.forwarders))
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+class ShardWorker:
+    """Serves the updates of one shard with a TelegramBot in its own process
+    
+    On stop the worker rejects new batches with 503, so the ingress keeps
+    them buffered, and finishes the updates it already accepted. Conversation
+    state is written through to the shared store, so the restarted worker
+    picks the dialogs up where they were. The ingress resends a batch whose
+    answer it did not get, so the ids of the recent updates are kept and
+    repeated ones are skipped.
+    """
+    
+    def __init__(self, bot, shard: int, warm_up: bool = True, recent_updates: int = 10000):
+        self.bot = bot
+        self.shard = shard
+        self.warm_up = warm_up
+        self.received = 0
+        self.duplicates = 0
+        self.draining = False
+        self._recent_ids: Set[int] = set()
+        self._recent_order: Deque[int] = deque(maxlen=recent_updates)
+        self._server: Optional[web.AppRunner] = None
+    
+    async def handle_updates(self, request: web.Request) -> web.Response:
+        if self.draining:
+            return web.Response(status=503)
+        for update in await request.json():
+            update_id = update.get('update_id')
+            if update_id in self._recent_ids:
+                self.duplicates += 1
+                continue
+            self._remember(update_id)
+            self.bot.dispatch_update(types.Update.de_json(update))
+            self.received += 1
+        return web.Response()
+    
+    def _remember(self, update_id: int) -> None:
+        if len(self._recent_order) == self._recent_order.maxlen:
+            self._recent_ids.discard(self._recent_order[0])
+        self._recent_order.append(update_id)
+        self._recent_ids.add(update_id)
+    
+    async def handle_status(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            'shard': self.shard,
+            'received': self.received,
+            'duplicates': self.duplicates,
+            'pending': self.bot.dispatcher.pending(),
+            'active_users': self.bot.dispatcher.active_lanes(),
+            'draining': self.draining
+        })
+    
+    async def start(self, host: str = '127.0.0.1', port: int = 9200) -> None:
+        """Start the bot and accept batches from the ingress"""
+        await self.bot.start(warm_up=self.warm_up)
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/updates', self.handle_updates)
+        app.router.add_get('/status', self.handle_status)
+        self._server = web.AppRunner(app, access_log=None)
+        await self._server.setup()
+        await web.TCPSite(self._server, host, port).start()
+        logging.info(f"Shard {self.shard} worker listening on {host}:{port}")
+    
+    async def stop(self) -> None:
+        """Reject new updates, finish accepted ones and release the bot"""
+        self.draining = True
+        await self.bot.stop()
+        if self._server:
+            await self._server.cleanup()
+            self._server = None
@@ -0,0 +1,100 @@
+import time
+import logging
+from contextlib import nullcontext
+from typing import AsyncIterator, List, Optional
+
+from telebot.asyncio_helper import ApiTelegramException
+
+from .metrics_service import MetricsService
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Split text into Telegram-sized parts, preferring line and word boundaries"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(' ', 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n ')
+    parts.append(text)
+    return parts
+
+class StreamingReplyService:
+    """Service for sending LLM replies to Telegram, optionally as a live stream"""
+    
+    def __init__(
+        self,
+        bot,
+        edit_interval: float = 1.0,
+        placeholder: str = "…",
+        metrics: Optional[MetricsService] = None
+    ):
+        self.bot = bot
+        self.edit_interval = edit_interval
+        self.placeholder = placeholder
+        self.metrics = metrics
+    
+    def _span(self):
+        """Time a Telegram API call when metrics are enabled"""
+        return self.metrics.span("telegram_send") if self.metrics else nullcontext()
+    
+    async def send_reply(self, message, text: str) -> None:
+        """Reply with a complete text, split into several messages if needed"""
+        for i, part in enumerate(split_message(text)):
+            with self._span():
+                if i == 0:
+                    await self.bot.reply_to(message, part)
+                else:
+                    await self.bot.send_message(message.chat.id, part)
+    
+    async def edit_reply(self, chat_id: int, message_id: int, text: str) -> None:
+        """Replace the text of a sent message, sending any overflow as new messages"""
+        parts = split_message(text)
+        with self._span():
+            await self.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=parts[0])
+        for part in parts[1:]:
+            with self._span():
+                await self.bot.send_message(chat_id, part)
+    
+    async def stream_reply(self, message, chunks: AsyncIterator[str]) -> str:
+        """Show a placeholder right away and edit it as chunks arrive, return the full text"""
+        with self._span():
+            sent = [await self.bot.reply_to(message, self.placeholder)]
+        shown = [self.placeholder]
+        text = ""
+        last_render = time.monotonic()
+        
+        async for chunk in chunks:
+            text += chunk
+            # Telegram allows roughly one edit per second in a chat
+            if time.monotonic() - last_render >= self.edit_interval:
+                await self._render(message, text, sent, shown)
+                last_render = time.monotonic()
+        
+        await self._render(message, text, sent, shown)
+        return text
+    
+    async def _render(self, message, text: str, sent: list, shown: List[str]) -> None:
+        """Bring the sent messages in line with the text, sending new parts as needed"""
+        for i, part in enumerate(split_message(text)):
+            if not part.strip():
+                continue
+            if i >= len(sent):
+                with self._span():
+                    sent.append(await self.bot.send_message(message.chat.id, part))
+                shown.append(part)
+            elif shown[i] != part:
+                try:
+                    with self._span():
+                        await self.bot.edit_message_text(
+                            chat_id=message.chat.id,
+                            message_id=sent[i].message_id,
+                            text=part
+                        )
+                    shown[i] = part
+                except ApiTelegramException as e:
+                    logging.warning(f"Failed to edit streamed message: {e}")
@@ -0,0 +1,136 @@
+import io
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, BinaryIO, Optional, Union
+
+AudioInput = Union[bytes, BinaryIO]
+
+class STTBackend:
+    """Base class for speech-to-text engines"""
+    
+    # Whether astream yields text before the whole note is decoded
+    streaming = False
+    
+    def transcribe(self, audio: AudioInput, filename: str = "voice.ogg") -> str:
+        """Transcribe audio and return the full text"""
+        raise NotImplementedError
+    
+    async def atranscribe(self, audio: AudioInput, filename: str = "voice.ogg") -> str:
+        """Transcribe audio without blocking the event loop"""
+        return await asyncio.to_thread(self.transcribe, audio, filename)
+    
+    async def astream(self, audio: AudioInput, filename: str = "voice.ogg") -> AsyncIterator[str]:
+        """Yield pieces of the transcription as they become available"""
+        yield await self.atranscribe(audio, filename)
+    
+    def close(self) -> None:
+        """Release the resources of the engine"""
+
+class WhisperAPIBackend(STTBackend):
+    """Speech-to-text through the hosted OpenAI Whisper API"""
+    
+    def __init__(self, model: str = "whisper-1"):
+        import openai
+        
+        self.model = model
+        # Clients are created once and keep their connection pools between calls
+        self.client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        self.async_client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    
+    def transcribe(self, audio: AudioInput, filename: str = "voice.ogg") -> str:
+        transcription = self.client.audio.transcriptions.create(
+            model=self.model,
+            file=(filename, audio)
+        )
+        return transcription.text
+    
+    async def atranscribe(self, audio: AudioInput, filename: str = "voice.ogg") -> str:
+        transcription = await self.async_client.audio.transcriptions.create(
+            model=self.model,
+            file=(filename, audio)
+        )
+        return transcription.text
+
+class LocalWhisperBackend(STTBackend):
+    """Offline speech-to-text with a faster-whisper model kept loaded in memory
+    
+    Long notes are decoded segment by segment, so partial text is available
+    before the whole note is done. Transcriptions run on a thread pool sized
+    to the CPU cores; CTranslate2 releases the GIL while decoding.
+    """
+    
+    streaming = True
+    
+    def __init__(
+        self,
+        model: str = "small",
+        compute_type: str = "int8",
+        workers: int = 0,
+        language: Optional[str] = None
+    ):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError as e:
+            raise ImportError("Local speech-to-text requires faster-whisper: pip install faster-whisper") from e
+        
+        cores = os.cpu_count() or 1
+        self.workers = workers or max(1, cores // 2)
+        self.language = language
+        self.model = WhisperModel(
+            model,
+            device="cpu",
+            compute_type=compute_type,
+            cpu_threads=max(1, cores // self.workers),
+            num_workers=self.workers
+        )
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="stt")
+        logging.info(f"Local speech-to-text model {model} loaded with {self.workers} workers")
+    
+    def _segments(self, audio: AudioInput):
+        """Start decoding and return a lazy iterator over the segment texts"""
+        source = io.BytesIO(audio) if isinstance(audio, bytes) else audio
+        segments, _ = self.model.transcribe(source, language=self.language, vad_filter=True)
+        return (segment.text for segment in segments)
+    
+    def transcribe(self, audio: AudioInput, filename: str = "voice.ogg") -> str:
+        return "".join(self._segments(audio)).strip()
+    
+    async def atranscribe(self, audio: AudioInput, filename: str = "voice.ogg") -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.transcribe, audio, filename)
+    
+    async def astream(self, audio: AudioInput, filename: str = "voice.ogg") -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        pieces: asyncio.Queue = asyncio.Queue()
+        done = object()
+        
+        def decode():
+            try:
+                for text in self._segments(audio):
+                    loop.call_soon_threadsafe(pieces.put_nowait, text)
+            except Exception as e:
+                loop.call_soon_threadsafe(pieces.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(pieces.put_nowait, done)
+        
+        self.executor.submit(decode)
+        while True:
+            piece = await pieces.get()
+            if piece is done:
+                return
+            if isinstance(piece, Exception):
+                raise piece
+            yield piece
+    
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+def create_stt_backend(backend: str = "openai", **settings) -> STTBackend:
+    """Create the speech-to-text backend selected in the config"""
+    if backend == "local":
+        return LocalWhisperBackend(**settings)
+    if backend != "openai":
+        logging.error(f"Unknown STT backend: {backend}")
+    return WhisperAPIBackend()
@@ -1,24 +1,47 @@
-import os
 import logging
-from typing import Optional
+from typing import AsyncIterator, BinaryIO, Optional, Union
 
-import openai
+from .stt_backends import STTBackend, WhisperAPIBackend
+
+VoiceInput = Union[str, bytes, BinaryIO]
 
 class STTService:
     """Service for handling Speech-to-Text operations"""
     
-    def __init__(self):
-        self.client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    def __init__(self, backend: Optional[STTBackend] = None):
+        self.backend = backend or WhisperAPIBackend()
+    
+    @property
+    def streams_partial_text(self) -> bool:
+        """Whether partial transcriptions arrive before the whole note is decoded"""
+        return self.backend.streaming
+    
+    def transcribe_voice(self, voice: VoiceInput, filename: str = "voice.ogg") -> Optional[str]:
+        """Transcribe voice message
+        
+        Accepts raw bytes, a binary file-like object or a path to an audio file.
+        """
+        try:
+            if isinstance(voice, str):
+                with open(voice, "rb") as audio_file:
+                    return self.backend.transcribe(audio_file, filename)
+            return self.backend.transcribe(voice, filename)
+        except Exception as e:
+            logging.error(f"Voice transcription error: {e}")
+            return None
     
-    def transcribe_voice(self, voice_file_path: str) -> Optional[str]:
-        """Transcribe voice message using Whisper API"""
+    async def atranscribe_voice(self, voice: Union[bytes, BinaryIO], filename: str = "voice.ogg") -> Optional[str]:
+        """Transcribe in-memory audio without blocking the event loop"""
         try:
-            with open(voice_file_path, "rb") as audio_file:
-                transcription = self.client.audio.transcriptions.create(
-                    model="whisper-1", 
-                    file=audio_file
-                )
-            return transcription.text
+            return await self.backend.atranscribe(voice, filename)
         except Exception as e:
             logging.error(f"Voice transcription error: {e}")
-            return None 
\ No newline at end of file
+            return None
+    
+    def astream_transcription(self, voice: Union[bytes, BinaryIO], filename: str = "voice.ogg") -> AsyncIterator[str]:
+        """Yield pieces of the transcription as they are decoded, errors are raised"""
+        return self.backend.astream(voice, filename)
+    
+    def close(self) -> None:
+        """Release the speech-to-text engine"""
+        self.backend.close()
\ No newline at end of file
@@ -0,0 +1,87 @@
+import csv
+import os
+
+import pytest
+
+from services.log_sink import CSV_COLUMNS, build_row, export_parquet, read_rows
+from services.memory_service import TelegramChatMemory
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+LEGACY_LOG = os.path.join(os.path.dirname(__file__), 'data', 'legacy_conversations.csv')
+
+def read_raw(csv_path: str):
+    with open(csv_path, 'r', newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        return next(reader), list(reader)
+
+def test_legacy_log_round_trips_through_parquet(tmp_path):
+    header, raw_rows = read_raw(LEGACY_LOG)
+    # The header of the legacy log does not describe its rows
+    assert header[0] != 'Schema Version'
+    assert {len(values) for values in raw_rows} == {7, 8, 11}
+    
+    counts = export_parquet([LEGACY_LOG], str(tmp_path))
+    dialogs = pq.read_table(tmp_path / 'dialogs.parquet').to_pylist()
+    prompts = pq.read_table(tmp_path / 'prompts.parquet').to_pydict()
+    
+    assert counts == {'dialogs': len(raw_rows), 'prompts': len({values[3] for values in raw_rows})}
+    assert sorted(prompts['system_prompt']) == sorted({values[3] for values in raw_rows})
+    for values, dialog in zip(raw_rows, dialogs):
+        assert dialog['schema_version'] == 1
+        assert dialog['timestamp'] == values[0]
+        assert dialog['user_id'] == int(values[1])
+        assert dialog['user_uuid'] == values[2]
+        assert dialog['conversation_log'] == values[-1]
+        # No analysis is lost, whichever column it was written to
+        assert dialog['analysis_result']
+        assert dialog['analysis_result'] in "\n".join(values[4:-1])
+        assert dialog['dialog_rating'] in ('Successful', 'Unsuccessful', '')
+
+def test_legacy_rows_are_mapped_by_column_count():
+    rows = list(read_rows(LEGACY_LOG))
+    by_uuid = {row['User UUID'][:8]: row for row in rows}
+    
+    # Dialog rating and analysis, no naturalness rating
+    assert by_uuid['04daf1f1']['Dialog Rating'] == 'Successful'
+    assert by_uuid['04daf1f1']['Naturalness Rating'] == ''
+    assert by_uuid['04daf1f1']['Analysis Result'].startswith('Rating: 7')
+    # Dialog rating, naturalness rating and analysis
+    assert by_uuid['e9dcc323']['Dialog Rating'] == 'Unsuccessful'
+    assert by_uuid['e9dcc323']['Naturalness Rating'] == '1'
+    assert by_uuid['e9dcc323']['Analysis Result'].startswith('Разговор недостаточно длинный')
+    # Naturalness rating and analysis, no dialog rating
+    assert by_uuid['fb0daf75']['Dialog Rating'] == ''
+    assert by_uuid['fb0daf75']['Naturalness Rating'] == '1'
+    # Analysis split over several columns
+    assert by_uuid['15212d50']['Naturalness Rating'] == '7'
+    assert by_uuid['15212d50']['Conversation Log'].startswith('HUMAN: Компания Алексис Войс')
+
+def test_current_log_round_trips_through_parquet(tmp_path):
+    memory = TelegramChatMemory(user_id=7)
+    memory.add_exchange("Алло", "Слушаю")
+    conversation = {
+        'user_uuid': 'uuid-1',
+        'system_prompt': "Вы - клиент.",
+        'rating': True,
+        'naturalness_rating': 4,
+        'memory': memory
+    }
+    row = build_row(7, conversation, memory.format_conversation_log(), "Анализ", analysis_prompt="Оцените")
+    csv_path = tmp_path / 'conversations.csv'
+    with open(csv_path, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(CSV_COLUMNS)
+        writer.writerow([row[column] for column in CSV_COLUMNS])
+    
+    export_parquet([str(csv_path)], str(tmp_path / 'export'))
+    dialog, = pq.read_table(tmp_path / 'export' / 'dialogs.parquet').to_pylist()
+    
+    assert dialog['schema_version'] == 2
+    assert dialog['user_id'] == 7
+    assert dialog['prompt_hash'] == row['Prompt Hash']
+    assert dialog['dialog_rating'] == 'Successful'
+    assert dialog['naturalness_rating'] == 4
+    assert dialog['analysis_prompt_hash'] == row['Analysis Prompt Hash']
+    assert dialog['analysis_result'] == "Анализ"
+    assert dialog['conversation_log'] == memory.format_conversation_log()
@@ -0,0 +1,133 @@
+import asyncio
+from typing import Any, List
+
+import pytest
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from services.llm_service import LLMService
+from services.memory_service import TelegramChatMemory
+
+SYSTEM_PROMPT = "Вы - клиент. Вам позвонили."
+
+class RecordingChatModel(BaseChatModel):
+    """Chat model that keeps the messages of every call and answers with a numbered reply"""
+    
+    calls: List[Any] = []
+    
+    @property
+    def _llm_type(self) -> str:
+        return "recording-chat"
+    
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self.calls.append(list(messages))
+        reply = AIMessage(content=f"Ответ {len(self.calls)}")
+        return ChatResult(generations=[ChatGeneration(message=reply)])
+
+def make_chain():
+    llm = RecordingChatModel(calls=[])
+    llm_service = LLMService()
+    llm_service.register_llm(llm)
+    return llm_service, llm_service.create_chat_chain(SYSTEM_PROMPT), llm
+
+def chat(llm_service, chain, memory, text: str) -> str:
+    """One turn the way the bot handlers run it"""
+    response = chain.invoke(llm_service.build_chain_input(memory.get_messages(), text))
+    memory.add_exchange(text, response.content)
+    return response.content
+
+def test_first_turn_sends_system_prompt_and_user_message_once():
+    llm_service, chain, llm = make_chain()
+    memory = TelegramChatMemory(user_id=1)
+    
+    chat(llm_service, chain, memory, "Алло")
+    
+    assert llm.calls == [[SystemMessage(content=SYSTEM_PROMPT), HumanMessage(content="Алло")]]
+
+def test_history_follows_system_prompt_in_order():
+    llm_service, chain, llm = make_chain()
+    memory = TelegramChatMemory(user_id=1)
+    
+    for text in ("Алло", "Здравствуйте, это кондитерская школа", "Слушаю"):
+        chat(llm_service, chain, memory, text)
+    
+    assert llm.calls[-1] == [
+        SystemMessage(content=SYSTEM_PROMPT),
+        HumanMessage(content="Алло"),
+        AIMessage(content="Ответ 1"),
+        HumanMessage(content="Здравствуйте, это кондитерская школа"),
+        AIMessage(content="Ответ 2"),
+        HumanMessage(content="Слушаю")
+    ]
+
+def test_memory_holds_only_completed_turns():
+    llm_service, chain, llm = make_chain()
+    memory = TelegramChatMemory(user_id=1)
+    
+    chat(llm_service, chain, memory, "Алло")
+    chat(llm_service, chain, memory, "Слушаю")
+    
+    messages = llm.calls[-1]
+    assert sum(isinstance(message, SystemMessage) for message in messages) == 1
+    assert [message.content for message in messages].count("Слушаю") == 1
+    assert memory.get_messages() == [
+        HumanMessage(content="Алло"),
+        AIMessage(content="Ответ 1"),
+        HumanMessage(content="Слушаю"),
+        AIMessage(content="Ответ 2")
+    ]
+
+def summarized_chat():
+    """Dialog in summary mode whose early turns were folded into a summary"""
+    llm_service, chain, llm = make_chain()
+    
+    async def summarize(previous: str, messages) -> str:
+        return "Клиент интересуется курсами"
+    
+    async def run():
+        memory = TelegramChatMemory(user_id=1, token_budget=1, keep_last_turns=1, summarizer=summarize)
+        for text in ("Алло", "Здравствуйте, это кондитерская школа", "Какие курсы есть?"):
+            chat(llm_service, chain, memory, text)
+            if memory._summary_task:
+                await memory._summary_task
+        chat(llm_service, chain, memory, "Сколько стоит?")
+    
+    asyncio.run(run())
+    return llm.calls[-1]
+
+def test_summary_is_a_user_turn_after_the_only_system_message():
+    messages = summarized_chat()
+    
+    # The fold ended after a user message, so the verbatim turns open with a reply
+    assert messages == [
+        SystemMessage(content=SYSTEM_PROMPT),
+        HumanMessage(content="Summary of the earlier conversation:\nКлиент интересуется курсами"),
+        AIMessage(content="Ответ 2"),
+        HumanMessage(content="Какие курсы есть?"),
+        AIMessage(content="Ответ 3"),
+        HumanMessage(content="Сколько стоит?")
+    ]
+
+def test_summary_opens_a_verbatim_user_turn():
+    memory = TelegramChatMemory(user_id=1)
+    memory.load_state({
+        'messages': [['human', "Алло"], ['ai', "Слушаю"], ['human', "Какие курсы есть?"], ['ai', "Ответ"]],
+        'summary': "Клиент взял трубку",
+        'context_start': 2
+    })
+    
+    assert memory.get_messages() == [
+        HumanMessage(content="Summary of the earlier conversation:\nКлиент взял трубку\n\nКакие курсы есть?"),
+        AIMessage(content="Ответ")
+    ]
+
+def test_summarized_history_keeps_gemini_roles():
+    chat_models = pytest.importorskip("langchain_google_genai.chat_models")
+    
+    system_instruction, contents = chat_models._parse_chat_history(summarized_chat())
+    
+    # Gemini gets the system prompt as its instruction and alternating turns that start with the user
+    assert [part.text for part in system_instruction.parts] == [SYSTEM_PROMPT]
+    assert [content.role for content in contents] == ['user', 'model', 'user', 'model', 'user']
@@ -0,0 +1,153 @@
+import time
+import asyncio
+from typing import List
+
+import pytest
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from services.provider_router import ProviderRoute, ProviderRouter
+
+MESSAGES = [HumanMessage(content="Алло")]
+
+class BadRequestError(Exception):
+    """Permanent provider error, the way the OpenAI SDK reports a rejected request"""
+    
+    status_code = 400
+
+class APIConnectionError(Exception):
+    """Transient provider error"""
+
+class FakeChatModel(BaseChatModel):
+    """Chat model that answers after a delay, raising the queued errors on its first calls"""
+    
+    reply: str = "Слушаю"
+    delay: float = 0.0
+    errors: List[Exception] = []
+    calls: int = 0
+    cancelled: int = 0
+    
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+    
+    def _result(self) -> ChatResult:
+        if self.errors:
+            raise self.errors.pop(0)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.reply))])
+    
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self.calls += 1
+        time.sleep(self.delay)
+        return self._result()
+    
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return self._result()
+
+def make_router(*llms, **settings) -> ProviderRouter:
+    names = ('gpt', 'gemini')
+    settings.setdefault('retry_delay', 0)
+    return ProviderRouter(routes=[ProviderRoute(name, llm) for name, llm in zip(names, llms)], **settings)
+
+def test_transient_error_falls_back_to_next_route():
+    primary = FakeChatModel(reply="gpt", errors=[APIConnectionError("connection reset")])
+    fallback = FakeChatModel(reply="gemini")
+    
+    reply = asyncio.run(make_router(primary, fallback).ainvoke(MESSAGES))
+    
+    assert reply.content == "gemini"
+    assert (primary.calls, fallback.calls) == (1, 1)
+
+def test_transient_error_on_every_route_retries_the_round():
+    primary = FakeChatModel(reply="gpt", errors=[APIConnectionError("reset")])
+    fallback = FakeChatModel(reply="gemini", errors=[TimeoutError()])
+    
+    reply = asyncio.run(make_router(primary, fallback, max_retries=2).ainvoke(MESSAGES))
+    
+    assert reply.content == "gpt"
+    assert (primary.calls, fallback.calls) == (2, 1)
+
+def test_permanent_error_is_raised_without_fallback_or_retry():
+    primary = FakeChatModel(errors=[BadRequestError("content filter")])
+    fallback = FakeChatModel()
+    
+    with pytest.raises(BadRequestError):
+        asyncio.run(make_router(primary, fallback, max_retries=2).ainvoke(MESSAGES))
+    
+    assert (primary.calls, fallback.calls) == (1, 0)
+
+def test_blocking_call_raises_permanent_error_without_retry():
+    primary = FakeChatModel(errors=[BadRequestError("bad request")])
+    fallback = FakeChatModel()
+    
+    with pytest.raises(BadRequestError):
+        make_router(primary, fallback, max_retries=2).invoke(MESSAGES)
+    
+    assert (primary.calls, fallback.calls) == (1, 0)
+
+def test_blocking_call_is_cut_off_after_timeout():
+    primary = FakeChatModel(reply="gpt", delay=1.0)
+    fallback = FakeChatModel(reply="gemini")
+    
+    started_at = time.monotonic()
+    reply = make_router(primary, fallback, timeout=0.1).invoke(MESSAGES)
+    
+    assert reply.content == "gemini"
+    assert time.monotonic() - started_at < 0.5
+
+def test_slow_call_is_hedged_on_the_next_route_and_the_loser_cancelled():
+    primary = FakeChatModel(reply="gpt", delay=1.0)
+    fallback = FakeChatModel(reply="gemini")
+    router = make_router(primary, fallback, hedge_percentile=0.95, hedge_min_samples=20)
+    router.routes[0].latencies.extend([0.05] * 20)
+    
+    started_at = time.monotonic()
+    reply = asyncio.run(router.ainvoke(MESSAGES))
+    
+    assert reply.content == "gemini"
+    # The twin starts once the call outlasts the 95th percentile of its route
+    assert time.monotonic() - started_at < 0.5
+    assert (primary.calls, primary.cancelled, fallback.calls) == (1, 1, 1)
+
+def test_slow_call_is_not_hedged_without_another_route():
+    primary = FakeChatModel(reply="gpt", delay=0.2)
+    router = make_router(primary, hedge_percentile=0.95, hedge_min_samples=20)
+    router.routes[0].latencies.extend([0.01] * 20)
+    
+    reply = asyncio.run(router.ainvoke(MESSAGES))
+    
+    assert reply.content == "gpt"
+    assert primary.calls == 1
+
+def test_result_finishing_together_with_the_winner_is_discarded():
+    router = make_router(FakeChatModel(), FakeChatModel(), hedge_percentile=0.95, hedge_min_samples=20)
+    router.routes[0].latencies.extend([0.05] * 20)
+    discarded = []
+    
+    async def run():
+        # The hedged call releases the slow one, so both results arrive at once
+        released = asyncio.Event()
+        
+        async def call(llm):
+            if llm is router.routes[0].llm:
+                await released.wait()
+                return "gpt"
+            released.set()
+            return "gemini"
+        
+        async def discard(result):
+            discarded.append(result)
+        
+        return await router._round(call, discard)
+    
+    winner = asyncio.run(run())
+    
+    assert discarded and winner not in discarded
+    assert sorted([winner] + discarded) == ["gemini", "gpt"]
@@ -0,0 +1,72 @@
+import socket
+import asyncio
+from typing import List
+
+import aiohttp
+from aiohttp import web
+
+from services.shard_service import ShardForwarder, ShardWorker
+
+class FakeBot:
+    """Bot that only records the updates dispatched to it"""
+    
+    def __init__(self):
+        self.update_ids: List[int] = []
+    
+    async def start(self, warm_up: bool = True) -> None:
+        pass
+    
+    async def stop(self) -> None:
+        pass
+    
+    def dispatch_update(self, update) -> None:
+        self.update_ids.append(update.update_id)
+
+class LostAnswerWorker(ShardWorker):
+    """Worker whose first answer fails after the batch was dispatched, like a timeout on the way back"""
+    
+    lost_answers = 1
+    
+    async def handle_updates(self, request: web.Request) -> web.Response:
+        response = await super().handle_updates(request)
+        if self.lost_answers:
+            self.lost_answers -= 1
+            return web.Response(status=500)
+        return response
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+async def deliver(worker: ShardWorker, updates: List[dict]) -> ShardForwarder:
+    port = free_port()
+    await worker.start(host='127.0.0.1', port=port)
+    try:
+        async with aiohttp.ClientSession() as session:
+            forwarder = ShardForwarder(0, f"http://127.0.0.1:{port}/updates", session)
+            for update in updates:
+                forwarder.put(update)
+            await forwarder.flush(timeout=5)
+            return forwarder
+    finally:
+        await worker.stop()
+
+def test_batch_resent_after_a_lost_answer_is_dispatched_once():
+    bot = FakeBot()
+    worker = LostAnswerWorker(bot, shard=0, warm_up=False)
+    
+    forwarder = asyncio.run(deliver(worker, [{'update_id': update_id} for update_id in (1, 2, 3)]))
+    
+    assert bot.update_ids == [1, 2, 3]
+    assert worker.duplicates == 3
+    assert forwarder.forwarded == 3
+
+def test_only_the_most_recent_update_ids_are_kept():
+    bot = FakeBot()
+    worker = ShardWorker(bot, shard=0, warm_up=False, recent_updates=2)
+    
+    asyncio.run(deliver(worker, [{'update_id': update_id} for update_id in (1, 2, 3, 1)]))
+    
+    # Update 1 fell out of the window of two ids, so it counts as new
+    assert bot.update_ids == [1, 2, 3, 1]
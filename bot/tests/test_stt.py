@@ -0,0 +1,152 @@
+import io
+import sys
+import types
+import asyncio
+import logging
+from typing import List
+
+import pytest
+
+from services.stt_backends import LocalWhisperBackend, STTBackend, WhisperAPIBackend, create_stt_backend
+from services.stt_service import STTService
+
+# Start of an Ogg/Opus voice note as Telegram sends it
+OGG_NOTE = b"OggS\x00\x02" + b"\x00" * 20 + b"OpusHead" + b"\x01" * 64
+
+class StubBackend(STTBackend):
+    """Backend that records what it was given and returns a fixed text"""
+    
+    def __init__(self, text: str = "Алло, слушаю", error: Exception = None):
+        self.text = text
+        self.error = error
+        self.received: List[tuple] = []
+    
+    def transcribe(self, audio, filename: str = "voice.ogg") -> str:
+        data = audio if isinstance(audio, bytes) else audio.read()
+        self.received.append((data, filename))
+        if self.error:
+            raise self.error
+        return self.text
+
+class StubSegment:
+    def __init__(self, text: str):
+        self.text = text
+
+class StubWhisperModel:
+    """Stand-in for faster_whisper.WhisperModel that decodes nothing"""
+    
+    instances: List['StubWhisperModel'] = []
+    
+    def __init__(self, model: str, **settings):
+        self.model = model
+        self.settings = settings
+        self.sources: List[bytes] = []
+        self.fail = False
+        StubWhisperModel.instances.append(self)
+    
+    def transcribe(self, source, language=None, vad_filter=False):
+        self.sources.append(source.read())
+        if self.fail:
+            raise RuntimeError("corrupt audio")
+        return (StubSegment(text) for text in (" Алло,", " слушаю.")), None
+
+@pytest.fixture
+def faster_whisper(monkeypatch):
+    StubWhisperModel.instances = []
+    monkeypatch.setitem(sys.modules, 'faster_whisper', types.SimpleNamespace(WhisperModel=StubWhisperModel))
+    return StubWhisperModel
+
+def test_openai_backend_is_the_default(monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'test-key')
+    
+    assert isinstance(create_stt_backend(), WhisperAPIBackend)
+    assert isinstance(create_stt_backend("openai"), WhisperAPIBackend)
+
+def test_unknown_backend_falls_back_to_openai(monkeypatch, caplog):
+    monkeypatch.setenv('OPENAI_API_KEY', 'test-key')
+    
+    with caplog.at_level(logging.ERROR):
+        backend = create_stt_backend("vosk")
+    
+    assert isinstance(backend, WhisperAPIBackend)
+    assert "Unknown STT backend: vosk" in caplog.text
+
+def test_local_backend_loads_the_configured_model_once(faster_whisper):
+    backend = create_stt_backend("local", model="tiny", compute_type="int8", workers=2, language="ru")
+    try:
+        assert isinstance(backend, LocalWhisperBackend)
+        assert backend.streaming
+        assert backend.workers == 2
+        assert backend.language == "ru"
+        model, = faster_whisper.instances
+        assert model.model == "tiny"
+        assert model.settings['compute_type'] == "int8"
+        assert model.settings['num_workers'] == 2
+        
+        backend.transcribe(OGG_NOTE)
+        backend.transcribe(OGG_NOTE)
+        assert len(faster_whisper.instances) == 1
+    finally:
+        backend.close()
+
+def test_local_backend_requires_faster_whisper(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'faster_whisper', None)
+    
+    with pytest.raises(ImportError, match="faster-whisper"):
+        create_stt_backend("local")
+
+def test_ogg_bytes_file_and_path_reach_the_backend_unchanged(tmp_path):
+    backend = StubBackend()
+    service = STTService(backend)
+    note_path = tmp_path / "voice.ogg"
+    note_path.write_bytes(OGG_NOTE)
+    
+    assert service.transcribe_voice(OGG_NOTE) == "Алло, слушаю"
+    assert service.transcribe_voice(io.BytesIO(OGG_NOTE)) == "Алло, слушаю"
+    assert service.transcribe_voice(str(note_path)) == "Алло, слушаю"
+    assert asyncio.run(service.atranscribe_voice(OGG_NOTE)) == "Алло, слушаю"
+    
+    assert backend.received == [(OGG_NOTE, "voice.ogg")] * 4
+
+def test_local_backend_decodes_ogg_from_memory(faster_whisper):
+    backend = LocalWhisperBackend(workers=1)
+    service = STTService(backend)
+    
+    async def stream():
+        return [piece async for piece in service.astream_transcription(OGG_NOTE)]
+    
+    try:
+        assert service.streams_partial_text
+        assert service.transcribe_voice(OGG_NOTE) == "Алло, слушаю."
+        assert asyncio.run(service.atranscribe_voice(OGG_NOTE)) == "Алло, слушаю."
+        assert asyncio.run(stream()) == [" Алло,", " слушаю."]
+        assert faster_whisper.instances[0].sources == [OGG_NOTE] * 3
+    finally:
+        service.close()
+
+def test_transcription_errors_are_logged_and_return_none(caplog):
+    service = STTService(StubBackend(error=RuntimeError("API unavailable")))
+    
+    with caplog.at_level(logging.ERROR):
+        assert service.transcribe_voice(OGG_NOTE) is None
+        assert asyncio.run(service.atranscribe_voice(OGG_NOTE)) is None
+    
+    assert caplog.text.count("Voice transcription error: API unavailable") == 2
+
+def test_missing_voice_file_returns_none(tmp_path):
+    service = STTService(StubBackend())
+    
+    assert service.transcribe_voice(str(tmp_path / "missing.ogg")) is None
+
+def test_streaming_errors_are_raised(faster_whisper):
+    backend = LocalWhisperBackend(workers=1)
+    faster_whisper.instances[0].fail = True
+    
+    async def stream():
+        return [piece async for piece in backend.astream(OGG_NOTE)]
+    
+    try:
+        with pytest.raises(RuntimeError, match="corrupt audio"):
+            asyncio.run(stream())
+    finally:
+        backend.close()
@@ -1,17 +1,33 @@
 import os
+import time
+import asyncio
 import logging
-import yaml
-import tempfile
+from functools import partial
+from typing import Optional, Set
 
-import telebot
+from telebot.async_telebot import AsyncTeleBot
 from dotenv import load_dotenv
 
 # Import services
 from services.llm_service import LLMService
+from services.analysis_cache import AnalysisCache
 from services.stt_service import STTService
+from services.stt_backends import create_stt_backend
 from services.conversation_service import ConversationService
+from services.conversation_store import SQLiteConversationStore
 from services.keyboard_service import KeyboardService
 from services.logging_service import LoggingService
+from services.live_analysis_service import LiveAnalysisService
+from services.search_index import DialogSearchIndex, parse_query
+from services.dispatch_service import UpdateDispatcher
+from services.admission_service import AdmissionService
+from services.streaming_service import StreamingReplyService
+from services.job_service import JobQueueService
+from services.metrics_service import MetricsService
+from services.response_cache import ResponseCache
+from services.experiment_service import ExperimentService
+from services.config_service import ConfigWatcher, load_config, validate_config
+from services.memory_service import count_tokens
 
 # Load environment variables
 load_dotenv()
@@ -25,31 +41,196 @@ logging.basicConfig(
 class TelegramBot:
     """Main Telegram bot class"""
     
-    def __init__(self):
-        # Load configuration
-        self.config = self._load_config()
+    def __init__(
+        self,
+        config: Optional[dict] = None,
+        telegram_bot: Optional[AsyncTeleBot] = None,
+        config_path: str = 'config.yaml'
+    ):
+        # Load configuration, a config file is watched for changes once the bot starts
+        self.config_path = None if config else config_path
+        self.config = config or self._load_config()
+        validate_config(self.config)
+        self.config_watcher = None
         
         # Initialize services
-        self.llm_service = LLMService(self.config['llm_provider'])
-        self.stt_service = STTService()
+        self.metrics = MetricsService(json_logs=self.config.get('metrics_json_logs', False))
+        self.llm_service = LLMService(
+            self.config['llm_provider'],
+            analysis_provider=self.config.get('analysis_llm_provider'),
+            max_connections=self.config.get('llm_max_connections', 100),
+            keepalive_expiry=self.config.get('llm_keepalive_expiry', 120),
+            analysis_cache=AnalysisCache(
+                max_entries=self.config.get('analysis_cache_size', 1000),
+                db_path=self.config.get('analysis_cache_db')
+            ),
+            routing={
+                'fallback_provider': self.config.get('llm_fallback_provider'),
+                'timeout': self.config.get('llm_timeout', 60),
+                'max_retries': self.config.get('llm_max_retries', 2),
+                'hedge_percentile': self.config.get('llm_hedge_percentile'),
+                'hedge_min_samples': self.config.get('llm_hedge_min_samples', 20),
+                'requests_per_minute': self.config.get('llm_requests_per_minute')
+            }
+        )
+        self.experiments = ExperimentService(
+            self.config.get('experiments_db'),
+            shard=self.config.get('cluster_shard', 0)
+        )
+        self._configure_experiment()
         self.conversation_service = ConversationService(
             self.llm_service,
-            self.config['default_system_prompt']
+            self.config['default_system_prompt'],
+            memory_settings={
+                'mode': self.config.get('memory_mode', 'full'),
+                'token_budget': self.config.get('memory_token_budget'),
+                'keep_last_turns': self.config.get('memory_keep_last_turns'),
+                'summary_prompt': self.config.get('memory_summary_prompt')
+            },
+            store=self._create_conversation_store(),
+            cache_size=self.config.get('conversation_cache_size', 1000),
+            cache_ttl=self.config.get('conversation_cache_ttl', 3600),
+            experiments=self.experiments
         )
+        self.response_cache = self._create_response_cache()
         self.keyboard_service = KeyboardService()
-        self.logging_service = LoggingService(self.llm_service)
+        self.live_analysis = self._create_live_analysis()
+        self.search_index = DialogSearchIndex(self.config['search_index_db']) if self.config.get('search_index_db') else None
+        self.logging_service = LoggingService(
+            self.llm_service,
+            log_dir=self.config.get('log_dir', 'logs/llm_experiments'),
+            batch_size=self.config.get('log_batch_size', 50),
+            flush_interval=self.config.get('log_flush_interval', 1.0),
+            fsync_policy=self.config.get('log_fsync_policy', 'batch'),
+            metrics=self.metrics,
+            experiments=self.experiments,
+            live_analysis=self.live_analysis,
+            search_index=self.search_index
+        )
+        self.analysis_queue = JobQueueService(
+            workers=self.config.get('analysis_workers', 2),
+            max_backlog=self.config.get('analysis_max_backlog', 100),
+            max_retries=self.config.get('analysis_max_retries', 3),
+            name="analysis"
+        )
+        
+        # Users whose next text message is a new system prompt
+        self.awaiting_prompt = set()
         
         # Initialize bot
-        self.bot = telebot.TeleBot(os.getenv('TELEGRAM_BOT_TOKEN'))
+        self.bot = telegram_bot or AsyncTeleBot(os.getenv('TELEGRAM_BOT_TOKEN'))
+        self._warm_up_task = None
+        self.stt_service: Optional[STTService] = None
+        self._stt_task: Optional[asyncio.Task] = None
+        self.streaming_service = StreamingReplyService(
+            self.bot,
+            edit_interval=self.config.get('stream_edit_interval', 1.0),
+            metrics=self.metrics
+        )
+        self.dispatcher = None
+        self.admission = None
+        # Replies to turned away messages, sent outside the per-user lanes
+        self._notices: Set[asyncio.Task] = set()
         self._setup_handlers()
     
     def _load_config(self) -> dict:
-        """Load configuration from YAML file"""
-        with open('config.yaml', 'r', encoding='utf-8') as config_file:
-            return yaml.safe_load(config_file)
+        """Load and validate configuration from the YAML file, parsed once per file version"""
+        return load_config(self.config_path)
+    
+    def _create_stt_service(self) -> STTService:
+        """Speech-to-text service, a local model takes seconds to load"""
+        return STTService(create_stt_backend(
+            self.config.get('stt_backend', 'openai'),
+            **self._local_stt_settings()
+        ))
+    
+    def _load_stt_service(self) -> asyncio.Task:
+        """Task creating the speech-to-text service in a thread, started once"""
+        if self._stt_task is None:
+            self._stt_task = asyncio.create_task(asyncio.to_thread(self._create_stt_service))
+            self._stt_task.add_done_callback(self._stt_service_loaded)
+        return self._stt_task
+    
+    def _stt_service_loaded(self, task: asyncio.Task) -> None:
+        if task.cancelled() or task.exception():
+            if not task.cancelled():
+                logging.error(f"Error creating speech-to-text service: {task.exception()}")
+            # The next voice message tries again
+            self._stt_task = None
+            return
+        self.stt_service = task.result()
+    
+    def _local_stt_settings(self) -> dict:
+        """Settings of the local speech-to-text engine, if it is selected"""
+        if self.config.get('stt_backend') != 'local':
+            return {}
+        return {
+            'model': self.config.get('stt_local_model', 'small'),
+            'compute_type': self.config.get('stt_local_compute_type', 'int8'),
+            'workers': self.config.get('stt_local_workers', 0),
+            'language': self.config.get('stt_language')
+        }
+    
+    def _create_conversation_store(self) -> Optional[SQLiteConversationStore]:
+        """Create the conversation store selected in the config, in memory mode the cache is all there is"""
+        if self.config.get('conversation_store') == 'sqlite':
+            return SQLiteConversationStore(self.config['conversation_store_path'])
+        return None
+    
+    def _configure_experiment(self) -> None:
+        """Activate the configured experiment, or stop assigning variants without one"""
+        name = self.config.get('experiment_name')
+        self.experiments.active = None
+        if name:
+            variants = {
+                variant: {
+                    'prompt': (settings or {}).get('prompt') or self.config['default_system_prompt'],
+                    'weight': (settings or {}).get('weight', 1)
+                }
+                for variant, settings in (self.config.get('experiment_variants') or {}).items()
+            }
+            self.experiments.define(name, variants, self.config.get('experiment_assignment', 'user'))
+            logging.info(f"Experiment {name} is running with variants {', '.join(variants)}")
+    
+    def _create_response_cache(self) -> Optional[ResponseCache]:
+        """Create the cache of replies to repeated openers, if it is enabled"""
+        if not self.config.get('response_cache_enabled'):
+            return None
+        embedding_model = self.config.get('response_cache_embedding_model')
+        return ResponseCache(
+            embeddings=self.llm_service.create_embeddings(embedding_model) if embedding_model else None,
+            similarity_threshold=self.config.get('response_cache_similarity', 0.92),
+            max_history=self.config.get('response_cache_max_history', 2),
+            bypass_rate=self.config.get('response_cache_bypass_rate', 0.3),
+            max_variants=self.config.get('response_cache_max_variants', 5),
+            max_entries=self.config.get('response_cache_size', 2000),
+            ttl=self.config.get('response_cache_ttl', 86400)
+        )
+    
+    def _create_live_analysis(self) -> Optional[LiveAnalysisService]:
+        """Create the turn-by-turn dialog analysis, if it is enabled"""
+        if not self.config.get('live_analysis'):
+            return None
+        return LiveAnalysisService(
+            self.llm_service,
+            lambda: self.config['live_analysis_prompt'],
+            window=self.config.get('live_analysis_window', 2),
+            metrics=self.metrics,
+            saved=self._save_live_analysis
+        )
+    
+    def _save_live_analysis(self, conversation: dict) -> None:
+        """Store a running analysis with its conversation, unless the user has started another dialog since"""
+        user_id = conversation['memory'].user_id
+        current = self.conversation_service.get_conversation(user_id)
+        if current and current['user_uuid'] == conversation['user_uuid']:
+            self.conversation_service.save_conversation(user_id, conversation)
     
     def _setup_handlers(self) -> None:
         """Set up all message handlers"""
+        # Pending prompt input takes precedence over every other text handler
+        self.bot.message_handler(func=lambda m: m.from_user.id in self.awaiting_prompt)(self.save_system_prompt)
+        
         # Command handlers
         self.bot.message_handler(commands=['start'])(self.handle_start)
         self.bot.message_handler(commands=['check_prompt'])(self.handle_check_prompt)
@@ -57,11 +238,13 @@ class TelegramBot:
         self.bot.message_handler(commands=['set_prompt'])(self.handle_set_prompt)
         self.bot.message_handler(commands=['start_chat'])(self.handle_start_chat)
         self.bot.message_handler(commands=['end_chat'])(self.handle_end_chat)
+        self.bot.message_handler(commands=['experiment'])(self.handle_experiment)
+        self.bot.message_handler(commands=['search'])(self.handle_search)
         
         # Button handlers
-        self.bot.message_handler(func=lambda m: m.text == "▶️ Начать диалог")(self.handle_start_chat)
-        self.bot.message_handler(func=lambda m: m.text == "⏹ Завершить диалог")(self.handle_end_chat)
-        self.bot.message_handler(func=lambda m: m.text == "🎯 Установить промпт")(self.handle_set_prompt)
+        self.bot.message_handler(func=lambda m: m.text == KeyboardService.START_CHAT_BUTTON)(self.handle_start_chat)
+        self.bot.message_handler(func=lambda m: m.text == KeyboardService.END_CHAT_BUTTON)(self.handle_end_chat)
+        self.bot.message_handler(func=lambda m: m.text == KeyboardService.SET_PROMPT_BUTTON)(self.handle_set_prompt)
         
         # Callback handlers
         self.bot.callback_query_handler(func=lambda c: c.data.startswith('rating_'))(self.handle_rating)
@@ -71,30 +254,30 @@ class TelegramBot:
         self.bot.message_handler(content_types=['voice'])(self.handle_voice_message)
         self.bot.message_handler(func=lambda m: True)(self.handle_text_message)
     
-    def handle_start(self, message):
+    async def handle_start(self, message):
         """Handle /start command"""
         self.conversation_service.create_conversation(message.from_user.id)
-        self.bot.reply_to(
+        await self.bot.reply_to(
             message,
             self.config['welcome_message'],
             reply_markup=self.keyboard_service.create_main_keyboard()
         )
     
-    def handle_check_prompt(self, message):
+    async def handle_check_prompt(self, message):
         """Handle /check_prompt command"""
         user_id = message.from_user.id
         current_prompt = self.conversation_service.get_user_prompt(user_id)
         
         if current_prompt:
-            self.bot.reply_to(message, f"Текущий системный промпт:\n{current_prompt}")
+            await self.bot.reply_to(message, f"Текущий системный промпт:\n{current_prompt}")
         else:
-            self.bot.reply_to(message, self.config['prompt_not_set_message'])
+            await self.bot.reply_to(message, self.config['prompt_not_set_message'])
     
-    def handle_voice_input(self, message):
+    async def handle_voice_input(self, message):
         """Handle /voice_input command"""
-        self.bot.reply_to(message, self.config['voice_input_coming_soon'])
+        await self.bot.reply_to(message, self.config['voice_input_coming_soon'])
     
-    def handle_set_prompt(self, message):
+    async def handle_set_prompt(self, message):
         """Handle /set_prompt command"""
         user_id = message.from_user.id
         current_prompt = self.conversation_service.get_user_prompt(user_id) or self.config['default_system_prompt']
@@ -105,43 +288,129 @@ class TelegramBot:
         chunks = [prompt_message[i:i + 4000] for i in range(0, len(prompt_message), 4000)]
         for i, chunk in enumerate(chunks):
             if i == 0:
-                self.bot.reply_to(message, chunk)
+                await self.bot.reply_to(message, chunk)
             else:
-                self.bot.send_message(message.chat.id, chunk)
+                await self.bot.send_message(message.chat.id, chunk)
         
-        self.bot.register_next_step_handler(message, self.save_system_prompt)
+        self.awaiting_prompt.add(user_id)
     
-    def save_system_prompt(self, message):
+    async def save_system_prompt(self, message):
         """Save new system prompt"""
+        self.awaiting_prompt.discard(message.from_user.id)
+        
         if message.text.startswith('/'):
-            self.bot.reply_to(message, "❌ Изменение промпта отменено.")
+            await self.bot.reply_to(message, "❌ Изменение промпта отменено.")
             return
         
         self.conversation_service.update_system_prompt(message.from_user.id, message.text)
-        self.bot.reply_to(message, f"Системный промпт обновлен:\n{message.text}")
+        await self.bot.reply_to(message, f"Системный промпт обновлен:\n{message.text}")
     
-    def handle_start_chat(self, message):
+    async def handle_start_chat(self, message):
         """Handle chat start command/button"""
         user_id = message.from_user.id
         self.conversation_service.create_conversation(user_id)
-        self.bot.reply_to(message, self.config['chat_started_message'])
-        self.bot.send_message(user_id, "Алло, здравствуйте")
+        await self.bot.reply_to(message, self.config['chat_started_message'])
+        await self.bot.send_message(user_id, "Алло, здравствуйте")
     
-    def handle_end_chat(self, message):
+    async def handle_end_chat(self, message):
         """Handle chat end command/button"""
         user_id = message.from_user.id
         
         if self.conversation_service.is_conversation_active(user_id):
             self.conversation_service.end_conversation(user_id)
-            self.bot.reply_to(
+            if self.live_analysis:
+                # The last turns are analyzed while the user picks a rating
+                self.live_analysis.observe(
+                    self.conversation_service.get_conversation(user_id),
+                    self.config['conversation_analysis_prompt']
+                )
+            await self.bot.reply_to(
                 message,
                 self.config['chat_ended_message'],
                 reply_markup=self.keyboard_service.create_naturalness_rating_keyboard()
             )
         else:
-            self.bot.reply_to(message, self.config['no_active_chat_message'])
+            await self.bot.reply_to(message, self.config['no_active_chat_message'])
+    
+    async def handle_experiment(self, message):
+        """Handle /experiment command, an experiment name may follow the command"""
+        parts = message.text.split(maxsplit=1)
+        # Totals of the other cluster shards are read from SQLite
+        report = await asyncio.to_thread(self.experiments.report, parts[1].strip() if len(parts) > 1 else None)
+        for i in range(0, len(report), 4000):
+            await self.bot.reply_to(message, report[i:i + 4000])
+    
+    async def handle_search(self, message):
+        """Handle /search command, words to find and key:value filters follow the command"""
+        parts = message.text.split(maxsplit=1)
+        if not self.search_index:
+            await self.bot.reply_to(message, "Поиск по диалогам отключен.")
+            return
+        if len(parts) < 2:
+            await self.bot.reply_to(message, self.config.get(
+                'search_help_message',
+                "Поиск по диалогам: /search слова для поиска и фильтры user:ID, rating:successful|unsuccessful|unrated"
+            ))
+            return
+        
+        try:
+            search = parse_query(parts[1])
+        except ValueError as e:
+            await self.bot.reply_to(message, f"Не удалось разобрать запрос: {e}")
+            return
+        # Testers find their own dialogs, admins may search every user's
+        if message.from_user.id not in (self.config.get('search_admin_ids') or []):
+            search['user_id'] = message.from_user.id
+        
+        # The index is shared with the log writer thread, queries wait for its lock off the event loop
+        if 'dialog_id' in search:
+            dialog = await asyncio.to_thread(self.search_index.dialog, search['dialog_id'])
+            if not dialog or ('user_id' in search and dialog['user_id'] != search['user_id']):
+                reply = "Диалог не найден."
+            else:
+                reply = (
+                    f"Диалог #{dialog['id']} от {dialog['timestamp'][:16].replace('T', ' ')}, "
+                    f"пользователь {dialog['user_id']}\n\n"
+                    f"Системный промпт:\n{dialog['system_prompt'] or dialog['prompt_hash']}\n\n"
+                    f"Лог разговора:\n{dialog['conversation_log']}\n\n"
+                    f"Результат анализа:\n{dialog['analysis_result']}"
+                )
+        else:
+            page = search.pop('page', 1)
+            with self.metrics.span("search"):
+                results, has_more = await asyncio.to_thread(
+                    self.search_index.search,
+                    page=page,
+                    page_size=self.config.get('search_page_size', 5),
+                    **search
+                )
+            reply = self._format_search_results(parts[1], page, results, has_more)
+        
+        for i in range(0, len(reply), 4000):
+            await self.bot.reply_to(message, reply[i:i + 4000])
+    
+    @staticmethod
+    def _format_search_results(query: str, page: int, results: list, has_more: bool) -> str:
+        """Plain-text page of search results with the command for the next page"""
+        if not results:
+            return "Ничего не найдено." if page == 1 else "Больше результатов нет."
+        
+        ratings = {'Successful': "успешный", 'Unsuccessful': "неуспешный"}
+        lines = [f"Результаты поиска, страница {page}:"]
+        for result in results:
+            naturalness = f", естественность {result['naturalness_rating']}/5" if result['naturalness_rating'] else ""
+            lines.append(
+                f"\n#{result['id']} {result['timestamp'][:16].replace('T', ' ')}, пользователь {result['user_id']}, "
+                f"промпт {result['prompt_hash'][:8]}, {ratings.get(result['dialog_rating'], 'без оценки')}{naturalness}\n"
+                f"{result['snippet']}"
+            )
+        if has_more:
+            words = [word for word in query.split() if not word.lower().startswith('page:')]
+            lines.append(f"\nСледующая страница: /search {' '.join(words)} page:{page + 1}")
+        lines.append("Весь диалог: /search id:номер")
+        return "\n".join(lines)
     
-    def handle_rating(self, call):
+    async def handle_rating(self, call):
         """Handle conversation rating callback"""
         user_id = call.from_user.id
         conversation = self.conversation_service.get_conversation(user_id)
@@ -149,26 +418,12 @@ class TelegramBot:
         if conversation:
             is_successful = call.data == 'rating_successful'
             self.conversation_service.set_rating(user_id, is_successful)
+            await self.bot.answer_callback_query(call.id)
             
             response_text = "Спасибо! Разговор отмечен как успешный. 👍\n" if is_successful else "Спасибо за ваш отзыв. Разговор отмечен как неуспешный. 👎\n"
-            
-            # Log conversation and get analysis
-            analysis_result = self.logging_service.log_conversation(
-                user_id,
-                conversation,
-                self.config['conversation_analysis_prompt']
-            )
-            
-            response_text += f"Результат анализа:\n{analysis_result}"
-            
-            self.bot.answer_callback_query(call.id)
-            self.bot.edit_message_text(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text=response_text
-            )
+            await self._queue_analysis(call, user_id, conversation, response_text)
     
-    def handle_naturalness_rating(self, call):
+    async def handle_naturalness_rating(self, call):
         """Handle naturalness rating callback"""
         user_id = call.from_user.id
         conversation = self.conversation_service.get_conversation(user_id)
@@ -176,108 +431,417 @@ class TelegramBot:
         if conversation:
             rating = int(call.data.split('_')[-1])
             self.conversation_service.set_naturalness_rating(user_id, rating)
+            await self.bot.answer_callback_query(call.id)
             
-            # Log conversation and get analysis
-            analysis_result = self.logging_service.log_conversation(
+            response_text = f"Спасибо за оценку! Вы оценили естественность диалога на {rating} из 5.\n"
+            await self._queue_analysis(call, user_id, conversation, response_text)
+    
+    async def _queue_analysis(self, call, user_id: int, conversation: dict, response_text: str) -> None:
+        """Run logging and analysis in the background and edit the result into the rating message"""
+        chat_id = call.message.chat.id
+        message_id = call.message.message_id
+        # Freeze the ratings as they are now, the user may rate again before the job runs
+        snapshot = dict(conversation)
+        
+        async def deliver(analysis_result):
+            await self.streaming_service.edit_reply(
+                chat_id,
+                message_id,
+                f"{response_text}Результат анализа:\n{analysis_result}"
+            )
+        
+        async def fail(error):
+            await self.logging_service.awrite_conversation(
                 user_id,
-                conversation,
+                snapshot,
+                "Unable to analyze conversation",
                 self.config['conversation_analysis_prompt']
             )
-            
-            response_text = f"Спасибо за оценку! Вы оценили естественность диалога на {rating} из 5.\n"
-            response_text += f"Результат анализа:\n{analysis_result}"
-            
-            self.bot.answer_callback_query(call.id)
-            self.bot.edit_message_text(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text=response_text
+            await deliver("Не удалось проанализировать разговор.")
+        
+        # Show progress before queueing so a fast result is never overwritten
+        await deliver("⏳ Анализ выполняется...")
+        
+        queued = self.analysis_queue.submit(
+            partial(
+                self.logging_service.alog_conversation,
+                user_id,
+                snapshot,
+                self.config['conversation_analysis_prompt']
+            ),
+            on_done=deliver,
+            on_error=fail
+        )
+        if not queued:
+            await self.logging_service.awrite_conversation(
+                user_id,
+                snapshot,
+                "Analysis skipped: queue is full",
+                self.config['conversation_analysis_prompt']
             )
+            await deliver("Сервис анализа перегружен, попробуйте позже.")
     
-    def handle_voice_message(self, message):
+    async def handle_voice_message(self, message):
         """Handle voice messages"""
         user_id = message.from_user.id
         
         if not self.conversation_service.is_conversation_active(user_id):
-            self.bot.reply_to(message, "Пожалуйста, начните чат, используя /start_chat")
+            await self.bot.reply_to(message, "Пожалуйста, начните чат, используя /start_chat")
             return
         
         conversation = self.conversation_service.get_conversation(user_id)
-        memory = conversation['memory']
-        chain = conversation['chain']
         
         try:
-            # Download and save voice file
-            voice_info = self.bot.get_file(message.voice.file_id)
-            downloaded_file = self.bot.download_file(voice_info.file_path)
-            
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.ogg') as temp_voice:
-                temp_voice.write(downloaded_file)
-                temp_voice_path = temp_voice.name
-            
-            # Transcribe voice message
-            transcribed_text = self.stt_service.transcribe_voice(temp_voice_path)
-            os.unlink(temp_voice_path)
-            
-            if not transcribed_text:
-                self.bot.reply_to(message, "Извините, не удалось расшифровать голосовое сообщение.")
-                return
-            
-            # Send transcription to user
-            self.bot.reply_to(message, f"Расшифрованный текст: {transcribed_text}")
-            
-            # Process message
-            memory.add_user_message(transcribed_text)
-            response = chain.invoke({
-                "input": transcribed_text,
-                "chat_history": memory.get_messages()
-            })
-            
-            # Handle response
-            ai_response = response.content
-            memory.add_ai_message(ai_response)
-            self.bot.reply_to(message, ai_response)
-            
+            with self.metrics.trace("voice_message", user_id=user_id):
+                # Download voice file into memory
+                with self.metrics.span("voice_download"):
+                    voice_info = await self.bot.get_file(message.voice.file_id)
+                    downloaded_file = await self.bot.download_file(voice_info.file_path)
+                
+                # Transcribe voice message
+                with self.metrics.span("stt"):
+                    await asyncio.shield(self._load_stt_service())
+                    if self.stt_service.streams_partial_text:
+                        # Show the transcription growing while long notes are decoded
+                        transcribed_text = await self._stream_transcription(message, downloaded_file)
+                    else:
+                        transcribed_text = await self.stt_service.atranscribe_voice(downloaded_file)
+                        if transcribed_text:
+                            await self.bot.reply_to(message, f"Расшифрованный текст: {transcribed_text}")
+                
+                if not transcribed_text:
+                    await self.bot.reply_to(message, "Извините, не удалось расшифровать голосовое сообщение.")
+                    return
+                
+                # Process message
+                await self._respond(message, conversation, transcribed_text)
+        
         except Exception as e:
             logging.error(f"Error processing voice message: {e}")
-            self.bot.reply_to(message, "Извините, произошла ошибка при обработке вашего голосового сообщения.")
+            await self.bot.reply_to(message, "Извините, произошла ошибка при обработке вашего голосового сообщения.")
     
-    def handle_text_message(self, message):
+    async def _stream_transcription(self, message, voice: bytes) -> str:
+        """Transcribe a voice note, editing the partial text into a reply as it arrives"""
+        prefix = "Расшифрованный текст: "
+        
+        async def pieces():
+            yield prefix
+            async for piece in self.stt_service.astream_transcription(voice):
+                yield piece
+        
+        shown_text = await self.streaming_service.stream_reply(message, pieces())
+        return shown_text[len(prefix):].strip()
+    
+    async def handle_text_message(self, message):
         """Handle text messages"""
         user_id = message.from_user.id
         
         if not self.conversation_service.is_conversation_active(user_id):
-            self.bot.reply_to(
+            await self.bot.reply_to(
                 message,
                 "Пожалуйста, начните чат, используя /start_chat или кнопку '▶️ Начать диалог'"
             )
             return
         
         conversation = self.conversation_service.get_conversation(user_id)
-        memory = conversation['memory']
-        chain = conversation['chain']
         
         try:
             # Process message
-            memory.add_user_message(message.text)
-            response = chain.invoke({
-                "input": message.text,
-                "chat_history": memory.get_messages()
-            })
-            
-            # Handle response
-            ai_response = response.content
-            memory.add_ai_message(ai_response)
-            self.bot.reply_to(message, ai_response)
-            
+            with self.metrics.trace("text_message", user_id=user_id):
+                await self._respond(message, conversation, message.text)
+        
         except Exception as e:
             logging.error(f"Error processing message: {e}")
-            self.bot.reply_to(message, "Извините, произошла ошибка при обработке вашего сообщения.")
+            await self.bot.reply_to(message, "Извините, произошла ошибка при обработке вашего сообщения.")
+    
+    async def _respond(self, message, conversation: dict, user_text: str) -> None:
+        """Reply to a user message with the LLM and record the turn in memory"""
+        started_at = time.perf_counter()
+        memory = conversation['memory']
+        chain = conversation['chain']
+        with self.metrics.span("prompt_build"):
+            chat_history = memory.get_messages()
+            chain_input = self.llm_service.build_chain_input(chat_history, user_text)
+        self.metrics.observe("history_messages", len(chat_history))
+        self.metrics.observe("history_tokens", memory.context_tokens)
+        
+        cache_probe = None
+        if self.response_cache:
+            with self.metrics.span("response_cache"):
+                cache_probe = await self.response_cache.probe(conversation['system_prompt'], chat_history, user_text)
+        
+        if cache_probe and cache_probe.reply is not None:
+            ai_response = cache_probe.reply
+            await self.streaming_service.send_reply(message, ai_response)
+        elif self.config.get('stream_replies', False):
+            ai_response = await self.streaming_service.stream_reply(
+                message,
+                self._stream_content(chain, chain_input)
+            )
+        else:
+            llm_started_at = time.perf_counter()
+            response = await chain.ainvoke(chain_input)
+            # Without streaming the first token reaches the user with the whole reply
+            self.metrics.record("llm_ttft", time.perf_counter() - llm_started_at)
+            self.metrics.record("llm_total", time.perf_counter() - llm_started_at)
+            ai_response = response.content
+            self._observe_usage(response.usage_metadata, ai_response)
+            await self.streaming_service.send_reply(message, ai_response)
+        
+        if cache_probe and cache_probe.reply is None:
+            self.response_cache.store(cache_probe, ai_response)
+        
+        # The turn is stored only once it is complete, so history never holds it twice
+        with self.metrics.span("memory_save"):
+            conversation['reply_seconds'] += time.perf_counter() - started_at
+            if self.admission:
+                self.admission.record_turn(time.perf_counter() - started_at)
+            memory.add_exchange(user_text, ai_response)
+            self.conversation_service.save_conversation(message.from_user.id, conversation)
+        if self.live_analysis:
+            self.live_analysis.observe(conversation, self.config['conversation_analysis_prompt'])
+    
+    async def _stream_content(self, chain, chain_input: dict):
+        """Yield the text of each streamed chain chunk, timing only the waits on the LLM"""
+        waited = 0.0
+        usage = None
+        text = ""
+        resumed_at = time.perf_counter()
+        async for chunk in chain.astream(chain_input):
+            if not text and chunk.content:
+                self.metrics.record("llm_ttft", waited + time.perf_counter() - resumed_at)
+            waited += time.perf_counter() - resumed_at
+            if chunk.usage_metadata:
+                usage = chunk.usage_metadata
+            if chunk.content:
+                text += chunk.content
+                yield chunk.content
+            # Time spent editing Telegram messages between chunks is not LLM time
+            resumed_at = time.perf_counter()
+        
+        self.metrics.record("llm_total", waited + time.perf_counter() - resumed_at)
+        self._observe_usage(usage, text)
+    
+    def _observe_usage(self, usage: Optional[dict], reply: str) -> None:
+        """Record the token counts of an LLM call, estimating them if the provider sent none"""
+        if usage:
+            self.llm_service.record_usage(usage)
+            self.metrics.observe("input_tokens", usage.get('input_tokens', 0))
+            self.metrics.observe("cached_input_tokens", (usage.get('input_token_details') or {}).get('cache_read', 0) or 0)
+            self.metrics.observe("output_tokens", usage.get('output_tokens', 0))
+        else:
+            self.metrics.observe("output_tokens", count_tokens(reply))
+    
+    @staticmethod
+    def _update_user_id(update) -> int:
+        """Get the id of the user an update belongs to"""
+        for event in (update.message, update.callback_query, update.edited_message):
+            if event and event.from_user:
+                return event.from_user.id
+        return 0
+    
+    def _starts_turn(self, user_id: int, update) -> bool:
+        """Whether an update is a chat message the LLM answers, not a command, button or prompt"""
+        message = update.message
+        if not message or message.content_type not in ('text', 'voice') or user_id in self.awaiting_prompt:
+            return False
+        return message.content_type == 'voice' or not (
+            message.text.startswith('/') or message.text in KeyboardService.MENU_BUTTONS
+        )
+    
+    def dispatch_update(self, update) -> None:
+        """Queue an update behind earlier updates from the same user, chat messages pass admission first"""
+        user_id = self._update_user_id(update)
+        if self._starts_turn(user_id, update):
+            if update.message.content_type == 'text':
+                self.admission.hold(user_id, update)
+                return
+            self.admission.release(user_id)
+            self.admission.admit(user_id, update)
+            return
+        
+        # Held messages keep their place in front of this update
+        self.admission.release(user_id)
+        self._submit_update(user_id, update)
+    
+    def _submit_update(self, user_id: int, update) -> None:
+        self.dispatcher.submit(user_id, partial(self.process_update, update))
+    
+    async def process_update(self, update) -> None:
+        """Run the handlers of an update once the provider clients are loaded"""
+        # Handlers build chains, waiting here keeps them off the clients lock held by the warm-up thread
+        if self._warm_up_task and not self._warm_up_task.done():
+            await asyncio.wait([self._warm_up_task])
+        await self.bot.process_new_updates([update])
+    
+    def _turn_away(self, update, reason: str) -> None:
+        """Tell the user why a message gets no reply, without waiting for a free slot"""
+        if reason == 'rate_limited':
+            text = self.config.get(
+                'rate_limited_message',
+                "Вы отправляете сообщения слишком часто. Подождите немного, и я отвечу на следующее."
+            )
+        else:
+            text = self.config.get(
+                'overloaded_message',
+                "Сейчас слишком много собеседников. Пожалуйста, повторите сообщение через минуту."
+            )
+        notice = asyncio.create_task(self.bot.reply_to(update.message, text))
+        self._notices.add(notice)
+        notice.add_done_callback(self._notices.discard)
+    
+    def _admission_settings(self) -> dict:
+        return {
+            'debounce': self.config.get('admission_debounce', 0),
+            'max_debounce': self.config.get('admission_max_debounce', 5.0),
+            'turns_per_minute': self.config.get('admission_turns_per_minute'),
+            'burst': self.config.get('admission_burst', 3),
+            'max_queue_wait': self.config.get('admission_max_queue_wait')
+        }
+    
+    async def _poll_updates(self) -> None:
+        """Long-poll Telegram and hand updates to the dispatcher in arrival order"""
+        offset = None
+        while True:
+            try:
+                updates = await self.bot.get_updates(
+                    offset=offset,
+                    timeout=self.config.get('polling_timeout', 20)
+                )
+            except Exception as e:
+                logging.error(f"Error fetching updates: {e}")
+                await asyncio.sleep(3)
+                continue
+            
+            for update in updates:
+                offset = update.update_id + 1
+                self.dispatch_update(update)
+    
+    async def start(self, warm_up: bool = True) -> None:
+        """Start background workers, after this updates can be dispatched"""
+        self.dispatcher = UpdateDispatcher(self.config.get('max_concurrent_users', 16))
+        self.admission = AdmissionService(
+            self.dispatcher,
+            self._submit_update,
+            self._turn_away,
+            **self._admission_settings()
+        )
+        self.analysis_queue.start()
+        self._register_metrics()
+        if self.config.get('metrics_port'):
+            await self.metrics.start_server(
+                self.config.get('metrics_host', '127.0.0.1'),
+                self.config['metrics_port']
+            )
+        if warm_up:
+            # Updates are accepted while the provider clients and the speech-to-text engine load in threads,
+            # handlers wait for them
+            self._warm_up_task = asyncio.create_task(self.llm_service.warm_up())
+            self._load_stt_service()
+        if self.config_path and self.config.get('config_reload_interval', 2):
+            self.config_watcher = ConfigWatcher(
+                self.config_path,
+                self.config,
+                self.apply_config,
+                interval=self.config.get('config_reload_interval', 2)
+            )
+            self.config_watcher.start()
+    
+    def apply_config(self, config: dict, changed: Set[str]) -> None:
+        """Apply a reloaded config to the running bot, settings read at startup need a restart"""
+        self.config = config
+        # Messages, prompts and these settings are read from the config when they are used
+        applied = {'polling_timeout', 'stream_replies', 'voice_input_coming_soon', 'stream_edit_interval', 'config_reload_interval'}
+        
+        if 'default_system_prompt' in changed:
+            self.conversation_service.default_system_prompt = config['default_system_prompt']
+        if changed & {'memory_mode', 'memory_token_budget', 'memory_keep_last_turns', 'memory_summary_prompt'}:
+            # New conversations get the new memory settings
+            self.conversation_service.memory_settings = {
+                'mode': config.get('memory_mode', 'full'),
+                'token_budget': config.get('memory_token_budget'),
+                'keep_last_turns': config.get('memory_keep_last_turns'),
+                'summary_prompt': config.get('memory_summary_prompt')
+            }
+            applied |= {'memory_mode', 'memory_token_budget', 'memory_keep_last_turns', 'memory_summary_prompt'}
+        if 'stream_edit_interval' in changed:
+            self.streaming_service.edit_interval = config.get('stream_edit_interval', 1.0)
+        if changed & {'experiment_name', 'experiment_assignment', 'experiment_variants', 'default_system_prompt'}:
+            self._configure_experiment()
+            applied |= {'experiment_name', 'experiment_assignment', 'experiment_variants'}
+        if any(key.startswith('admission_') for key in changed):
+            for name, value in self._admission_settings().items():
+                setattr(self.admission, name, value)
+            applied |= {key for key in changed if key.startswith('admission_')}
+        if self.config_watcher and 'config_reload_interval' in changed:
+            self.config_watcher.interval = config.get('config_reload_interval') or 2
+        
+        restart = sorted(key for key in changed - applied if not key.endswith(('_message', '_prompt')))
+        if restart:
+            logging.warning(f"Config changes need a restart to take effect: {', '.join(restart)}")
+    
+    def _register_metrics(self) -> None:
+        """Expose queue depths and cache statistics next to the timing spans"""
+        self.metrics.register_collector('bot_dispatcher', lambda: {
+            'pending_updates': self.dispatcher.pending(),
+            'active_users': self.dispatcher.active_lanes()
+        })
+        self.metrics.register_collector('bot_admission', self.admission.metrics)
+        self.metrics.register_collector('bot_analysis_queue', self.analysis_queue.metrics)
+        if self.live_analysis:
+            self.metrics.register_collector('bot_live_analysis', self.live_analysis.stats)
+        self.metrics.register_collector('bot_prompt_cache', self.llm_service.prompt_cache_stats)
+        if self.response_cache:
+            self.metrics.register_collector('bot_response_cache', self.response_cache.stats)
+        self.metrics.register_collector('bot_conversations', lambda: {
+            'cached': len(self.conversation_service.conversations)
+        })
+        if self.llm_service.analysis_cache:
+            self.metrics.register_collector('bot_analysis_cache', lambda: {
+                'hits': self.llm_service.analysis_cache.hits,
+                'misses': self.llm_service.analysis_cache.misses
+            })
+    
+    async def stop(self) -> None:
+        """Finish queued work and release all resources"""
+        if self.config_watcher:
+            await self.config_watcher.stop()
+        if self._warm_up_task:
+            await self._warm_up_task
+        if self._stt_task:
+            await asyncio.wait([self._stt_task])
+        self.admission.close()
+        await self.dispatcher.drain()
+        await asyncio.gather(*self._notices, return_exceptions=True)
+        await self.analysis_queue.stop()
+        if self.live_analysis:
+            await self.live_analysis.close()
+        await self.metrics.stop_server()
+        self.logging_service.close()
+        if self.search_index:
+            self.search_index.close()
+        if self.stt_service:
+            self.stt_service.close()
+        await self.llm_service.aclose()
+        if self.llm_service.analysis_cache:
+            self.llm_service.analysis_cache.close()
+        if self.conversation_service.store:
+            self.conversation_service.store.close()
+        self.experiments.close()
+        await self.bot.close_session()
+    
+    async def run_async(self):
+        """Start the bot inside a running event loop"""
+        await self.start()
+        logging.info("LLM Experiment Telegram Bot started...")
+        try:
+            await self._poll_updates()
+        finally:
+            await self.stop()
     
     def run(self):
         """Start the bot"""
-        logging.info("LLM Experiment Telegram Bot started...")
-        self.bot.polling(none_stop=True)
+        asyncio.run(self.run_async())
 
 def main():
     """Main entry point"""